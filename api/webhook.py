@@ -1,13 +1,61 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response
+from starlette.routing import Route
 from telegram import Update
 from bot.telegram_bot import build_bot
+from bot.dispatcher import UpdateDispatcher
+from bot.dedup import dedup
+from bot.tracing import metrics
+from bot.alerts import alert_digest
+from bot.prefilter import build_prefilter
+from db.database import close_db, init_db, pool_stats
+from db.link_buffer import link_buffer
 import asyncio
+import json
+import os
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
 
 app = FastAPI()
 bot_app = build_bot()
 
 bot_lock = asyncio.Lock()
 
+# Updates run in order per chat and in parallel across chats (bot/dispatcher.py).
+# WEBHOOK_ASYNC=1: ack Telegram right away and let the dispatcher work in
+# the background. Only for long-running servers (uvicorn etc.) — a
+# serverless function may be frozen as soon as the response is sent.
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+dispatcher = UpdateDispatcher(bot_app.process_update)
+
+# Updates no handler can act on are acked without building an Update
+# (bot/prefilter.py); derived from bot_app's handlers
+keep_update = build_prefilter(bot_app, settled=dispatcher.settled)
+skipped_updates = 0
+
+# The webhook answers the same bytes every time. A new Response per
+# request all the same: FastAPI sets the request's BackgroundTasks on it
+OK_BODY = b'{"status":"ok"}'
+
+def ok_response():
+    return Response(OK_BODY, media_type="application/json")
+
+# WEBHOOK_RAW_ROUTE=1: serve POST /api/webhook as a plain Starlette route,
+# without FastAPI's request / response handling (same handler, see below)
+WEBHOOK_RAW_ROUTE = os.getenv("WEBHOOK_RAW_ROUTE", "0") == "1"
+
+# Open the DB pool while the first update is still being parsed
+DB_PREWARM = os.getenv("DB_PREWARM", "1") == "1"
+_warmup_tasks = []
+
 async def init_bot_once():
     if not getattr(bot_app, "_initialized", False):
         async with bot_lock:
@@ -16,22 +64,126 @@ async def init_bot_once():
                 bot_app._initialized = True
                 print("✅ Bot initialized safely")
 
+async def warm(what, coro):
+    try:
+        await coro
+    except Exception as e:
+        # The request path retries and reports the real error
+        print(f"⚠️ {what} pre-warm failed:", e)
+
+def start_warmup():
+    """First request of a cold instance: connect the DB pool and initialize
+    the bot in the background instead of one after another in the request."""
+    if not _warmup_tasks:
+        if DB_PREWARM:
+            _warmup_tasks.append(asyncio.ensure_future(warm("DB", init_db())))
+        _warmup_tasks.append(asyncio.ensure_future(warm("Bot", init_bot_once())))
+
+@app.on_event("shutdown")
+async def flush_pending_writes():
+    await dispatcher.drain()
+    await alert_digest.close()
+    await link_buffer.close()
+    await close_db()
+
 @app.get("/")
 async def root():
     return {"status": "ok"}
 
-@app.post("/api/webhook")
-async def telegram_webhook(request: Request):
+@app.get("/api/stats")
+async def stats():
+    return {
+        "skipped_updates": skipped_updates,
+        "db_pool": pool_stats(),
+        "dispatcher": dispatcher.stats(),
+        "duplicate_updates": dedup.duplicates,
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    pool = pool_stats()
+    gauges = [
+        ("bot_db_pool_in_use", "DB connections in use.", pool["in_use"]),
+        ("bot_db_pool_size", "Open DB connections.", pool["size"]),
+        ("bot_db_pool_waiters", "Tasks waiting for a DB connection.", pool["waiters"]),
+        ("bot_dispatcher_queued", "Updates waiting in dispatcher shards.", dispatcher.qsize()),
+        ("bot_link_buffer_pending", "Link writes not yet flushed.", len(link_buffer)),
+        ("bot_duplicate_updates_total", "Redelivered updates dropped.", dedup.duplicates),
+        ("bot_skipped_updates_total", "Updates no handler could act on, dropped unparsed.", skipped_updates),
+        ("bot_alerts_pending", "Users waiting for the next alert digest.", len(alert_digest)),
+        ("bot_alert_digests_total", "Alert digests sent.", alert_digest.sent),
+        ("bot_alerts_merged_total", "Repeat alerts merged into a pending digest.", alert_digest.merged),
+        ("bot_outbound_queued", "Bot API requests waiting for a rate limit token.", bot_app.bot.rate_limiter.queued),
+        ("bot_outbound_retries_total", "Bot API requests retried after a RetryAfter.", bot_app.bot.rate_limiter.retries),
+        ("bot_outbound_refused_total", "Bot API requests refused instead of waiting for a token.", bot_app.bot.rate_limiter.refused),
+    ]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+def error_response(status_code, detail):
+    body = json_dumps({"status": "error", "detail": detail})
+    return Response(body, status_code=status_code, media_type="application/json")
+
+_settle_tasks = set()
+
+async def settle_update(update_id, done):
+    """Fast-ack mode: the dedup claim is done once the dispatcher processed
+    the update, and released if a handler raised (bot/dispatcher.py)."""
+    try:
+        await done
+    except Exception:
+        await dedup.forget(update_id)
+    else:
+        await dedup.finish(update_id)
+
+async def handle_webhook(body: bytes) -> Response:
+    """Raw request body in, response out (both webhook routes)."""
+    global skipped_updates
+    start_warmup()
+    try:
+        data = json_loads(body)
+        update_id = data.get("update_id")
+    except (ValueError, AttributeError) as e:
+        # Not an update; a retry would not change that
+        print("❌ Webhook got an invalid body:", e)
+        return error_response(400, "invalid update")
+
+    if not keep_update(data):
+        skipped_updates += 1
+        return ok_response()
+
+    # Telegram redelivery of an update we already have → ack and drop
+    if not await dedup.claim(update_id):
+        return ok_response()
+
     try:
-        data = await request.json()
         update = Update.de_json(data, bot_app.bot)
 
         # Safe init
         await init_bot_once()
 
-        await bot_app.process_update(update)
-        return {"status": "ok"}
+        if WEBHOOK_ASYNC:
+            done = await dispatcher.put(update)
+            settle = asyncio.ensure_future(settle_update(update_id, done))
+            _settle_tasks.add(settle)
+            settle.add_done_callback(_settle_tasks.discard)
+        else:
+            await dispatcher.process_now(update)
+            await dedup.finish(update_id)
+        return ok_response()
 
     except Exception as e:
         print("❌ Webhook processing failed:", e)
-        return {"status": "error", "detail": str(e)}, 500
+        # A 500 makes Telegram redeliver; let that copy through dedup
+        await dedup.forget(update_id)
+        return error_response(500, str(e))
+
+@app.post("/api/webhook")
+async def telegram_webhook(request: Request):
+    return await handle_webhook(await request.body())
+
+async def raw_telegram_webhook(request):
+    return await handle_webhook(await request.body())
+
+if WEBHOOK_RAW_ROUTE:
+    # Matched before the FastAPI route of the same path
+    app.router.routes.insert(0, Route("/api/webhook", raw_telegram_webhook, methods=["POST"]))
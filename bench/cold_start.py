@@ -0,0 +1,162 @@
+"""
+Cold-start benchmark for the webhook entry point.
+
+Each run starts a fresh interpreter that imports api.webhook and POSTs one
+update to the FastAPI app in-process, then reports:
+
+    spawn_to_response_ms  process start → first webhook response (parent clock)
+    import_ms             import of api.webhook (FastAPI, PTB, build_bot)
+    first_response_ms     first POST /api/webhook: a plain "done" in a group
+                          with tracking on, so the bot is initialized, the
+                          update parsed and count_ad_messages loads the chat
+
+Runs offline by default: a cached bot identity (BOT_USERNAME) so initialize
+makes no getMe call, DB pre-warm and DB dedup off, and the database is
+bench/load_test.py's in-memory stub. The sender is not a participant, so
+nothing is sent to Telegram. Pass --with-db to use DATABASE_URL instead
+(and keep pre-warm).
+
+    python bench/cold_start.py --runs 10
+    python bench/cold_start.py --importtime     # slowest imports of one run
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHAT_ID = -100123
+
+# Kept by the prefilter (no cached session yet) and handled by count_ad_messages
+TEXT_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": CHAT_ID, "type": "supergroup", "title": "cold start"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Bench"},
+        "text": "done",
+    },
+}
+
+
+def stub_database():
+    """bench/load_test.py's in-memory database, the chat's tracking on."""
+    import db.database as database
+    from load_test import RoundTrips, StubDB, StubPool
+
+    db = StubDB(latency=0)
+    db._session(CHAT_ID)["tracking_enabled"] = True
+    database.pool = StubPool(db, RoundTrips())
+
+
+def child(with_db):
+    sys.path.insert(0, ROOT)
+    import asyncio
+
+    start = time.perf_counter()
+    import api.webhook as webhook
+    imported = time.perf_counter()
+
+    import httpx
+
+    if not with_db:
+        stub_database()
+
+    async def first_request():
+        transport = httpx.ASGITransport(app=webhook.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            t0 = time.perf_counter()
+            response = await client.post("/api/webhook", json=TEXT_UPDATE)
+            return response.status_code, time.perf_counter() - t0
+
+    status, first = asyncio.run(first_request())
+    print(json.dumps({
+        "import_ms": (imported - start) * 1000,
+        "first_response_ms": first * 1000,
+        "status": status,
+    }))
+
+
+def child_env(with_db):
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    env.setdefault("BOT_USERNAME", "bench_bot")
+    if not with_db:
+        env["DB_PREWARM"] = "0"
+        env["DEDUP_DB"] = "0"
+    return env
+
+
+def run_once(env, with_db, extra_args=()):
+    child_args = ["--child", "--with-db"] if with_db else ["--child"]
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, *extra_args, os.path.abspath(__file__), *child_args],
+        env=env, cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    elapsed = (time.perf_counter() - t0) * 1000
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["spawn_to_response_ms"] = elapsed
+    return result, proc.stderr
+
+
+def print_importtime(stderr, top=15):
+    rows = []
+    for line in stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    rows.sort(reverse=True)
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, own, name in rows[:top]:
+        print(f"{cumulative / 1000:14.1f} {own / 1000:9.1f}  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--with-db", action="store_true")
+    parser.add_argument("--importtime", action="store_true")
+    parser.add_argument("--json", action="store_true", help="machine readable output")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.with_db)
+        return
+
+    env = child_env(args.with_db)
+
+    if args.importtime:
+        _, stderr = run_once(env, args.with_db, ("-X", "importtime"))
+        print_importtime(stderr)
+        return
+
+    results = [run_once(env, args.with_db)[0] for _ in range(args.runs)]
+    summary = {}
+    for key in ("spawn_to_response_ms", "import_ms", "first_response_ms"):
+        values = [r[key] for r in results]
+        summary[key] = {
+            "median": round(statistics.median(values), 1),
+            "min": round(min(values), 1),
+            "max": round(max(values), 1),
+        }
+
+    if args.json:
+        print(json.dumps({"runs": args.runs, **summary}))
+        return
+
+    print(f"{args.runs} cold starts (status {results[0]['status']})")
+    for key, stats in summary.items():
+        print(f"  {key:22} median {stats['median']:8.1f}  min {stats['min']:8.1f}  max {stats['max']:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,723 @@
+"""
+Load test: replay synthetic link sessions through the webhook in-process.
+
+Per chat the scenario is what a real session looks like:
+
+    /open, /tracking                        admin opens the session
+    links   every user posts an X link (some post two, some reuse a handle)
+    done    most users say "done", the rest chat
+    /unsafe, /mult, /muteall                admin reports and end of session
+
+Updates are POSTed to api/webhook.py's FastAPI app over httpx's ASGI
+transport. The bot talks to a fake Telegram Bot API server on 127.0.0.1
+(real HTTP, via TELEGRAM_API_URL), and the database is an in-memory stub
+of the bot's queries (or a real Postgres with --database-url). Reported:
+
+    p50 / p99 / mean latency of the webhook call, per handler
+    throughput (updates/s) per phase and overall
+    DB round trips per update, per handler
+    Bot API calls per method, peak RSS (and tracemalloc peak)
+
+Telegram's rate limits (bot/outbound.py) are on by default, as in
+production: past 20 messages per chat and minute, user notices are
+dropped and commands that would wait longer than OUTBOUND_MAX_WAIT fail
+(counted as errors; Telegram would deliver them again). The report shows
+the most messages any chat got in one minute. --no-rate-limits lifts the
+limits to measure the handlers alone.
+
+Everything is seeded and offline, so runs are comparable across commits:
+
+    python bench/load_test.py --users 300 --chats 2
+    python bench/load_test.py --no-rate-limits --json > before.json
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import math
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOT_TOKEN = "123456:LOADTEST"
+ADMIN_ID = 1000
+FIRST_USER_ID = 100_000
+FIRST_CHAT_ID = -1_001_000_000_000
+
+# Which handler an update goes to; DB round trips are charged to it
+current_kind = contextvars.ContextVar("current_kind", default="background")
+
+
+# ----------------------------------------------------------------------
+# Fake Telegram Bot API
+# ----------------------------------------------------------------------
+
+class FakeTelegram:
+    """Minimal Bot API: answers the methods the bot uses, counts calls."""
+
+    def __init__(self, bot_id):
+        self.bot_id = bot_id
+        self.calls = Counter()
+        self.sent_at = defaultdict(list)    # chat id -> monotonic time of every message sent
+        self._message_id = 0
+
+    def _chat(self, chat_id):
+        return {"id": int(chat_id), "type": "supergroup", "title": "load test"}
+
+    def _message(self, params):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": self._chat(params.get("chat_id", FIRST_CHAT_ID)),
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": "loadtest_bot"},
+            "text": params.get("text", ""),
+        }
+
+    def max_messages_per_minute(self):
+        """Most messages any chat got within 60 seconds."""
+        most = 0
+        for times in self.sent_at.values():
+            start = 0
+            for end, at in enumerate(times):
+                while at - times[start] >= 60:
+                    start += 1
+                most = max(most, end - start + 1)
+        return most
+
+    def answer(self, method, params):
+        self.calls[method] += 1
+        if method in ("sendMessage", "sendSticker"):
+            self.sent_at[params.get("chat_id")].append(time.monotonic())
+            return self._message(params)
+        if method == "getChatAdministrators":
+            return [{
+                "status": "creator",
+                "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"},
+                "is_anonymous": False,
+            }]
+        if method == "getChatMember":
+            return {
+                "status": "administrator",
+                "user": {"id": int(params.get("user_id", self.bot_id)), "is_bot": True, "first_name": "bot"},
+                "can_be_edited": False,
+                "is_anonymous": False,
+                "can_manage_chat": True,
+                "can_delete_messages": True,
+                "can_manage_video_chats": True,
+                "can_restrict_members": True,
+                "can_promote_members": False,
+                "can_change_info": True,
+                "can_invite_users": True,
+            }
+        if method == "getMe":
+            return {"id": self.bot_id, "is_bot": True, "first_name": "loadtest_bot", "username": "loadtest_bot"}
+        # restrictChatMember, setChatPermissions, setChatTitle, pinChatMessage, ...
+        return True
+
+    async def __call__(self, scope, receive, send):
+        # Plain ASGI app: POST /bot<token>/<method>, form encoded parameters
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        method = scope["path"].rsplit("/", 1)[-1]
+        params = {}
+        for key, values in parse_qs(body.decode()).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+
+        payload = json.dumps({"ok": True, "result": self.answer(method, params)}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+
+async def start_fake_telegram(app):
+    import uvicorn
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="off"))
+    task = asyncio.ensure_future(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task, sock.getsockname()[1]
+
+
+# ----------------------------------------------------------------------
+# Database: in-memory stub of the bot's queries, or a counted real pool
+# ----------------------------------------------------------------------
+
+class RoundTrips:
+    def __init__(self):
+        self.by_kind = Counter()
+
+    def count(self):
+        self.by_kind[current_kind.get()] += 1
+
+
+class StubDB:
+    """Answers the exact SQL constants the bot sends, from Python dicts."""
+
+    def __init__(self, latency):
+        from bot import dedup, moderation, state
+        from db import link_buffer
+
+        self.latency = latency
+        self.sessions = {}       # chat_id -> sessionsdata row
+        self.users = {}          # (session_id, tg_user_id) -> users row
+        self.links = defaultdict(list)   # users.id -> urls
+        self.claimed = set()
+        self._ids = Counter()
+
+        self.handlers = {
+            link_buffer.FLUSH_LINKS_SQL: self._flush_links,
+            state.VERSION_SQL: self._version,
+            state.LOAD_USERS_SQL: self._load_users,
+            state.SET_TRACKING_SQL: self._set_tracking,
+            state.SET_AD_WORDS_SQL: self._set_ad_words,
+            state.RESET_SESSION_SQL: self._reset_session,
+            state.MARK_USERS_SQL: self._mark_users,
+            state.CLOSE_SESSION_SQL: self._close_session,
+            dedup.CLAIM_SQL: self._claim,
+            moderation.NEW_JOB_SQL: self._new_job,
+        }
+
+    def _next(self, name):
+        self._ids[name] += 1
+        return self._ids[name]
+
+    def _session(self, chat_id):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            session = self.sessions[chat_id] = {
+                "chat_id": chat_id,
+                "version": 0,
+                "tracking_enabled": False,
+                "ad_words": None,
+                "session_id": self._next("session"),
+                "start_time": datetime.now(timezone.utc),
+            }
+        return session
+
+    def _bump(self, chat_id):
+        session = self._session(chat_id)
+        session["version"] += 1
+        return session
+
+    def _session_users(self, session_id):
+        return sorted(
+            (row for (sid, _), row in self.users.items() if sid == session_id),
+            key=lambda row: row["id"],
+        )
+
+    def _flush_links(self, chat_ids, user_ids, usernames, full_names, x_usernames, urls):
+        touched = {chat_id: self._bump(chat_id) for chat_id in dict.fromkeys(chat_ids)}
+        for chat_id, user_id, username, full_name, x_username, url in zip(
+            chat_ids, user_ids, usernames, full_names, x_usernames, urls
+        ):
+            key = (touched[chat_id]["session_id"], user_id)
+            row = self.users.get(key)
+            if row is None:
+                row = self.users[key] = {
+                    "id": self._next("user"),
+                    "tg_user_id": user_id,
+                    "username": username,
+                    "full_name": full_name,
+                    "x_username": None,
+                    "link_count": 0,
+                    "ad_count": 0,
+                    "status": "unsafe",
+                }
+            row["link_count"] += 1
+            row["x_username"] = row["x_username"] or x_username
+            self.links[row["id"]].append(url)
+        return [{"chat_id": chat_id, "version": s["version"]} for chat_id, s in touched.items()]
+
+    def _version(self, chat_id):
+        session = self.sessions.get(chat_id)
+        return [dict(session)] if session else []
+
+    def _load_users(self, session_id, start_time):
+        return [
+            {**row, "links": list(self.links[row["id"]])}
+            for row in self._session_users(session_id)
+        ]
+
+    def _set_tracking(self, chat_id, enabled):
+        session = self._bump(chat_id)
+        session["tracking_enabled"] = enabled
+        return [{"version": session["version"]}]
+
+    def _set_ad_words(self, chat_id, words):
+        session = self._bump(chat_id)
+        session["ad_words"] = words
+        return [{"version": session["version"]}]
+
+    def _reset_session(self, chat_id):
+        session = self._bump(chat_id)
+        session.update(
+            session_id=self._next("session"),
+            tracking_enabled=False,
+            start_time=datetime.now(timezone.utc),
+        )
+        return [{"version": session["version"], "session_id": session["session_id"], "start_time": session["start_time"]}]
+
+    def _mark_users(self, chat_id, user_ids, status, reset_ad_count, ad_increment):
+        session = self._bump(chat_id)
+        changed = []
+        for user_id in user_ids:
+            row = self.users.get((session["session_id"], user_id))
+            if row:
+                row["status"] = status
+                row["ad_count"] = 0 if reset_ad_count else row["ad_count"] + ad_increment
+                changed.append(user_id)
+        return [{"version": session["version"], "user_ids": changed}]
+
+    def _close_session(self, chat_id):
+        session = self._bump(chat_id)
+        session["tracking_enabled"] = False
+        rows = self._session_users(session["session_id"])
+        unsafe = [row["tg_user_id"] for row in rows if row["status"] != "safe"]
+        for row in rows:
+            if row["status"] != "safe":
+                row["status"] = "unsafe"
+        return [{"version": session["version"], "unsafe_ids": unsafe, "safe_count": len(rows) - len(unsafe)}]
+
+    def _claim(self, update_id, ttl):
+        if update_id in self.claimed:
+            return []
+        self.claimed.add(update_id)
+        return [{"update_id": update_id}]
+
+    def _new_job(self, *args):
+        return [{"id": self._next("job")}]
+
+    async def run(self, query, args):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        handler = self.handlers.get(query)
+        # Anything else (checkpoints, retention, prune...) only needs to succeed
+        return handler(*args) if handler else []
+
+
+class StubConnection:
+    def __init__(self, db, trips):
+        self.db = db
+        self.trips = trips
+
+    async def fetch(self, query, *args):
+        self.trips.count()
+        return await self.db.run(query, args)
+
+    async def fetchrow(self, query, *args):
+        self.trips.count()
+        rows = await self.db.run(query, args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query, *args):
+        self.trips.count()
+        rows = await self.db.run(query, args)
+        return next(iter(rows[0].values())) if rows else 0
+
+    async def execute(self, query, *args):
+        self.trips.count()
+        await self.db.run(query, args)
+        return "OK"
+
+    async def executemany(self, query, args):
+        self.trips.count()
+        for row in args:
+            await self.db.run(query, row)
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class StubPool:
+    def __init__(self, db, trips, size=10):
+        self._connections = asyncio.Queue()
+        for _ in range(size):
+            self._connections.put_nowait(StubConnection(db, trips))
+        self._size = size
+
+    async def acquire(self):
+        return await self._connections.get()
+
+    async def release(self, con):
+        self._connections.put_nowait(con)
+
+    def get_size(self):
+        return self._size
+
+    def get_idle_size(self):
+        return self._connections.qsize()
+
+    async def close(self):
+        pass
+
+
+class CountingConnection:
+    """Real asyncpg connection, every query counted as one round trip."""
+
+    def __init__(self, con, trips):
+        self._con = con
+        self._trips = trips
+
+    def __getattr__(self, name):
+        attr = getattr(self._con, name)
+        if name in ("fetch", "fetchrow", "fetchval", "execute", "executemany"):
+            async def counted(*args, **kwargs):
+                self._trips.count()
+                return await attr(*args, **kwargs)
+            return counted
+        return attr
+
+
+class CountingPool:
+    def __init__(self, pool, trips):
+        self._pool = pool
+        self._trips = trips
+        self._wrapped = {}
+
+    async def acquire(self):
+        con = await self._pool.acquire()
+        wrapped = CountingConnection(con, self._trips)
+        self._wrapped[id(wrapped)] = con
+        return wrapped
+
+    async def release(self, con):
+        await self._pool.release(self._wrapped.pop(id(con)))
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+# ----------------------------------------------------------------------
+# Scenario
+# ----------------------------------------------------------------------
+
+class Scenario:
+    def __init__(self, users, chats, multi_link, shared_handle, done, seed):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.chats = [FIRST_CHAT_ID - i for i in range(chats)]
+        self.multi_link = multi_link
+        self.shared_handle = shared_handle
+        self.done = done
+        self._update_id = 0
+        self._message_id = 0
+        self.kinds = {}   # update_id -> handler kind
+
+    def _message(self, chat_id, user_id, text, kind, entities=()):
+        self._update_id += 1
+        self._message_id += 1
+        self.kinds[self._update_id] = kind
+        sender = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "load test"},
+            "from": sender,
+            "text": text,
+        }
+        if entities:
+            message["entities"] = list(entities)
+        return {"update_id": self._update_id, "message": message}
+
+    def command(self, chat_id, name):
+        text = f"/{name}"
+        return self._message(
+            chat_id, ADMIN_ID, text, text,
+            [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        )
+
+    def _link(self, chat_id, user_id, handle):
+        url = f"https://x.com/{handle}/status/{self.rng.randrange(10**17, 10**18)}?s=20"
+        text = f"{url} please like"
+        return self._message(chat_id, user_id, text, "link", [{"type": "url", "offset": 0, "length": len(url)}])
+
+    def _per_chat(self, build):
+        """Interleave the chats' updates, keeping each chat's own order."""
+        streams = [build(chat_index, chat_id) for chat_index, chat_id in enumerate(self.chats)]
+        merged = []
+        while any(streams):
+            for stream in streams:
+                if stream:
+                    merged.append(stream.pop(0))
+        return merged
+
+    def _user_ids(self, chat_index):
+        first = FIRST_USER_ID + chat_index * self.users
+        return list(range(first, first + self.users))
+
+    def phases(self):
+        def open_phase(chat_index, chat_id):
+            return [self.command(chat_id, "open"), self.command(chat_id, "tracking")]
+
+        def link_phase(chat_index, chat_id):
+            user_ids = self._user_ids(chat_index)
+            updates = []
+            for user_id in user_ids:
+                handle = f"handle{user_id}"
+                if self.rng.random() < self.shared_handle:
+                    handle = f"handle{self.rng.choice(user_ids)}"
+                updates.append(self._link(chat_id, user_id, handle))
+                if self.rng.random() < self.multi_link:
+                    updates.append(self._link(chat_id, user_id, handle))
+            self.rng.shuffle(updates)
+            return updates
+
+        def done_phase(chat_index, chat_id):
+            updates = []
+            for user_id in self._user_ids(chat_index):
+                if self.rng.random() < self.done:
+                    updates.append(self._message(chat_id, user_id, self.rng.choice(["done", "all done", "Done ✅"]), "done"))
+                else:
+                    updates.append(self._message(chat_id, user_id, "liked most of them, brb", "chat"))
+            self.rng.shuffle(updates)
+            return updates
+
+        def report_phase(chat_index, chat_id):
+            return [self.command(chat_id, name) for name in ("unsafe", "mult", "muteall")]
+
+        return [
+            ("open", self._per_chat(open_phase)),
+            ("links", self._per_chat(link_phase)),
+            ("done", self._per_chat(done_phase)),
+            ("reports", self._per_chat(report_phase)),
+        ]
+
+
+# ----------------------------------------------------------------------
+# Runner
+# ----------------------------------------------------------------------
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_env(args, port):
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "BOT_USERNAME": "loadtest_bot",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{port}",
+        "WEBHOOK_ASYNC": "0",
+    })
+    if args.no_rate_limits:
+        os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "100000")
+        os.environ.setdefault("OUTBOUND_CHAT_LIMIT", "100000")
+        os.environ.setdefault("OUTBOUND_CHAT_PERIOD", "1")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+        os.environ.setdefault("DB_SSL", "disable")
+
+
+async def run(args):
+    sys.path.insert(0, ROOT)
+
+    fake = FakeTelegram(int(BOT_TOKEN.split(":")[0]))
+    server, server_task, port = await start_fake_telegram(fake)
+    configure_env(args, port)
+
+    import httpx
+    import db.database as database
+
+    trips = RoundTrips()
+    if args.database_url:
+        database.pool = CountingPool(await database.init_db(), trips)
+    else:
+        database.pool = StubPool(StubDB(args.db_latency_ms / 1000), trips)
+
+    import api.webhook as webhook
+
+    scenario = Scenario(args.users, args.chats, args.multi_link, args.shared_handle, args.done, args.seed)
+
+    # Charge DB round trips to the handler the update is for
+    process = webhook.dispatcher.process
+
+    async def tagged_process(update):
+        token = current_kind.set(scenario.kinds.get(update.update_id, "other"))
+        try:
+            return await process(update)
+        finally:
+            current_kind.reset(token)
+
+    webhook.dispatcher.process = tagged_process
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    latencies = defaultdict(list)
+    phase_stats = {}
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    transport = httpx.ASGITransport(app=webhook.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+
+        async def post(update):
+            nonlocal errors
+            kind = scenario.kinds[update["update_id"]]
+            async with semaphore:
+                # The ASGI app runs in this task: dedup etc. are charged too
+                token = current_kind.set(kind)
+                t0 = time.perf_counter()
+                try:
+                    response = await client.post("/api/webhook", json=update)
+                finally:
+                    elapsed = time.perf_counter() - t0
+                    current_kind.reset(token)
+            latencies[kind].append(elapsed)
+            if response.status_code != 200 or response.json().get("status") != "ok":
+                errors += 1
+
+        total_start = time.perf_counter()
+        for name, updates in scenario.phases():
+            start = time.perf_counter()
+            # Reports run one after another, like an admin typing them
+            if name in ("open", "reports"):
+                for update in updates:
+                    await post(update)
+            else:
+                await asyncio.gather(*(post(update) for update in updates))
+            elapsed = time.perf_counter() - start
+            phase_stats[name] = {
+                "updates": len(updates),
+                "seconds": round(elapsed, 3),
+                "updates_per_s": round(len(updates) / elapsed, 1) if elapsed else None,
+            }
+        total_elapsed = time.perf_counter() - total_start
+
+    await webhook.dispatcher.drain()
+    await webhook.link_buffer.close()
+
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    server.should_exit = True
+    await server_task
+
+    total_updates = sum(len(v) for v in latencies.values())
+    handlers = {}
+    for kind, values in sorted(latencies.items()):
+        handlers[kind] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "mean_ms": round(statistics.mean(values) * 1000, 3),
+            "db_round_trips_per_update": round(trips.by_kind[kind] / len(values), 2),
+        }
+
+    return {
+        "commit": git_commit(),
+        "params": {
+            "users": args.users,
+            "chats": args.chats,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "db": "postgres" if args.database_url else f"stub ({args.db_latency_ms} ms)",
+            "rate_limits": "lifted" if args.no_rate_limits else "real",
+        },
+        "updates": total_updates,
+        "errors": errors,
+        "seconds": round(total_elapsed, 3),
+        "updates_per_s": round(total_updates / total_elapsed, 1),
+        "phases": phase_stats,
+        "handlers": handlers,
+        "db_round_trips": sum(trips.by_kind.values()),
+        "db_round_trips_background": trips.by_kind["background"],
+        "bot_api_calls": dict(sorted(fake.calls.items())),
+        "max_messages_per_chat_minute": fake.max_messages_per_minute(),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tracemalloc_peak_mb": round(traced_peak / 2**20, 1) if traced_peak is not None else None,
+    }
+
+
+def print_report(result):
+    params = result["params"]
+    print(
+        f"commit {result['commit']}  users/chat {params['users']}  chats {params['chats']}  "
+        f"concurrency {params['concurrency']}  db {params['db']}  rate limits {params['rate_limits']}"
+    )
+    print(
+        f"{result['updates']} updates in {result['seconds']:.2f}s → {result['updates_per_s']} updates/s"
+        f"  ({result['errors']} errors)"
+    )
+    for name, phase in result["phases"].items():
+        print(f"  {name:8} {phase['updates']:6} updates  {phase['seconds']:8.3f}s  {phase['updates_per_s']} /s")
+
+    print(f"\n{'handler':12} {'count':>6} {'p50 ms':>9} {'p99 ms':>9} {'mean ms':>9} {'db trips/upd':>13}")
+    for kind, stats in result["handlers"].items():
+        print(
+            f"{kind:12} {stats['count']:6} {stats['p50_ms']:9.2f} {stats['p99_ms']:9.2f} "
+            f"{stats['mean_ms']:9.2f} {stats['db_round_trips_per_update']:13.2f}"
+        )
+
+    print(f"\nDB round trips: {result['db_round_trips']} ({result['db_round_trips_background']} background)")
+    print("Bot API calls: " + ", ".join(f"{m} {n}" for m, n in result["bot_api_calls"].items()))
+    print(f"Messages per chat: at most {result['max_messages_per_chat_minute']} in one minute (Telegram allows 20)")
+    memory = f"peak RSS {result['peak_rss_mb']} MB"
+    if result["tracemalloc_peak_mb"] is not None:
+        memory += f", tracemalloc peak {result['tracemalloc_peak_mb']} MB"
+    print(memory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=300, help="users per chat")
+    parser.add_argument("--chats", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=40, help="parallel webhook calls (Telegram's default max_connections)")
+    parser.add_argument("--multi-link", type=float, default=0.1, help="share of users posting a second link")
+    parser.add_argument("--shared-handle", type=float, default=0.05, help="share of users reusing another's X handle")
+    parser.add_argument("--done", type=float, default=0.7, help="share of users saying done")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db-latency-ms", type=float, default=1.0, help="simulated round trip of the DB stub")
+    parser.add_argument("--database-url", help="use this Postgres instead of the stub (migrate it first: python -m db.migrations)")
+    parser.add_argument("--no-rate-limits", action="store_true", help="lift the outbound rate limits (handler cost only)")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak (slower)")
+    parser.add_argument("--json", action="store_true", help="machine readable output")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
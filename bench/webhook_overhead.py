@@ -0,0 +1,201 @@
+"""
+Microbenchmark: per-request overhead of the webhook entry point.
+
+Calls the ASGI app directly (no HTTP, no httpx) with updates the
+prefilter acks right away, so what is measured is body parsing, routing,
+the handler's own work and writing the response. Compared:
+
+    legacy      the previous handler: await request.json(), dict response
+    fastapi     POST /api/webhook as shipped (raw body, orjson, constant response)
+    starlette   the same handler as a plain Starlette route (WEBHOOK_RAW_ROUTE=1)
+
+plus json vs orjson parsing of the bodies alone. Offline: cached bot
+identity, DB pre-warm and DB dedup off.
+
+    python bench/webhook_overhead.py
+    python bench/webhook_overhead.py --requests 20000 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STICKER_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": -100123, "type": "supergroup", "title": "bench"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Bench"},
+        "sticker": {
+            "file_id": "CAACAgUAAxkBAAICLWfAVQEf", "file_unique_id": "AgADVgUAAgyw2VY",
+            "width": 512, "height": 512, "is_animated": False, "is_video": False, "type": "regular",
+        },
+    },
+}
+
+# An edit of a long message with many links: large body, still dropped
+EDIT_UPDATE = {
+    "update_id": 2,
+    "edited_message": {
+        "message_id": 2,
+        "date": 0,
+        "edit_date": 1,
+        "chat": {"id": -100123, "type": "supergroup", "title": "bench"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Bench"},
+        "text": " ".join(f"https://x.com/user{i}/status/{10**18 + i}" for i in range(100)),
+        "entities": [{"type": "url", "offset": i * 46, "length": 45} for i in range(100)],
+    },
+}
+
+
+def configure_env():
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("BOT_USERNAME", "bench_bot")
+    os.environ["DB_PREWARM"] = "0"
+    os.environ["DEDUP_DB"] = "0"
+    os.environ["WEBHOOK_RAW_ROUTE"] = "0"
+
+
+def legacy_app(webhook):
+    """The handler as it was: stdlib json via request.json(), dict responses."""
+    from fastapi import FastAPI, Request
+
+    app = FastAPI()
+
+    @app.post("/api/webhook")
+    async def telegram_webhook(request: Request):
+        try:
+            webhook.start_warmup()
+            data = await request.json()
+            # Only updates the prefilter drops are benchmarked
+            webhook.keep_update(data)
+            return {"status": "ok"}
+        except Exception as e:
+            return {"status": "error", "detail": str(e)}, 500
+
+    return app
+
+
+async def call(app, body):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "https",
+        "path": "/api/webhook",
+        "raw_path": b"/api/webhook",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 1),
+        "server": ("bench", 443),
+    }
+    sent = False
+    status = None
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {"type": "http.disconnect"}
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def measure(app, body, requests, rounds):
+    """Median µs per request over `rounds` rounds."""
+    status = await call(app, body)
+    if status != 200:
+        raise RuntimeError(f"webhook answered {status}")
+    for _ in range(requests // 10):
+        await call(app, body)
+
+    per_round = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(requests):
+            await call(app, body)
+        per_round.append((time.perf_counter() - start) / requests * 1e6)
+    return statistics.median(per_round)
+
+
+def measure_parse(loads, body, requests, rounds):
+    per_round = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(requests):
+            loads(body)
+        per_round.append((time.perf_counter() - start) / requests * 1e6)
+    return statistics.median(per_round)
+
+
+async def run(args):
+    configure_env()
+    sys.path.insert(0, ROOT)
+    import api.webhook as webhook
+    from starlette.routing import Route
+
+    bodies = {
+        "sticker": json.dumps(STICKER_UPDATE).encode(),
+        "large edit": json.dumps(EDIT_UPDATE).encode(),
+    }
+    apps = {"legacy": legacy_app(webhook), "fastapi": webhook.app}
+
+    results = {}
+    for name, body in bodies.items():
+        row = results[name] = {"body_bytes": len(body)}
+        for mode, app in apps.items():
+            row[mode] = await measure(app, body, args.requests, args.rounds)
+
+    # Same as starting with WEBHOOK_RAW_ROUTE=1
+    webhook.app.router.routes.insert(0, Route("/api/webhook", webhook.raw_telegram_webhook, methods=["POST"]))
+    for name, body in bodies.items():
+        results[name]["starlette"] = await measure(webhook.app, body, args.requests, args.rounds)
+
+    for name, body in bodies.items():
+        results[name]["parse json"] = measure_parse(json.loads, body, args.requests, args.rounds)
+        if webhook.json_loads is not json.loads:
+            results[name]["parse orjson"] = measure_parse(webhook.json_loads, body, args.requests, args.rounds)
+
+    await webhook.dispatcher.drain()
+    return results
+
+
+def print_results(results):
+    columns = ["legacy", "fastapi", "starlette", "parse json", "parse orjson"]
+    print(f"{'update':<12}{'bytes':>7}" + "".join(f"{c:>14}" for c in columns) + "   (µs/request)")
+    for name, row in results.items():
+        cells = "".join(f"{row[c]:>14.1f}" if c in row else f"{'-':>14}" for c in columns)
+        print(f"{name:<12}{row['body_bytes']:>7}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000, help="requests per round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# bot/ad_matcher.py
+import re
+from functools import lru_cache
+
+
+def normalize_ad_words(words):
+    """Lowercased, stripped, non-empty words as a frozenset (the cache key)."""
+    return frozenset(w.strip().lower() for w in words if w and w.strip())
+
+
+@lru_cache(maxsize=128)
+def compile_ad_matcher(words: frozenset):
+    """One regex for the whole word list: \\b(?:w1|w2|...)\\b, case-insensitive.
+
+    Cached per word set, so it is only rebuilt when a chat's list changes."""
+    if not words:
+        return None
+    # Longest first so multi-word phrases are tried before their parts
+    alternation = "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternation})\b", re.IGNORECASE)
+
+
+def matches(matcher, *texts) -> bool:
+    if matcher is None:
+        return False
+    return any(text and matcher.search(text) for text in texts)
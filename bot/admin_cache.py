@@ -0,0 +1,72 @@
+# bot/admin_cache.py
+import asyncio
+import os
+import time
+
+from telegram import ChatMember, Update
+from telegram.ext import ContextTypes
+
+# How long a chat's admin list is trusted before asking Telegram again
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+
+ADMIN_STATUSES = {ChatMember.ADMINISTRATOR, ChatMember.OWNER}
+
+_admins = {}       # chat_id -> (expires_at, frozenset of admin user ids)
+_inflight = {}     # chat_id -> task fetching the admin list
+_generation = {}   # chat_id -> bumped on invalidation, drops stale fetches
+
+
+async def get_admin_ids(chat) -> frozenset:
+    """Admin user ids of `chat`, from cache or one shared getChatAdministrators call."""
+    cached = _admins.get(chat.id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    # Coalesce concurrent lookups for the same chat into one request
+    task = _inflight.get(chat.id)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_admin_ids(chat))
+        _inflight[chat.id] = task
+    return await asyncio.shield(task)
+
+
+async def _fetch_admin_ids(chat) -> frozenset:
+    generation = _generation.get(chat.id, 0)
+    try:
+        admins = await chat.get_administrators()
+    finally:
+        _inflight.pop(chat.id, None)
+
+    admin_ids = frozenset(admin.user.id for admin in admins)
+
+    # Only cache if nobody invalidated the chat while we were fetching
+    if _generation.get(chat.id, 0) == generation:
+        _admins[chat.id] = (time.monotonic() + ADMIN_CACHE_TTL, admin_ids)
+    return admin_ids
+
+
+async def is_admin(update: Update) -> bool:
+    chat = update.effective_chat
+    user_id = update.message.from_user.id
+    # Cached per chat, refreshed on TTL or admin changes
+    return user_id in await get_admin_ids(chat)
+
+
+def invalidate(chat_id):
+    _admins.pop(chat_id, None)
+    _inflight.pop(chat_id, None)
+    _generation[chat_id] = _generation.get(chat_id, 0) + 1
+
+
+async def track_admin_changes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ChatMemberUpdated handler: drop the cached admin list when someone is
+    promoted or demoted. Needs "chat_member" in the webhook's allowed_updates."""
+    member_update = update.chat_member or update.my_chat_member
+    if not member_update:
+        return
+
+    was_admin = member_update.old_chat_member.status in ADMIN_STATUSES
+    is_admin_now = member_update.new_chat_member.status in ADMIN_STATUSES
+
+    if was_admin or is_admin_now:
+        invalidate(member_update.chat.id)
@@ -0,0 +1,196 @@
+# bot/alerts.py
+"""
+Coalesced user alerts ("@x shared more than one link").
+
+Alerts are collected per chat for ALERT_WINDOW seconds and sent as one
+digest message (one line per user, latest link count wins). With
+ALERT_BUDGET set, each chat may send at most that many digests per
+ALERT_BUDGET_PERIOD seconds; past that, alerts keep merging into the next
+digest. A RetryAfter the outbound scheduler gave up on pauses the chat's
+digests instead of retrying into the flood limit.
+
+Priority lane: while an admin command runs in a chat (see
+prioritize_commands), that chat's digest waits for it, so command replies
+never queue behind bulk alerts. Digests also go out in the ALERT class of
+the outbound scheduler (bot/outbound.py).
+
+Both default to 0: every alert is sent from its own update, within the
+outbound scheduler's per-chat limit. A window or budget keeps alerts in
+process memory after the response, so only set them on a long-running
+server (see WEBHOOK_ASYNC); a frozen or recycled serverless instance would
+send them late or never.
+"""
+import asyncio
+import functools
+import os
+from contextlib import asynccontextmanager
+
+from telegram.error import RetryAfter
+from telegram.ext import CommandHandler
+
+from bot.outbound import ALERT
+from bot.ratelimit import BucketMap, retry_after_seconds
+
+ALERT_WINDOW = float(os.getenv("ALERT_WINDOW", "0"))
+# Digests per chat and ALERT_BUDGET_PERIOD (0 = no budget)
+ALERT_BUDGET = int(os.getenv("ALERT_BUDGET", "0"))
+ALERT_BUDGET_PERIOD = float(os.getenv("ALERT_BUDGET_PERIOD", "60"))
+# Users listed in one digest; the rest are summed up
+ALERT_MAX_LINES = int(os.getenv("ALERT_MAX_LINES", "50"))
+
+
+class _PendingAlerts:
+    __slots__ = ("bot", "lines", "timer")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lines = {}     # user id -> (mention, link count), first-alert order
+        self.timer = None
+
+
+class AlertDigest:
+    def __init__(self, window=ALERT_WINDOW, budget=ALERT_BUDGET, period=ALERT_BUDGET_PERIOD):
+        self.window = window
+        self._pending = {}        # chat_id -> _PendingAlerts
+        self._budgets = BucketMap(budget / period, burst=budget) if budget > 0 else None
+        self._busy = {}           # chat_id -> admin commands running
+        self._idle = {}           # chat_id -> Event set when _busy drops to 0
+        self.sent = 0
+        self.merged = 0
+
+    def __len__(self):
+        return sum(len(p.lines) for p in self._pending.values())
+
+    async def add(self, bot, chat_id, user_id, mention, link_count):
+        """Queue a "shared more than one link" alert for the chat's next digest."""
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = self._pending[chat_id] = _PendingAlerts(bot)
+        if user_id in pending.lines:
+            self.merged += 1
+        pending.lines[user_id] = (mention, link_count)
+
+        if pending.timer is None:
+            if self.window <= 0 and not self._busy.get(chat_id):
+                await self.flush(chat_id)
+            else:
+                self._schedule(chat_id, pending, self.window)
+
+    def _schedule(self, chat_id, pending, delay):
+        pending.timer = asyncio.ensure_future(self._flush_later(chat_id, delay))
+
+    async def _flush_later(self, chat_id, delay):
+        await asyncio.sleep(delay)
+        pending = self._pending.get(chat_id)
+        if pending is not None:
+            pending.timer = None
+        try:
+            await self.flush(chat_id)
+        except Exception as e:
+            print("⚠️ Alert digest failed:", e)
+
+    async def flush(self, chat_id, ignore_budget=False):
+        # Priority lane: admin commands of this chat go first
+        idle = self._idle.get(chat_id)
+        if idle is not None:
+            await idle.wait()
+
+        pending = self._pending.get(chat_id)
+        if pending is None or not pending.lines:
+            return
+
+        budget = self._budgets[chat_id] if self._budgets is not None else None
+        if budget is not None and not ignore_budget:
+            wait = budget.delay()
+            if wait > 0:
+                # Over budget: keep merging until a digest may go out
+                if pending.timer is None:
+                    self._schedule(chat_id, pending, wait)
+                return
+            budget.take()
+
+        lines = pending.lines
+        del self._pending[chat_id]
+        if pending.timer is not None and pending.timer is not asyncio.current_task():
+            pending.timer.cancel()
+
+        try:
+            await pending.bot.send_message(
+                chat_id, format_digest(list(lines.values())), rate_limit_args=ALERT
+            )
+            self.sent += 1
+        except RetryAfter as e:
+            if budget is not None:
+                budget.pause(retry_after_seconds(e))
+            self._requeue(chat_id, pending.bot, lines, retry_after_seconds(e))
+        except Exception as e:
+            print("⚠️ Alert digest failed:", e)
+
+    def _requeue(self, chat_id, bot, lines, delay):
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = self._pending[chat_id] = _PendingAlerts(bot)
+        # Newer lines of the same users win
+        pending.lines = {**lines, **pending.lines}
+        if pending.timer is None:
+            self._schedule(chat_id, pending, delay)
+
+    @asynccontextmanager
+    async def priority(self, chat_id):
+        """Hold the chat's digests back while the block runs."""
+        self._busy[chat_id] = self._busy.get(chat_id, 0) + 1
+        if chat_id not in self._idle:
+            self._idle[chat_id] = asyncio.Event()
+        try:
+            yield
+        finally:
+            self._busy[chat_id] -= 1
+            if not self._busy[chat_id]:
+                del self._busy[chat_id]
+                self._idle.pop(chat_id).set()
+
+    async def close(self):
+        """Send everything still pending (shutdown)."""
+        for chat_id in list(self._pending):
+            try:
+                await self.flush(chat_id, ignore_budget=True)
+            except Exception as e:
+                print("⚠️ Alert digest failed:", e)
+
+
+def format_digest(lines):
+    """`lines`: (mention, link count) per user."""
+    if len(lines) == 1:
+        return f"⚠️ Alert: {lines[0][0]} shared more than one link."
+
+    shown = lines[:ALERT_MAX_LINES]
+    text = "⚠️ Alert: shared more than one link:\n" + "\n".join(
+        f"• {mention} → {count} links" for mention, count in shown
+    )
+    if len(lines) > len(shown):
+        text += f"\n…and {len(lines) - len(shown)} more"
+    return text
+
+
+def prioritize_commands(application, digest):
+    """Run every command handler in `digest`'s priority lane for its chat."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandHandler):
+                handler.callback = _in_priority_lane(handler.callback, digest)
+
+
+def _in_priority_lane(callback, digest):
+    @functools.wraps(callback)
+    async def prioritized(update, context):
+        chat = update.effective_chat
+        if chat is None:
+            return await callback(update, context)
+        async with digest.priority(chat.id):
+            return await callback(update, context)
+
+    prioritized.__name__ = getattr(callback, "__name__", "handler")
+    return prioritized
+
+
+alert_digest = AlertDigest()
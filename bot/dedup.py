@@ -0,0 +1,140 @@
+# bot/dedup.py
+"""
+Drop Telegram webhook redeliveries by update_id.
+
+Hot path: a bounded ring of recently seen ids (deque + dict, O(1)).
+Cross-instance: the processed_updates table (db/migrations.py); the first instance
+to insert an id owns it. Telegram gives up on an update after 24h, so
+older rows are pruned.
+
+A claim is "in progress" until finish() marks it done. A redelivery is
+dropped while the claim is done or younger than DEDUP_CLAIM_TTL seconds;
+after that the first attempt is presumed dead (function timeout, recycled
+instance) and the redelivery takes the claim over.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+
+from db.database import execute, fetchrow
+
+DEDUP_RING_SIZE = int(os.getenv("DEDUP_RING_SIZE", "10000"))
+# Also check / record ids in Postgres (needed with more than one instance)
+DEDUP_DB = os.getenv("DEDUP_DB", "1") == "1"
+DEDUP_PRUNE_INTERVAL = float(os.getenv("DEDUP_PRUNE_INTERVAL", "3600"))
+# Seconds an unfinished claim blocks redeliveries
+DEDUP_CLAIM_TTL = float(os.getenv("DEDUP_CLAIM_TTL", "60"))
+
+CLAIM_SQL = """
+INSERT INTO processed_updates (update_id, done, claimed_until)
+VALUES ($1, false, NOW() + make_interval(secs => $2))
+ON CONFLICT (update_id) DO UPDATE
+SET claimed_until = EXCLUDED.claimed_until, seen_at = NOW()
+WHERE NOT processed_updates.done AND processed_updates.claimed_until < NOW()
+RETURNING update_id
+"""
+
+FINISH_SQL = "UPDATE processed_updates SET done = true, claimed_until = NULL WHERE update_id = $1"
+
+FORGET_SQL = "DELETE FROM processed_updates WHERE update_id = $1"
+
+PRUNE_SQL = "DELETE FROM processed_updates WHERE seen_at < NOW() - interval '1 day'"
+
+
+class UpdateDeduplicator:
+    def __init__(self, ring_size=DEDUP_RING_SIZE, use_db=DEDUP_DB, claim_ttl=DEDUP_CLAIM_TTL):
+        self.use_db = use_db
+        self.claim_ttl = claim_ttl
+        self._ring = deque(maxlen=max(1, ring_size))
+        self._seen = {}     # update_id -> claim expiry (monotonic), None once done
+        self._pruned_at = 0.0
+        self._prune_task = None
+        self.duplicates = 0
+
+    def _remember(self, update_id):
+        expires = time.monotonic() + self.claim_ttl
+        if update_id in self._seen:
+            # Taking over an expired claim
+            self._seen[update_id] = expires
+            return
+        if len(self._ring) == self._ring.maxlen:
+            self._seen.pop(self._ring[0], None)
+        self._ring.append(update_id)
+        self._seen[update_id] = expires
+
+    def _is_claimed(self, update_id):
+        if update_id not in self._seen:
+            return False
+        expires = self._seen[update_id]
+        return expires is None or time.monotonic() < expires
+
+    async def claim(self, update_id) -> bool:
+        """True if this update is new (or its earlier claim expired) and should be processed."""
+        if update_id is None:
+            return True
+        if self._is_claimed(update_id):
+            self.duplicates += 1
+            return False
+
+        # Remember first: a redelivery arriving while we ask the DB is dropped too
+        self._remember(update_id)
+
+        if not self.use_db:
+            return True
+
+        try:
+            row = await fetchrow(CLAIM_SQL, update_id, self.claim_ttl)
+        except Exception as e:
+            # Fail open: better a possible duplicate than a lost update
+            print("⚠️ Dedup check failed:", e)
+            return True
+
+        self._maybe_prune()
+
+        if row is None:
+            self.duplicates += 1
+            return False
+        return True
+
+    async def finish(self, update_id):
+        """Processing succeeded: drop every later redelivery."""
+        if update_id is None:
+            return
+        if update_id in self._seen:
+            self._seen[update_id] = None
+        if self.use_db:
+            try:
+                await execute(FINISH_SQL, update_id)
+            except Exception as e:
+                # The claim still expires; a redelivery after that runs again
+                print("⚠️ Dedup finish failed:", e)
+
+    async def forget(self, update_id):
+        """Processing failed: let Telegram's redelivery through."""
+        if update_id is None:
+            return
+        self._seen.pop(update_id, None)
+        if self.use_db:
+            try:
+                await execute(FORGET_SQL, update_id)
+            except Exception as e:
+                print("⚠️ Dedup forget failed:", e)
+
+    def _maybe_prune(self):
+        now = time.monotonic()
+        if now - self._pruned_at < DEDUP_PRUNE_INTERVAL:
+            return
+        if self._prune_task and not self._prune_task.done():
+            return
+        self._pruned_at = now
+        self._prune_task = asyncio.ensure_future(self._prune())
+
+    async def _prune(self):
+        try:
+            await execute(PRUNE_SQL)
+        except Exception as e:
+            print("⚠️ Dedup prune failed:", e)
+
+
+dedup = UpdateDeduplicator()
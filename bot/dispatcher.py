@@ -0,0 +1,180 @@
+# bot/dispatcher.py
+"""
+Update dispatcher: strictly ordered per chat, parallel across chats.
+
+Updates are hashed by chat id (user id when there is no chat) onto one of
+DISPATCH_SHARDS shards. Each shard is a bounded asyncio.Queue drained by a
+single worker, so two updates of the same chat can never run at the same
+time or out of order, while different shards run in parallel. A full shard
+makes put() wait, which pushes back on the webhook instead of buffering
+without limit.
+
+PTB's process_update hands handler exceptions to the error handlers
+instead of raising them; build_bot registers handler_failed, so an update
+whose handler raised still fails its future (and the webhook answers 500).
+"""
+import asyncio
+import contextvars
+import os
+import time
+from collections import deque
+
+from bot.tracing import current_trace, trace_update
+
+# Number of shards (= updates processed in parallel); WEBHOOK_WORKERS is the
+# older name of the same setting
+DISPATCH_SHARDS = int(os.getenv("DISPATCH_SHARDS", os.getenv("WEBHOOK_WORKERS", "8")))
+# Updates that may wait per shard before put() blocks
+DISPATCH_SHARD_SIZE = int(os.getenv("DISPATCH_SHARD_SIZE", "200"))
+# Seconds to wait for queued updates on shutdown
+DISPATCH_DRAIN_TIMEOUT = float(os.getenv("DISPATCH_DRAIN_TIMEOUT", os.getenv("WEBHOOK_DRAIN_TIMEOUT", "20")))
+
+# Handler errors of the update the current worker is processing
+_handler_errors = contextvars.ContextVar("handler_errors", default=None)
+
+
+async def handler_failed(update, context):
+    """Application error handler: remember the error for the dispatcher and
+    count the update as failed in its trace."""
+    errors = _handler_errors.get()
+    if errors is not None:
+        errors.append(context.error)
+    trace = current_trace()
+    if trace is not None:
+        trace.failed = True
+
+
+def update_key(update):
+    """Updates with the same key are processed in arrival order."""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+class Shard:
+    def __init__(self, index, max_size):
+        self.index = index
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.enqueued_at = deque()   # timestamps of the waiting updates, oldest first
+        self.pending = 0             # queued + running
+        self.task = None
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0     # enqueue → start of the latest update
+        self.max_lag = 0.0
+
+    def oldest_age(self):
+        """Seconds the oldest waiting update has been queued."""
+        if not self.enqueued_at:
+            return 0.0
+        return time.monotonic() - self.enqueued_at[0]
+
+    def stats(self):
+        return {
+            "shard": self.index,
+            "depth": self.queue.qsize(),
+            "oldest_age_ms": round(self.oldest_age() * 1000, 1),
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+
+class UpdateDispatcher:
+    def __init__(self, process, shards=DISPATCH_SHARDS, shard_size=DISPATCH_SHARD_SIZE):
+        self.process = process
+        self.shards = [Shard(i, shard_size) for i in range(max(1, shards))]
+
+    @property
+    def running(self):
+        return any(shard.task for shard in self.shards)
+
+    def start(self):
+        for shard in self.shards:
+            if shard.task is None:
+                shard.task = asyncio.ensure_future(self._worker(shard))
+
+    def shard_for(self, update) -> Shard:
+        return self.shard_for_key(update_key(update))
+
+    def shard_for_key(self, key) -> Shard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def settled(self, chat_id) -> bool:
+        """Nothing of `chat_id` (or its shard) is queued or running."""
+        return not self.shard_for_key(chat_id).pending
+
+    async def put(self, update) -> asyncio.Future:
+        """Queue `update`; the returned future resolves once it was processed."""
+        self.start()
+        done = asyncio.get_running_loop().create_future()
+        shard = self.shard_for(update)
+        shard.pending += 1
+        try:
+            await shard.queue.put((update, done))
+        except BaseException:
+            shard.pending -= 1
+            raise
+        shard.enqueued_at.append(time.monotonic())
+        return done
+
+    async def process_now(self, update):
+        """Queue `update` and wait for it (keeps the per-chat ordering)."""
+        await (await self.put(update))
+
+    def qsize(self):
+        return sum(shard.queue.qsize() for shard in self.shards)
+
+    def stats(self):
+        return {
+            "queued": self.qsize(),
+            "shards": [shard.stats() for shard in self.shards],
+        }
+
+    async def _worker(self, shard):
+        while True:
+            update, done = await shard.queue.get()
+            shard.last_lag = time.monotonic() - shard.enqueued_at.popleft()
+            shard.max_lag = max(shard.max_lag, shard.last_lag)
+            errors = []
+            token = _handler_errors.set(errors)
+            try:
+                with trace_update(update.update_id, shard.last_lag):
+                    await self.process(update)
+                if errors:
+                    raise errors[0]
+                shard.processed += 1
+                if not done.done():
+                    done.set_result(None)
+            except Exception as e:
+                shard.failed += 1
+                print("❌ Update processing failed:", e)
+                if not done.done():
+                    done.set_exception(e)
+                    # Nobody may be waiting (fast-ack mode)
+                    done.exception()
+            finally:
+                _handler_errors.reset(token)
+                shard.pending -= 1
+                shard.queue.task_done()
+
+    async def drain(self, timeout=DISPATCH_DRAIN_TIMEOUT):
+        """Finish what is queued (up to `timeout` seconds), then stop the workers."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(shard.queue.join() for shard in self.shards)), timeout
+            )
+        except asyncio.TimeoutError:
+            print(f"⚠️ Shutdown with {self.qsize()} updates still queued")
+
+        for shard in self.shards:
+            if shard.task is not None:
+                shard.task.cancel()
+        await asyncio.gather(*(s.task for s in self.shards if s.task), return_exceptions=True)
+        for shard in self.shards:
+            shard.task = None
@@ -0,0 +1,40 @@
+# bot/identity.py
+import os
+
+from telegram import User
+from telegram.ext import ExtBot
+
+# Set BOT_USERNAME (and optionally BOT_FIRST_NAME) to skip the getMe call in
+# Application.initialize() on every cold start. The bot id is the token prefix.
+# Note: with a cached identity the token is no longer verified at startup.
+BOT_USERNAME = os.getenv("BOT_USERNAME")
+BOT_FIRST_NAME = os.getenv("BOT_FIRST_NAME")
+
+
+def cached_identity(token):
+    if not BOT_USERNAME:
+        return None
+
+    bot_id = token.split(":", 1)[0]
+    if not bot_id.isdigit():
+        return None
+
+    username = BOT_USERNAME.lstrip("@")
+    return User(id=int(bot_id), first_name=BOT_FIRST_NAME or username, is_bot=True, username=username)
+
+
+class CachedIdentityBot(ExtBot):
+    """ExtBot whose first get_me() (the one initialize() makes) can be answered locally."""
+
+    __slots__ = ("_cached_identity",)
+
+    def __init__(self, token, *args, identity=None, **kwargs):
+        super().__init__(token, *args, **kwargs)
+        self._cached_identity = identity
+
+    async def get_me(self, *args, **kwargs):
+        if self._cached_identity is not None and self._bot_user is None:
+            self._cached_identity.set_bot(self)
+            self._bot_user = self._cached_identity
+            return self._bot_user
+        return await super().get_me(*args, **kwargs)
@@ -0,0 +1,193 @@
+# bot/moderation.py
+"""
+Bulk moderation: run one Telegram action (mute / unmute / kick / ban) for
+many users with bounded concurrency and with progress stored in moderation_jobs (db/migrations.py) so an interrupted run (e.g. a
+serverless timeout) picks up where it stopped on the next call.
+
+Only a job of the same chat session, started less than
+MODERATION_RESUME_WINDOW seconds ago and whose until_date is still ahead,
+is resumed; any other unfinished job is closed and a new one started.
+
+Pacing and RetryAfter handling are the outbound scheduler's
+(bot/outbound.py); a RetryAfter that still gets here means it gave up.
+"""
+import asyncio
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from telegram import ChatPermissions
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from db.database import execute, fetchrow
+
+MODERATION_CONCURRENCY = int(os.getenv("MODERATION_CONCURRENCY", "8"))
+# Retries after network errors (RetryAfter is retried by bot/outbound.py)
+MODERATION_MAX_RETRIES = int(os.getenv("MODERATION_MAX_RETRIES", "5"))
+# Store progress after this many finished users
+MODERATION_CHECKPOINT = int(os.getenv("MODERATION_CHECKPOINT", "25"))
+# Seconds after which an unfinished job is abandoned instead of resumed
+MODERATION_RESUME_WINDOW = float(os.getenv("MODERATION_RESUME_WINDOW", "900"))
+
+# Telegram treats an until_date less than 30s away as "forever"
+MIN_UNTIL_AHEAD = timedelta(seconds=30)
+
+
+async def _mute(bot, chat_id, user_id, until_date):
+    await bot.restrict_chat_member(
+        chat_id=chat_id,
+        user_id=user_id,
+        permissions=ChatPermissions(can_send_messages=False),
+        until_date=until_date
+    )
+
+async def _unmute(bot, chat_id, user_id, until_date):
+    await bot.restrict_chat_member(
+        chat_id=chat_id,
+        user_id=user_id,
+        permissions=ChatPermissions(can_send_messages=True)
+    )
+
+async def _ban(bot, chat_id, user_id, until_date):
+    await bot.ban_chat_member(chat_id, user_id, until_date=until_date)
+
+
+ACTIONS = {
+    "mute": _mute,
+    "unmute": _unmute,
+    "kick": _ban,   # /kick has always removed users with a ban
+    "ban": _ban,
+}
+
+
+class BulkResult:
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.done = []
+        self.failed = []
+        self.resumed = False
+
+    @property
+    def total(self):
+        return len(self.done) + len(self.failed)
+
+
+OPEN_JOB_SQL = """
+SELECT id, session_id, until_date, user_ids, done, failed,
+       created_at > NOW() - make_interval(secs => $3) AS recent
+FROM moderation_jobs
+WHERE chat_id = $1 AND action = $2 AND finished_at IS NULL
+ORDER BY id DESC
+LIMIT 1
+"""
+
+NEW_JOB_SQL = """
+INSERT INTO moderation_jobs (chat_id, action, until_date, user_ids, session_id)
+VALUES ($1, $2, $3, $4, $5)
+RETURNING id
+"""
+
+EXTEND_JOB_SQL = "UPDATE moderation_jobs SET user_ids = $2 WHERE id = $1"
+
+CHECKPOINT_SQL = """
+UPDATE moderation_jobs
+SET done = done || $2::bigint[],
+    failed = failed || $3::bigint[]
+WHERE id = $1
+"""
+
+FINISH_JOB_SQL = "UPDATE moderation_jobs SET finished_at = NOW() WHERE id = $1"
+
+async def _call_with_retry(action, bot, chat_id, user_id, until_date):
+    """True if the action went through, False if Telegram refused it for good."""
+    for attempt in range(MODERATION_MAX_RETRIES + 1):
+        try:
+            await action(bot, chat_id, user_id, until_date)
+            return True
+        except RetryAfter as e:
+            # The scheduler already waited out its retries
+            print(f"Moderation failed for {user_id}:", e)
+            return False
+        except (BadRequest, Forbidden) as e:
+            # Not in chat, is an admin, no rights... retrying won't help
+            print(f"Moderation failed for {user_id}:", e)
+            return False
+        except NetworkError as e:
+            if attempt == MODERATION_MAX_RETRIES:
+                print(f"Moderation failed for {user_id}:", e)
+                return False
+            await asyncio.sleep(min(30, 2 ** attempt) + random.random())
+    return False
+
+
+def _resumable(job, session_id):
+    if session_id is None or job["session_id"] != session_id or not job["recent"]:
+        return False
+    until_date = job["until_date"]
+    return until_date is None or until_date - datetime.now(timezone.utc) > MIN_UNTIL_AHEAD
+
+
+async def run_bulk_action(
+    bot, chat_id, action, user_ids, until_date=None, session_id=None, persist=True
+) -> BulkResult:
+    """Apply `action` (see ACTIONS) to `user_ids` in `chat_id`.
+
+    With persist=True progress is checkpointed, and a recent unfinished job
+    of the same chat/action/`session_id` is resumed: users it already did
+    are skipped, the ones it failed are tried again."""
+    handler = ACTIONS[action]
+    user_ids = list(dict.fromkeys(user_ids))
+
+    job_id = None
+    result = BulkResult()
+    handled = set()
+
+    if persist:
+        job = await fetchrow(OPEN_JOB_SQL, chat_id, action, MODERATION_RESUME_WINDOW)
+        if job and not _resumable(job, session_id):
+            # Other session, too old, or its mutes would now be permanent
+            await execute(FINISH_JOB_SQL, job["id"])
+            job = None
+        if job:
+            job_id = job["id"]
+            until_date = job["until_date"] or until_date
+            handled = set(job["done"])
+            result.resumed = True
+            merged = list(dict.fromkeys([*job["user_ids"], *user_ids]))
+            if len(merged) != len(job["user_ids"]):
+                await execute(EXTEND_JOB_SQL, job_id, merged)
+            user_ids = merged
+        else:
+            job_id = (await fetchrow(NEW_JOB_SQL, chat_id, action, until_date, user_ids, session_id))["id"]
+
+    result.job_id = job_id
+    todo = [uid for uid in user_ids if uid not in handled]
+
+    semaphore = asyncio.Semaphore(MODERATION_CONCURRENCY)
+    done_since_checkpoint = []
+    failed_since_checkpoint = []
+
+    async def checkpoint():
+        nonlocal done_since_checkpoint, failed_since_checkpoint
+        if not persist or not (done_since_checkpoint or failed_since_checkpoint):
+            return
+        done, failed = done_since_checkpoint, failed_since_checkpoint
+        done_since_checkpoint, failed_since_checkpoint = [], []
+        await execute(CHECKPOINT_SQL, job_id, done, failed)
+
+    async def run_one(user_id):
+        async with semaphore:
+            ok = await _call_with_retry(handler, bot, chat_id, user_id, until_date)
+
+        (result.done if ok else result.failed).append(user_id)
+        (done_since_checkpoint if ok else failed_since_checkpoint).append(user_id)
+        if len(done_since_checkpoint) + len(failed_since_checkpoint) >= MODERATION_CHECKPOINT:
+            await checkpoint()
+
+    await asyncio.gather(*(run_one(uid) for uid in todo))
+    await checkpoint()
+
+    if persist:
+        await execute(FINISH_JOB_SQL, job_id)
+
+    return result
@@ -0,0 +1,201 @@
+# bot/moderation_commands.py
+# Mute / unmute / kick / lock commands. Rarely used, so build_bot registers
+# them lazily and this module (and bot/moderation.py) is only imported the
+# first time one of them runs.
+from telegram import Update, ChatPermissions
+from telegram.ext import ContextTypes
+from datetime import timedelta
+
+from bot.admin_cache import is_admin
+from bot.moderation import run_bulk_action
+from bot.state import close_session, get_state
+
+
+async def mute_all_unsafe_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update):
+        STICKER_ID = "CAACAgUAAxkBAAICLWfAVQEf_k6dGDuoUbGDUrcng0BlAAJWBQACDLDZVke9Qr6WRu8KNgQ"
+        await update.message.reply_sticker(STICKER_ID)
+        return
+
+    chat = update.effective_chat
+    bot_member = await chat.get_member(context.bot.id)
+
+    if not bot_member.can_restrict_members:
+        await update.message.reply_text("Bot needs Manage Members permission.")
+        return
+
+    # End of session: unsafe users are settled and listed by one statement
+    unsafe_ids, _ = await close_session(chat.id)
+    session_id = (await get_state(chat.id)).session_id
+
+    if not unsafe_ids:
+        await update.message.reply_text("No unsafe users to mute.")
+        return
+
+    # 🔒 DEFAULT MUTE DURATION → 5 DAYS
+    mute_duration = timedelta(days=5)
+    until_date = update.message.date + mute_duration
+
+    # Concurrent + rate limited, resumes an interrupted /muteall (bot/moderation.py)
+    result = await run_bulk_action(
+        context.bot, chat.id, "mute", unsafe_ids, until_date=until_date, session_id=session_id
+    )
+    muted = len(result.done)
+    failed = len(result.failed)
+
+    await update.message.reply_text(
+        f"Muted {muted} unsafe users"
+        + (" (resumed previous run)" if result.resumed else "")
+        + (f"\nFailed: {failed}" if failed else "")
+    )
+
+    await lock_chat(update, context)
+
+
+
+async def mute_user(update, context):
+    if not await is_admin(update):
+        await update.message.reply_text("🚫 Admin only")
+        return
+
+    if not update.message.reply_to_message:
+        await update.message.reply_text("❌ Reply to a user to mute them")
+        return
+
+    user_id = update.message.reply_to_message.from_user.id
+
+    # Mute for 5 days
+    result = await run_bulk_action(
+        context.bot,
+        update.effective_chat.id,
+        "mute",
+        [user_id],
+        until_date=update.message.date + timedelta(days=5),
+        persist=False
+    )
+
+    if result.failed:
+        await update.message.reply_text("❌ Failed to mute user")
+        return
+
+    await update.message.reply_text("✅ User muted for 5 days")
+
+
+
+async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update):
+        await update.message.reply_text("🚫 Admin only")
+        return
+
+    if not update.message.reply_to_message:
+        await update.message.reply_text("❌ Reply to a user to unmute")
+        return
+
+    user_id = update.message.reply_to_message.from_user.id
+
+    result = await run_bulk_action(
+        context.bot, update.effective_chat.id, "unmute", [user_id], persist=False
+    )
+
+    if result.failed:
+        await update.message.reply_text("❌ Failed to unmute user")
+        return
+
+    await update.message.reply_text("✅ User unmuted")
+
+async def get_user_id(context: ContextTypes.DEFAULT_TYPE, username: str):
+    """Convert username (@username) to user ID even if they haven't sent a message."""
+    try:
+        user = await context.bot.get_chat(username)  # ✅ Resolves username to user ID
+        return user.id
+    except Exception:
+        return None
+
+
+async def kick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Kick a user from the group (Admins only)."""
+
+    chat = update.effective_chat
+
+    # # ✅ Ensure the bot has permission to kick
+    # if not await bot_has_permissions(update, context):
+    #     await update.message.reply_text("I need 'Ban Members' permission to kick users.")
+    #     return
+
+    if not await is_admin(update):
+            STICKER_ID = "7688271168:AAFpBE6eZc8-vI1qRSmdK7ayOMVXEoVoLcI"
+
+            await update.message.reply_sticker(STICKER_ID)  # Send sticker
+            return  # Stop execution if user is not an admin
+
+    target_user_id = None
+    target_username = None
+
+    try:
+        # ✅ Kick by replying to a user
+        if update.message.reply_to_message:
+            target_user_id = update.message.reply_to_message.from_user.id
+            target_username = f"@{update.message.reply_to_message.from_user.username}" if update.message.reply_to_message.from_user.username else "Unknown User"
+        else:
+            # ✅ Kick by @username
+            if not context.args:
+                await update.message.reply_text("Usage: /kick @username or reply to a user.")
+                return
+
+            target_username = context.args[0].replace("@", "")
+
+            # ✅ Convert username to user ID
+            target_user_id = await get_user_id(context, f"@{target_username}")
+
+            if not target_user_id:
+                await update.message.reply_text(f"User @{target_username} not found in Telegram.")
+                return
+
+        # ✅ Check if user is in the group
+        try:
+            user_status = await context.bot.get_chat_member(chat.id, target_user_id)
+        except Exception:
+            await update.message.reply_text(f"User @{target_username} is not in this group.")
+            return
+
+        # ✅ Prevent kicking admins
+        if user_status.status in ["administrator", "creator"]:
+            await update.message.reply_text(f"Cannot kick an admin: @{target_username}")
+            return
+
+
+
+        # ✅ Kick the user
+        result = await run_bulk_action(context.bot, chat.id, "kick", [target_user_id], persist=False)
+        if result.failed:
+            await update.message.reply_text(f"Failed to kick user: @{target_username}")
+            return
+
+        # ✅ Notify the chat
+        await update.message.reply_text(
+            f"User Kicked: @{target_username}\n"
+            f"Action: Removed from group"
+        )
+
+    except Exception as e:
+        await update.message.reply_text(f"Failed to kick user: {e}")
+
+
+async def lock_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update):
+        await update.message.reply_text("🚫 Admin only command")
+        return
+
+    try:
+        await context.bot.set_chat_permissions(
+            chat_id=update.effective_chat.id,
+            permissions=ChatPermissions(
+                can_send_messages=False
+            )
+        )
+
+        await update.message.reply_text("🔒 Chat locked successfully")
+
+    except Exception as e:
+        print("Failed to lock chat:", e)
+        await update.message.reply_text("❌ Failed to lock chat")
@@ -0,0 +1,213 @@
+# bot/outbound.py
+"""
+Outbound scheduler for every Bot API call the application makes.
+
+OutboundScheduler is the ExtBot rate limiter (build_bot passes it as
+`rate_limiter=`), so reply_text, restrict_chat_member, pin_chat_message...
+all go through it without changes in the handlers:
+
+- one global token bucket (OUTBOUND_GLOBAL_RATE requests/s, Telegram's
+  ~30/s ceiling) and a sliding window per group chat (at most
+  OUTBOUND_CHAT_LIMIT messages in any OUTBOUND_CHAT_PERIOD, Telegram's
+  20/min per group);
+- when tokens are short, waiting requests go out by priority class:
+  MODERATION (restrict / ban / permissions) > ADMIN (command replies,
+  pins, titles; the default) > ALERT (pass `rate_limit_args=ALERT`);
+- a RetryAfter pauses the bucket it hit (the chat's, or the global one)
+  and the request is queued again, up to OUTBOUND_MAX_RETRIES times.
+
+Handlers run inside the chat's dispatcher shard, so a request never waits
+long for a token: ALERT requests are refused at once when their chat is
+over its limit, any other request after OUTBOUND_MAX_WAIT seconds. Both
+raise RetryAfter, as Telegram would: alert digests merge into a later
+digest, the "𝕏 ID" replies are dropped, and a command fails its update
+(500, Telegram delivers it again later).
+
+Moderation calls and reads (get*) only count against the global bucket:
+the per-chat limit is about messages.
+
+TELEGRAM_POOL_SIZE / TELEGRAM_POOL_TIMEOUT size the HTTPX connection pool
+(see telegram_request_kwargs).
+"""
+import asyncio
+import bisect
+import itertools
+import math
+import os
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from bot.ratelimit import TokenBucket, WindowMap, retry_after_seconds
+
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_LIMIT = int(os.getenv("OUTBOUND_CHAT_LIMIT", "20"))
+OUTBOUND_CHAT_PERIOD = float(os.getenv("OUTBOUND_CHAT_PERIOD", "60"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+# Seconds a request may wait for a token before it is refused
+OUTBOUND_MAX_WAIT = float(os.getenv("OUTBOUND_MAX_WAIT", "5"))
+
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "5"))
+
+# Priority classes, lower goes first
+MODERATION = 0
+ADMIN = 1
+ALERT = 2
+
+MODERATION_ENDPOINTS = {
+    "restrictChatMember",
+    "banChatMember",
+    "unbanChatMember",
+    "setChatPermissions",
+    "deleteMessage",
+    "deleteMessages",
+}
+
+
+def telegram_request_kwargs():
+    """HTTPXRequest arguments for the bot's connection pool."""
+    return {"connection_pool_size": TELEGRAM_POOL_SIZE, "pool_timeout": TELEGRAM_POOL_TIMEOUT}
+
+
+def priority_of(endpoint, rate_limit_args):
+    if isinstance(rate_limit_args, int):
+        return rate_limit_args
+    if endpoint in MODERATION_ENDPOINTS:
+        return MODERATION
+    return ADMIN
+
+
+def _is_group(chat_id):
+    # Private chats have positive ids; "@channel" usernames count as groups
+    if isinstance(chat_id, int):
+        return chat_id < 0
+    return chat_id is not None
+
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(
+        self,
+        global_rate=OUTBOUND_GLOBAL_RATE,
+        chat_limit=OUTBOUND_CHAT_LIMIT,
+        chat_period=OUTBOUND_CHAT_PERIOD,
+        max_retries=OUTBOUND_MAX_RETRIES,
+        max_wait=OUTBOUND_MAX_WAIT,
+    ):
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._global = TokenBucket(global_rate)
+        self._chats = WindowMap(chat_limit, chat_period)
+        self._waiters = []        # sorted (priority, seq, buckets, future)
+        self._seq = itertools.count()
+        self._wake = None
+        self._pump_task = None
+        self.retries = 0
+        self.refused = 0
+
+    # No __len__: ExtBot skips a rate limiter that is falsy
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+        for *_, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = priority_of(endpoint, rate_limit_args)
+        chat_id = data.get("chat_id")
+        if priority != MODERATION and not endpoint.startswith("get") and _is_group(chat_id):
+            chat_bucket = self._chats[chat_id]
+            buckets = (self._global, chat_bucket)
+        else:
+            chat_bucket = None
+            buckets = (self._global,)
+
+        for attempt in range(self.max_retries + 1):
+            if priority == ALERT and chat_bucket is not None and chat_bucket.delay() > 0:
+                # Over the chat's limit: the caller merges or drops it
+                self._refuse(chat_bucket.delay())
+            await self._acquire(priority, buckets)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                # Everyone behind the same limit waits, not just this request
+                (chat_bucket or self._global).pause(retry_after_seconds(e))
+                self.retries += 1
+            finally:
+                for bucket in buckets:
+                    bucket.done()
+
+    def _refuse(self, wait):
+        self.refused += 1
+        raise RetryAfter(max(1, math.ceil(wait)))
+
+    async def _acquire(self, priority, buckets):
+        # Nobody queued: no need to involve the pump
+        if not self._waiters and all(bucket.delay() <= 0 for bucket in buckets):
+            for bucket in buckets:
+                bucket.take()
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiters, (priority, next(self._seq), buckets, future), key=lambda w: w[:2])
+        if self._pump_task is None or self._pump_task.done():
+            self._wake = asyncio.Event()
+            self._pump_task = asyncio.ensure_future(self._pump())
+        else:
+            self._wake.set()
+
+        try:
+            await asyncio.wait((future,), timeout=self.max_wait)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Granted, but the caller is gone: nothing will be sent
+                for bucket in buckets:
+                    bucket.done()
+            self._drop(future)
+            raise
+        if not future.done():
+            self._drop(future)
+            self._refuse(max(bucket.delay() for bucket in buckets))
+
+    def _drop(self, future):
+        future.cancel()
+        self._waiters[:] = [w for w in self._waiters if w[3] is not future]
+
+    async def _pump(self):
+        """Hand out tokens to the queued requests, highest priority first."""
+        while self._waiters:
+            wait = None
+            for i, (_, _, buckets, future) in enumerate(self._waiters):
+                if future.done():
+                    # Caller was cancelled
+                    del self._waiters[i]
+                    wait = 0.0
+                    break
+                delay = max(bucket.delay() for bucket in buckets)
+                if delay <= 0:
+                    for bucket in buckets:
+                        bucket.take()
+                    del self._waiters[i]
+                    future.set_result(None)
+                    wait = 0.0
+                    break
+                # A request of another chat further down may still go now
+                wait = delay if wait is None else min(wait, delay)
+
+            if wait:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
@@ -0,0 +1,215 @@
+# bot/prefilter.py
+"""
+Drop updates no handler can act on, before Update.de_json.
+
+build_prefilter(application) turns every registered handler into a check
+on the raw update dict, once:
+
+- CommandHandler: a bot_command entity at offset 0 naming one of its
+  commands, plus its filters;
+- ChatMemberHandler: the chat_member / my_chat_member key it listens to;
+- MessageHandler: its filters (Entity, TEXT, PHOTO, VIDEO, Document.ALL,
+  UpdateType.*, other media, combined with & | ~).
+
+Callbacks may declare more with @requires(message=True, tracking=True):
+the update must be a new message (not an edit / channel post), and the
+chat must not be known to have tracking off. "Known" means the chat's
+cached session is fresh (bot/state.py cached_tracking) and the dispatcher
+has nothing of that chat queued or running, e.g. a /tracking.
+
+Handlers or filters it cannot translate count as "may match", so the
+prefilter only drops what the handlers would ignore anyway.
+"""
+from telegram.ext import ChatMemberHandler, CommandHandler, MessageHandler, filters
+
+from bot.state import cached_tracking
+
+# Update keys behind Update.effective_message (callback_query is nested)
+MESSAGE_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post")
+
+UPDATE_TYPES = {
+    filters.UpdateType.MESSAGE: ("message",),
+    filters.UpdateType.EDITED_MESSAGE: ("edited_message",),
+    filters.UpdateType.MESSAGES: ("message", "edited_message"),
+    filters.UpdateType.CHANNEL_POST: ("channel_post",),
+    filters.UpdateType.EDITED_CHANNEL_POST: ("edited_channel_post",),
+    filters.UpdateType.CHANNEL_POSTS: ("channel_post", "edited_channel_post"),
+    filters.UpdateType.EDITED: ("edited_message", "edited_channel_post"),
+}
+
+# Filters that only check for one message field
+MESSAGE_FIELDS = {
+    filters.PHOTO: "photo",
+    filters.VIDEO: "video",
+    filters.AUDIO: "audio",
+    filters.VOICE: "voice",
+    filters.VIDEO_NOTE: "video_note",
+    filters.ANIMATION: "animation",
+    filters.CONTACT: "contact",
+    filters.LOCATION: "location",
+    filters.Document.ALL: "document",
+    filters.Sticker.ALL: "sticker",
+}
+
+
+def requires(message=False, tracking=False):
+    """Declare what a callback needs for the prefilter (see module docstring)."""
+    def mark(callback):
+        callback.prefilter_requires = {"message": message, "tracking": tracking}
+        return callback
+    return mark
+
+
+def effective_message(data):
+    for key in MESSAGE_KEYS:
+        message = data.get(key)
+        if message is not None:
+            return message
+    callback_query = data.get("callback_query")
+    return callback_query.get("message") if callback_query else None
+
+
+# Checks return True / False, or None when they cannot tell
+
+def _filter_check(f):
+    if f is filters.ALL:
+        return lambda data: effective_message(data) is not None
+
+    if f in UPDATE_TYPES:
+        keys = UPDATE_TYPES[f]
+        return lambda data: any(key in data for key in keys)
+
+    if f in MESSAGE_FIELDS:
+        field = MESSAGE_FIELDS[f]
+        return _on_message(lambda message: bool(message.get(field)))
+
+    if isinstance(f, filters.Entity):
+        entity_type = f.entity_type
+        return _on_message(
+            lambda message: any(e.get("type") == entity_type for e in message.get("entities", ()))
+        )
+
+    if isinstance(f, filters.Text):
+        strings = f.strings
+        if strings is None:
+            return _on_message(lambda message: bool(message.get("text")))
+        return _on_message(lambda message: message.get("text") in strings)
+
+    if isinstance(f, filters._MergedFilter):
+        base = _filter_check(f.base_filter)
+        if f.and_filter is not None:
+            return _and(base, _filter_check(f.and_filter))
+        return _or(base, _filter_check(f.or_filter))
+
+    if isinstance(f, filters._InvertedFilter):
+        inner = _filter_check(f.inv_filter)
+        return lambda data: _not(inner(data))
+
+    return lambda data: None
+
+
+def _on_message(check):
+    def on_message(data):
+        message = effective_message(data)
+        return message is not None and check(message)
+    return on_message
+
+
+def _and(a, b):
+    def both(data):
+        first = a(data)
+        if first is False:
+            return False
+        second = b(data)
+        if second is False:
+            return False
+        return True if first and second else None
+    return both
+
+
+def _or(a, b):
+    def either(data):
+        first = a(data)
+        if first:
+            return True
+        second = b(data)
+        if second:
+            return True
+        return False if first is False and second is False else None
+    return either
+
+
+def _not(value):
+    return None if value is None else not value
+
+
+def _command_check(handler):
+    commands = handler.commands
+    allowed = _filter_check(handler.filters)
+
+    def command(data):
+        message = effective_message(data)
+        if message is None:
+            return False
+        entities = message.get("entities")
+        text = message.get("text")
+        if not entities or not text:
+            return False
+        first = entities[0]
+        if first.get("type") != "bot_command" or first.get("offset") != 0:
+            return False
+        name = text[1:first.get("length", 0)].split("@", 1)[0].lower()
+        if name not in commands:
+            return False
+        return allowed(data)
+    return command
+
+
+def _chat_member_check(handler):
+    keys = {
+        ChatMemberHandler.MY_CHAT_MEMBER: ("my_chat_member",),
+        ChatMemberHandler.CHAT_MEMBER: ("chat_member",),
+    }.get(handler.chat_member_types, ("my_chat_member", "chat_member"))
+    return lambda data: any(key in data for key in keys)
+
+
+def _handler_check(handler):
+    if isinstance(handler, CommandHandler):
+        check = _command_check(handler)
+    elif isinstance(handler, ChatMemberHandler):
+        check = _chat_member_check(handler)
+    elif isinstance(handler, MessageHandler):
+        check = _filter_check(handler.filters)
+    else:
+        return lambda data, settled: None
+
+    needs = getattr(handler.callback, "prefilter_requires", None) or {}
+    message_only = needs.get("message", False)
+    tracking = needs.get("tracking", False)
+
+    def handler_check(data, settled):
+        if message_only and "message" not in data:
+            return False
+        result = check(data)
+        if result is False or not tracking:
+            return result
+        chat_id = data["message"]["chat"]["id"] if "message" in data else None
+        if chat_id is not None and settled(chat_id) and cached_tracking(chat_id) is False:
+            return False
+        return result
+    return handler_check
+
+
+def build_prefilter(application, settled=lambda chat_id: True):
+    """keep(data) -> False when no handler of `application` can act on `data`.
+
+    `settled(chat_id)`: nothing of that chat is waiting to be processed."""
+    checks = [
+        _handler_check(handler)
+        for handlers in application.handlers.values()
+        for handler in handlers
+    ]
+
+    def keep(data):
+        return any(check(data, settled) is not False for check in checks)
+    return keep
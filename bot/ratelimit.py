@@ -0,0 +1,131 @@
+# bot/ratelimit.py
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+
+class TokenBucket:
+    """`rate` tokens per second, up to `burst` saved up."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until a token is available (0 = now)."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def done(self):
+        """The request a token was taken for finished (nothing to do here)."""
+
+    async def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.take()
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold everyone back, e.g. after a RetryAfter from Telegram."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class SlidingWindow:
+    """At most `limit` requests in any `period` seconds (a token bucket with
+    a full burst allows up to twice that within one period).
+
+    A request counts from take() until done(), then from the time done()
+    was called: the server may have seen it as late as that, so stamping
+    the time the token was handed out could let `limit` + 1 through."""
+
+    def __init__(self, limit, period):
+        self.limit = max(1, int(limit))
+        self.period = float(period)
+        self.taken = deque()     # done() times, oldest first
+        self.in_flight = 0
+        self.blocked_until = 0.0
+
+    def _expire(self, now):
+        while self.taken and now - self.taken[0] >= self.period:
+            self.taken.popleft()
+
+    def delay(self):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._expire(now)
+        if len(self.taken) + self.in_flight < self.limit:
+            return 0.0
+        if not self.taken:
+            # Only requests still in flight; none expires before it is done
+            return self.period
+        return self.taken[0] + self.period - now
+
+    def take(self):
+        self.in_flight += 1
+
+    def done(self):
+        self.in_flight -= 1
+        self.taken.append(time.monotonic())
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class BucketMap:
+    """One TokenBucket per key (chat), least recently used dropped past max_size."""
+
+    def __init__(self, rate, burst=None, max_size=1024):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def __getitem__(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = self._new()
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _new(self):
+        return TokenBucket(self.rate, self.burst)
+
+
+class WindowMap(BucketMap):
+    """One SlidingWindow per key."""
+
+    def __init__(self, limit, period, max_size=1024):
+        super().__init__(None, max_size=max_size)
+        self.limit = limit
+        self.period = period
+
+    def _new(self):
+        return SlidingWindow(self.limit, self.period)
+
+
+def retry_after_seconds(exc) -> float:
+    """RetryAfter.retry_after is an int in PTB 20.x, a timedelta in later versions."""
+    value = exc.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
@@ -0,0 +1,95 @@
+# bot/reports.py
+"""
+Long reports (/list, /mult, /unsafe, /count, /testlist) are produced as a
+stream of already formatted / escaped rows and packed into as few Telegram
+messages as fit. Telegram's limit is 4096 characters, counted in UTF-16
+code units; we measure the text exactly as sent (tags and escapes
+included), which is never less than what Telegram counts after parsing.
+"""
+import asyncio
+
+MESSAGE_LIMIT = 4096
+
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _hard_split(line, room):
+    """Cut a single over-long line into pieces of at most `room` UTF-16 units."""
+    piece, size = [], 0
+    for char in line:
+        width = 2 if ord(char) > 0xFFFF else 1
+        if size + width > room:
+            yield "".join(piece)
+            piece, size = [], 0
+        piece.append(char)
+        size += width
+    if piece:
+        yield "".join(piece)
+
+
+def _split_row(row, room):
+    """A row that does not fit in one message is split on line breaks."""
+    if utf16_len(row) <= room:
+        yield row
+        return
+
+    lines, size = [], 0
+    for line in row.split("\n"):
+        for part in _hard_split(line, room) if utf16_len(line) > room else (line,):
+            part_size = utf16_len(part) + (1 if lines else 0)
+            if lines and size + part_size > room:
+                yield "\n".join(lines)
+                lines, size = [], 0
+                part_size = utf16_len(part)
+            lines.append(part)
+            size += part_size
+    if lines:
+        yield "\n".join(lines)
+
+
+def pack_messages(rows, header="", limit=MESSAGE_LIMIT):
+    """Yield message texts: `header` + as many rows (newline separated) as fit."""
+    room = limit - (utf16_len(header) + 1 if header else 0)
+    parts, size = [], 0
+
+    for row in rows:
+        for piece in _split_row(row, room):
+            piece_size = utf16_len(piece) + (1 if parts else 0)
+            if parts and size + piece_size > room:
+                yield _join(header, parts)
+                parts, size = [], 0
+                piece_size = utf16_len(piece)
+            parts.append(piece)
+            size += piece_size
+
+    if parts:
+        yield _join(header, parts)
+
+
+def _join(header, parts):
+    body = "\n".join(parts)
+    return f"{header}\n{body}" if header else body
+
+
+async def send_report(send, rows, header="", **kwargs) -> int:
+    """Stream `rows` through `send(text, **kwargs)` (e.g. message.reply_text).
+
+    While one chunk's request is in flight the next chunk is being packed,
+    but a chunk is only sent after the previous one completed, so they
+    arrive in order. Returns the number of messages sent."""
+    sent = 0
+    pending = None
+
+    for text in pack_messages(rows, header):
+        if pending is not None:
+            await pending
+        pending = asyncio.ensure_future(send(text, **kwargs))
+        # Let the request go out before packing the next chunk
+        await asyncio.sleep(0)
+        sent += 1
+
+    if pending is not None:
+        await pending
+    return sent
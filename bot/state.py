@@ -0,0 +1,422 @@
+# bot/state.py
+"""
+Per-chat session state shared by every bot instance.
+
+The users / links / sessionsdata tables are the source of truth; users
+and links rows belong to the chat's current session_id (a new one per
+/open, old ones are archived, see db/retention.py). Each
+instance keeps a read-through ChatSession per chat_id, tagged with the
+sessionsdata.version it was loaded at. Every write bumps that version in
+the same statement; a write whose returned version is exactly ours + 1 was
+the only change, so the session (already updated in memory) stays valid.
+Anything else means another instance wrote too and the session is reloaded.
+
+Sessions live in an LRU registry bounded by SESSION_CACHE_SIZE and
+SESSION_IDLE_TTL, so memory follows the chats that are active right now.
+Each session has its own lock: handlers of one chat are serialized against
+each other and against reloads, handlers of different chats never wait on
+each other.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from db.database import fetch, fetchrow
+from db.link_buffer import link_buffer
+from db.retention import maybe_run_retention
+from bot.urls import canonical_url
+from bot.x_index import XUsernameIndex
+
+# How long a cached session is used without re-checking its version.
+# Report commands always check (fresh=True).
+STATE_MAX_STALENESS = float(os.getenv("STATE_MAX_STALENESS", "1.0"))
+# Upper bound of sessions kept in memory, and how long an untouched one stays
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "256"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+
+
+SAFE = "safe"
+UNSAFE = "unsafe"
+
+
+class Participant:
+    """One user of a chat session. status is SAFE, UNSAFE or None (no link yet);
+    links is a dict used as an insertion-ordered set of URLs."""
+
+    __slots__ = ("srno", "name", "username", "x_username", "link_count", "ad_count", "status", "links")
+
+    def __init__(self, srno, name, username, x_username=None, link_count=0, ad_count=0, status=None, links=()):
+        self.srno = srno
+        self.name = name
+        self.username = username
+        self.x_username = x_username
+        self.link_count = link_count
+        self.ad_count = ad_count
+        self.status = status
+        self.links = dict.fromkeys(links)
+
+    @property
+    def display_name(self):
+        return f"@{self.username}" if self.username else (self.name or "Unknown")
+
+    def add_link(self, url):
+        self.links[url] = None
+
+
+class ChatSession:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.lock = asyncio.Lock()
+        self.version = None          # None = not loaded / stale
+        self.tracking_enabled = False
+        self.ad_words = None         # frozenset, None = bot default
+        self.session_id = None       # sessionsdata.session_id the rows belong to
+        self.participants = {}       # tg user id -> Participant, in srno order
+        self.x_index = XUsernameIndex()   # kept in step with participants' x_username
+        self.checked_at = 0.0
+        self.last_used = time.monotonic()
+
+    def clear(self):
+        # In place: handlers may hold a reference to the dict
+        self.participants.clear()
+        self.x_index.clear()
+
+    def add_participant(self, user_id, name, username) -> Participant:
+        participant = self.participants.get(user_id)
+        if participant is None:
+            participant = Participant(len(self.participants) + 1, name, username)
+            self.participants[user_id] = participant
+        return participant
+
+    def with_status(self, status):
+        """(user_id, Participant) pairs with `status`, in srno order."""
+        return [(user_id, p) for user_id, p in self.participants.items() if p.status == status]
+
+
+class SessionRegistry:
+    """chat_id → ChatSession, least recently used first."""
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE, idle_ttl=SESSION_IDLE_TTL):
+        self.max_size = max(1, max_size)
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, chat_id):
+        return self._sessions.get(chat_id)
+
+    def get_or_create(self, chat_id) -> ChatSession:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            session = ChatSession(chat_id)
+            self._sessions[chat_id] = session
+        else:
+            self._sessions.move_to_end(chat_id)
+
+        session.last_used = time.monotonic()
+        self._evict()
+        return session
+
+    def _evict(self):
+        # Dropping a session only costs a reload: the DB has everything and
+        # pending link writes are flushed before any reload.
+        now = time.monotonic()
+        for chat_id, session in list(self._sessions.items()):
+            over_size = len(self._sessions) > self.max_size
+            idle = now - session.last_used > self.idle_ttl
+            if not over_size and not idle:
+                break
+            if not session.lock.locked():
+                del self._sessions[chat_id]
+
+
+sessions = SessionRegistry()
+
+
+VERSION_SQL = """
+SELECT version, tracking_enabled, ad_words, session_id, start_time
+FROM sessionsdata
+WHERE chat_id=$1
+"""
+
+LOAD_USERS_SQL = """
+SELECT
+    u.tg_user_id,
+    u.username,
+    u.full_name,
+    u.x_username,
+    u.link_count,
+    u.ad_count,
+    u.status,
+    COALESCE(array_agg(l.url ORDER BY l.id) FILTER (WHERE l.url IS NOT NULL), '{}') AS links
+FROM users u
+LEFT JOIN links l
+    ON l.session_id = u.session_id
+    AND l.user_id = u.id
+    -- partition key: only the partitions since the session started are read
+    AND l.created_at >= COALESCE($2, '-infinity'::timestamptz)
+WHERE u.session_id = $1
+GROUP BY u.id
+ORDER BY u.id
+"""
+
+SET_TRACKING_SQL = """
+INSERT INTO sessionsdata (chat_id, tracking_enabled, version)
+VALUES ($1, $2, 1)
+ON CONFLICT (chat_id)
+DO UPDATE SET
+    tracking_enabled = EXCLUDED.tracking_enabled,
+    version = sessionsdata.version + 1
+RETURNING version
+"""
+
+SET_AD_WORDS_SQL = """
+INSERT INTO sessionsdata (chat_id, tracking_enabled, version, ad_words)
+VALUES ($1, false, 1, $2)
+ON CONFLICT (chat_id)
+DO UPDATE SET
+    ad_words = EXCLUDED.ad_words,
+    version = sessionsdata.version + 1
+RETURNING version
+"""
+
+# /open: archive the current session (its rows stay until db/retention.py
+# rolls it up) and switch the chat to a new session id.
+RESET_SESSION_SQL = """
+WITH archived AS (
+    INSERT INTO session_archive (session_id, chat_id, started_at, ended_at)
+    SELECT session_id, chat_id, start_time, COALESCE(end_time, NOW())
+    FROM sessionsdata
+    WHERE chat_id = $1
+    ON CONFLICT (session_id) DO NOTHING
+)
+INSERT INTO sessionsdata (chat_id, tracking_enabled, version)
+VALUES ($1, false, 1)
+ON CONFLICT (chat_id)
+DO UPDATE SET
+    session_id = nextval('chat_session_id_seq'),
+    tracking_enabled = false,
+    start_time = NOW(),
+    end_time = NULL,
+    version = sessionsdata.version + 1
+RETURNING version, session_id, start_time
+"""
+
+# Set-based status changes: one statement for any number of users, the
+# version bump included. $1 chat_id, $2 user ids, $3 status,
+# $4 reset ad_count to 0, $5 added to ad_count otherwise.
+MARK_USERS_SQL = """
+WITH bumped AS (
+    INSERT INTO sessionsdata (chat_id, tracking_enabled, version)
+    VALUES ($1, false, 1)
+    ON CONFLICT (chat_id)
+    DO UPDATE SET version = sessionsdata.version + 1
+    RETURNING session_id, version
+),
+changed AS (
+    UPDATE users
+    SET status = $3,
+        ad_count = CASE WHEN $4 THEN 0 ELSE users.ad_count + $5 END
+    FROM bumped
+    WHERE users.session_id = bumped.session_id AND users.tg_user_id = ANY($2::bigint[])
+    RETURNING users.tg_user_id
+)
+SELECT
+    (SELECT version FROM bumped) AS version,
+    ARRAY(SELECT tg_user_id FROM changed) AS user_ids
+"""
+
+# End of a session: tracking off, everyone who is not safe by now is
+# unsafe, and the unsafe ids + safe count come back in the same round trip.
+CLOSE_SESSION_SQL = """
+WITH bumped AS (
+    INSERT INTO sessionsdata (chat_id, tracking_enabled, version)
+    VALUES ($1, false, 1)
+    ON CONFLICT (chat_id)
+    DO UPDATE SET
+        tracking_enabled = false,
+        end_time = NOW(),
+        version = sessionsdata.version + 1
+    RETURNING session_id, version
+),
+unsafe AS (
+    UPDATE users
+    SET status = 'unsafe'
+    FROM bumped
+    WHERE users.session_id = bumped.session_id AND users.status IS DISTINCT FROM 'safe'
+    RETURNING users.id, users.tg_user_id
+)
+SELECT
+    (SELECT version FROM bumped) AS version,
+    ARRAY(SELECT tg_user_id FROM unsafe ORDER BY id) AS unsafe_ids,
+    (
+        SELECT count(*) FROM users JOIN bumped USING (session_id)
+        WHERE users.status = 'safe'
+    ) AS safe_count
+"""
+
+
+async def _read_version(chat_id):
+    return await fetchrow(VERSION_SQL, chat_id)
+
+
+def _apply_session_row(session, session_row):
+    session.session_id = session_row["session_id"] if session_row else None
+    session.tracking_enabled = session_row["tracking_enabled"] if session_row else False
+    ad_words = session_row["ad_words"] if session_row else None
+    session.ad_words = frozenset(ad_words) if ad_words else None
+
+
+async def _reload(session, session_row):
+    """Replace the session's contents with what the DB has (caller holds the lock)."""
+    rows = []
+    if session_row:
+        rows = await fetch(LOAD_USERS_SQL, session_row["session_id"], session_row["start_time"])
+
+    session.clear()
+    for srno, row in enumerate(rows, start=1):
+        user_id = row["tg_user_id"]
+        session.participants[user_id] = Participant(
+            srno,
+            row["full_name"],
+            row["username"],
+            x_username=row["x_username"],
+            link_count=row["link_count"],
+            ad_count=row["ad_count"],
+            status=SAFE if row["status"] == SAFE else UNSAFE,
+            # Canonical (older rows may hold raw variants), unique, first-seen order
+            links=(canonical_url(url) for url in row["links"]),
+        )
+        session.x_index.add(user_id, row["x_username"])
+
+    session.version = session_row["version"] if session_row else 0
+    _apply_session_row(session, session_row)
+
+
+async def get_state(chat_id, fresh=False) -> ChatSession:
+    """Session for `chat_id`, reloaded when another instance changed it.
+
+    Do not call while holding that session's lock."""
+    session = sessions.get_or_create(chat_id)
+    now = time.monotonic()
+    if (
+        session.version is not None
+        and not fresh
+        and now - session.checked_at < STATE_MAX_STALENESS
+    ):
+        return session
+
+    async with session.lock:
+        session_row = await _read_version(chat_id)
+        version = session_row["version"] if session_row else 0
+
+        if session.version != version:
+            # Our own pending link writes must land before we re-read
+            if len(link_buffer):
+                await link_buffer.flush()
+                session_row = await _read_version(chat_id)
+            await _reload(session, session_row)
+        else:
+            _apply_session_row(session, session_row)
+
+        session.checked_at = time.monotonic()
+        return session
+
+
+def cached_tracking(chat_id):
+    """The chat's tracking flag if its cached session is fresh, else None."""
+    session = sessions.get(chat_id)
+    if session is None or session.version is None:
+        return None
+    if time.monotonic() - session.checked_at >= STATE_MAX_STALENESS:
+        return None
+    return session.tracking_enabled
+
+
+def note_version(chat_id, version):
+    """Record the version a write of ours produced (see module docstring)."""
+    session = sessions.get(chat_id)
+    if session is None or session.version is None:
+        return
+    if version == session.version + 1:
+        session.version = version
+    else:
+        # Someone else wrote in between → reload on next access
+        session.version = None
+
+
+link_buffer.version_listeners.append(note_version)
+
+
+async def set_tracking(chat_id, enabled):
+    session = await get_state(chat_id)
+    async with session.lock:
+        row = await fetchrow(SET_TRACKING_SQL, chat_id, enabled)
+        session.tracking_enabled = enabled
+        note_version(chat_id, row["version"])
+
+
+async def set_ad_words(chat_id, words):
+    """Per-chat AD word list; an empty/None list falls back to the bot default."""
+    words = frozenset(words) if words else None
+    session = await get_state(chat_id)
+    async with session.lock:
+        row = await fetchrow(SET_AD_WORDS_SQL, chat_id, sorted(words) if words else None)
+        session.ad_words = words
+        note_version(chat_id, row["version"])
+
+
+async def reset_session(chat_id) -> ChatSession:
+    """/open: archive the chat's session and start from an empty one."""
+    session = sessions.get_or_create(chat_id)
+    async with session.lock:
+        await link_buffer.flush()
+        row = await fetchrow(RESET_SESSION_SQL, chat_id)
+
+        session.clear()
+        session.tracking_enabled = False
+        session.session_id = row["session_id"]
+        session.version = row["version"]
+        session.checked_at = time.monotonic()
+
+    # The archived session is rolled up / expired in the background
+    maybe_run_retention()
+    return session
+
+
+async def mark_users(chat_id, user_ids, status, reset_ad_count=False, ad_increment=0) -> list:
+    """Set `status` (SAFE / UNSAFE) for many users of a chat in one statement.
+
+    The caller updates the in-memory Participants (under the session lock)
+    once this returned. Returns the ids that matched a users row."""
+    await link_buffer.flush()
+    try:
+        row = await fetchrow(MARK_USERS_SQL, chat_id, list(user_ids), status, reset_ad_count, ad_increment)
+    except Exception:
+        # It may have committed anyway (e.g. a timeout): reload on next access
+        session = sessions.get(chat_id)
+        if session is not None:
+            session.version = None
+        raise
+    note_version(chat_id, row["version"])
+    return row["user_ids"]
+
+
+async def close_session(chat_id):
+    """Stop tracking and settle everyone not safe as unsafe.
+
+    Returns (unsafe user ids in srno order, number of safe users)."""
+    session = await get_state(chat_id)
+    async with session.lock:
+        await link_buffer.flush()
+        row = await fetchrow(CLOSE_SESSION_SQL, chat_id)
+
+        session.tracking_enabled = False
+        for participant in session.participants.values():
+            if participant.status != SAFE:
+                participant.status = UNSAFE
+        note_version(chat_id, row["version"])
+    return row["unsafe_ids"], row["safe_count"]
@@ -1,11 +1,26 @@
-from telegram import Update, Chat, ChatPermissions
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram import Update, ChatPermissions
+from telegram.ext import Application, ChatMemberHandler, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import RetryAfter
 from datetime import datetime, timedelta
 import telegram
 import logging
-import re
+import html
+import importlib
+import functools
 import os
-from db.database import  fetchrow, fetch, execute
+from db.link_buffer import link_buffer
+from bot.admin_cache import is_admin, track_admin_changes
+from bot.urls import parse_url
+from bot.state import SAFE, UNSAFE, close_session, get_state, mark_users, reset_session, set_ad_words, set_tracking
+from bot.ad_matcher import compile_ad_matcher, matches, normalize_ad_words
+from bot.reports import send_report
+from bot.identity import CachedIdentityBot, cached_identity
+from bot.tracing import TracedRequest, instrument_handlers
+from bot.alerts import alert_digest, prioritize_commands
+from bot.outbound import ALERT, OutboundScheduler, telegram_request_kwargs
+from bot.transitions import Step, run_transition
+from bot.prefilter import requires
+from bot.dispatcher import handler_failed
 
 
 
@@ -16,14 +31,16 @@ def escape_markdown_v2(text):
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# Dictionary to store user link counts and unsafe users
-link_counts = {}
-unsafe_users = {}
-safe_users = {}
-# Add a global flag for tracking system
-tracking_enabled = False
-# Words to check for exact matches
+# Per-chat link counts, safe/unsafe users and the tracking flag live in
+# bot/state.py (backed by the users / links / sessionsdata tables)
+
+# Words to check for exact matches (default; chats can override with /adwords)
 ad_words = {"ad", "all done", "AD", "all dn", "alldone","done"}
+default_ad_words = normalize_ad_words(ad_words)
+
+
+def tracking_words_text(words):
+    return "✅ Tracking words: " + ", ".join(sorted(words))
 
 
 excluded_users = {
@@ -41,16 +58,6 @@ excluded_users = {
 
 }
 
-async def is_admin(update: Update) -> bool:
-    chat = update.effective_chat
-    user_id = update.message.from_user.id
-    # Fetch chat administrators and check if the user is one of them
-    admins = await chat.get_administrators()
-    for admin in admins:
-        if admin.user.id == user_id:
-            return True
-    return False
-
 # Start command to reset all counts
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
@@ -60,29 +67,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_sticker(STICKER_ID)
         return
 
-    global link_counts, unsafe_users, safe_users
-    link_counts = {}
-    unsafe_users = {}
-    safe_users = {}
-
     chat_id = update.effective_chat.id
 
-    # 🔁 Update Group Name
-    try:
-        await context.bot.set_chat_title(
+    # Title and permissions run alongside the reset; the message waits for
+    # the reset (no announcement if it failed) and the pin for the message
+    # (bot/transitions.py). Links sent meanwhile queue behind /open in the
+    # dispatcher, so they land in the new session.
+    await run_transition("/open", [
+        # 🔁 Update Group Name
+        Step("title", functools.partial(
+            context.bot.set_chat_title,
             chat_id=chat_id,
             title="VERIFIED LIKE GC [OPEN]"
-        )
-    except Exception as e:
-        print("Failed to update group title:", e)
+        )),
 
-    # 🔒 Change permissions → TEXT ONLY
-    try:
-        await context.bot.set_chat_permissions(
-            chat_id=update.effective_chat.id,
+        # 🔒 Change permissions → TEXT ONLY
+        Step("permissions", functools.partial(
+            context.bot.set_chat_permissions,
+            chat_id=chat_id,
             permissions=ChatPermissions(
             can_send_messages=True,
-            can_send_audios=False,      
+            can_send_audios=False,
             can_send_documents=False,
             can_send_photos=False,
             can_send_videos=False,
@@ -92,45 +97,29 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             can_send_other_messages=False,
             can_add_web_page_previews=False
             )
-        )
+        )),
 
-    except Exception as e:
-        print("Failed to update permissions:", e)
-
-    await execute(
-        """
-        INSERT INTO public.sessionsdata (chat_id, tracking_enabled)
-        VALUES ($1, false)
-        ON CONFLICT (chat_id)
-        DO UPDATE SET
-            tracking_enabled=false,
-            start_time=NOW(),
-            end_time=NULL
-        """,
-        chat_id
-    )
+        # Reset counts / safe / unsafe users for this chat (DB + cache)
+        Step("reset", functools.partial(reset_session, chat_id), required=True),
 
-    # 📌 Stylish message
-    msg = await update.message.reply_text(
-        "🚀 Session Started Successfully!\n\n"
-        "🔗 Send your links below\n"
-    )
+        # 📌 Stylish message
+        Step("reply", lambda _: update.message.reply_text(
+            "🚀 Session Started Successfully!\n\n"
+            "🔗 Send your links below\n"
+        ), after="reset", required=True),
 
-    # 📌 Pin the message
-    try:
-        await context.bot.pin_chat_message(
+        # 📌 Pin the message
+        Step("pin", lambda msg: context.bot.pin_chat_message(
             chat_id=chat_id,
             message_id=msg.message_id,
             disable_notification=True
-        )
-    except Exception as e:
-        print("Failed to pin message:", e)
+        ), after="reply"),
+    ])
 
 
 # Message handler to count messages with links
+@requires(message=True)
 async def count_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global link_counts, unsafe_users, safe_users, excluded_users
-
     if not update.message:
         return
 
@@ -143,188 +132,137 @@ async def count_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_username in excluded_users:
         return
 
-    # Init user
-    if user_id not in link_counts:
-        link_counts[user_id] = {
-            "srno": len(link_counts) + 1,
-            "name": user_full_name,
-            "username": user_username,
-            "x_username": None,
-            "link_count": 0,
-            "ad_count": 0,
-            "links": []  # NEW: store all links
-        }
-
-    if not update.message.entities:
-        return
+    state = await get_state(update.effective_chat.id)
 
-    for entity in update.message.entities:
-        if entity.type not in ["url", "text_link"]:
-            continue
-
-        # Extract URL
-        url = update.message.text[entity.offset:entity.offset + entity.length]
-
-        # Extract X username
-        x_username = None
-        try:
-            if "twitter.com/" in url:
-                x_username = url.split("twitter.com/")[-1].split("/")[0].split("?")[0]
-            elif "x.com/" in url:
-                x_username = url.split("x.com/")[-1].split("/")[0].split("?")[0]
-        except:
-            x_username = None
-
-        # ❗ INVALID usernames (like i, status, etc.)
-        INVALID_X = {"i", "status", ""}
-
-        # SAVE ONLY ONCE
-        if not link_counts[user_id].get("x_username"):
-            if x_username and x_username not in INVALID_X:
-                # ✅ store username
-                link_counts[user_id]["x_username"] = f"{x_username}"
-            else:
-                # ✅ store clickable link
-                link_counts[user_id]["x_username"] = url
-
-        # Increment link count ALWAYS
-        link_counts[user_id]["link_count"] += 1
-
-        # Add the link to the list
-        if url not in link_counts[user_id]["links"]:
-            link_counts[user_id]["links"].append(url)
-
-        # Mark unsafe initially
-        if user_id not in unsafe_users and user_id not in safe_users:
-            unsafe_users[user_id] = {
-                "srno": link_counts[user_id]["srno"],
-                "name": user_full_name,
-                "username": user_username,
-                "x_username": link_counts[user_id]["x_username"],
-                "links": link_counts[user_id]["links"],
-            }
-        # DB: upsert user
-        user_row = await fetchrow(
-            """
-            INSERT INTO users (chat_id, tg_user_id, username, full_name, x_username, link_count)
-            VALUES ($1,$2,$3,$4,$5,1)
-            ON CONFLICT (chat_id, tg_user_id)
-            DO UPDATE SET
-                link_count = users.link_count + 1,
-                x_username = COALESCE(users.x_username, EXCLUDED.x_username)
-            RETURNING id
-            """,
-            update.effective_chat.id,
-            user_id,
-            user_username,
-            user_full_name,
-            link_counts[user_id]["x_username"]
-        )
+    alert = False
 
-        # DB: store link
-        await execute(
-            "INSERT INTO links (user_id, url) VALUES ($1,$2)",
-            user_row["id"],
-            url
-        )
+    # Same-chat updates are serialized on the session lock (srno, x_username)
+    async with state.lock:
+        # Init user
+        participant = state.add_participant(user_id, user_full_name, user_username)
 
+        if not update.message.entities:
+            return
 
-        # ⚠️ Alert ONLY if more than 1 link
-        if link_counts[user_id]["link_count"] > 1:
-            mention = f"@{user_username}" if user.username else user_full_name
-            await update.message.reply_text(
-                f"⚠️ Alert: {mention} shared more than one link."
+        for entity in update.message.entities:
+            if entity.type not in ["url", "text_link"]:
+                continue
+
+            # Extract URL (text_link: the hidden target, not the visible text)
+            raw_url = entity.url if entity.type == "text_link" else update.message.parse_entity(entity)
+
+            # Canonical URL + X handle (bot/urls.py, memoized)
+            parsed = parse_url(raw_url)
+            url = parsed.canonical
+
+            # SAVE ONLY ONCE
+            if not participant.x_username:
+                # ✅ store username, else clickable link
+                participant.x_username = parsed.handle or url
+                state.x_index.add(user_id, participant.x_username)
+
+            # Increment link count ALWAYS
+            participant.link_count += 1
+
+            # Add the link to the (ordered, deduplicated) set
+            participant.add_link(url)
+
+            # Mark unsafe initially
+            if participant.status is None:
+                participant.status = UNSAFE
+            # DB: upsert user + store link (batched, see db/link_buffer.py)
+            await link_buffer.add(
+                update.effective_chat.id,
+                user_id,
+                user_username,
+                user_full_name,
+                participant.x_username,
+                url
             )
 
-        break  # one link per message
 
+            # ⚠️ Alert ONLY if more than 1 link
+            alert = participant.link_count > 1
+
+            break  # one link per message
+
+    if alert:
+        mention = f"@{user_username}" if user.username else user_full_name
+        # Merged into one digest per chat and window (bot/alerts.py)
+        await alert_digest.add(context.bot, update.effective_chat.id, user_id, mention, participant.link_count)
+
+@requires(message=True, tracking=True)
 async def count_ad_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global link_counts, unsafe_users, safe_users
+    if not update.message:
+        return
 
-    if not update.message or not tracking_enabled:
+    state = await get_state(update.effective_chat.id)
+    if not state.tracking_enabled:
         return
 
     user = update.message.from_user
     user_id = user.id
 
-    # user must already exist
-    if user_id not in link_counts:
+    # user must already exist (checked before touching the text)
+    if user_id not in state.participants:
         return
 
-    # combine text
-    text = (update.message.text or "") + " " + (update.message.caption or "")
+    # One precompiled alternation for the chat's word list
+    matcher = compile_ad_matcher(state.ad_words or default_ad_words)
+    ad_match = matches(matcher, update.message.text, update.message.caption)
 
-    ad_match = any(
-        re.search(rf"\b{re.escape(word)}\b", text, re.IGNORECASE)
-        for word in ad_words
-    )
+    if not ad_match:
+        async with state.lock:
+            participant = state.participants.get(user_id)
+            # ✅ UNSAFE USER
+            if participant and participant.status is None:
+                participant.status = UNSAFE
+        return
 
-    user_data = link_counts[user_id]
+    async with state.lock:
+        participant = state.participants.get(user_id)
+        if not participant:
+            return
+
+        # DB first: mark safe + increment ad count
+        await mark_users(update.effective_chat.id, [user_id], SAFE, ad_increment=1)
 
-    if ad_match:
         # increment ad count
-        user_data["ad_count"] += 1
-
-        # remove from unsafe
-        unsafe_users.pop(user_id, None)
-
-        # ✅ SAFE USER (FULL STRUCTURE)
-        safe_users[user_id] = {
-            "srno": user_data["srno"],
-            "name": user_data["name"],
-            "username": user_data["username"],
-            "x_username": user_data["x_username"],
-            "links": user_data["links"],
-        }
-
-        x_username = user_data.get("x_username")
-
-        x_display = "Unknown"
-
-        # Case 1: x_username exists
-        if x_username:
-            # if username itself is a link
-            if x_username.startswith(("http://", "https://")):
-                x_display = x_username
-            else:
-                # normal username → show username + link
-                x_display = f"@{x_username}"
-
-        await update.message.reply_text(
-            f"𝕏 ID: {x_display}",
-            disable_web_page_preview=True
-        )
+        participant.ad_count += 1
 
-        # DB: mark safe + increment ad count
-        await execute(
-            """
-            UPDATE users
-            SET ad_count = ad_count + 1,
-                status = 'safe'
-            WHERE chat_id=$1 AND tg_user_id=$2
-            """,
-            update.effective_chat.id,
-            user_id
-        )
+        # ✅ SAFE USER
+        participant.status = SAFE
 
+    x_username = participant.x_username
 
-    else:
-        # ✅ UNSAFE USER (FULL STRUCTURE)
-        if user_id not in safe_users and user_id not in unsafe_users:
-            unsafe_users[user_id] = {
-                "srno": user_data["srno"],
-                "name": user_data["name"],
-                "username": user_data["username"],
-                "x_username": user_data["x_username"],
-                "links": user_data["links"],
-            }
+    x_display = "Unknown"
+
+    # Case 1: x_username exists
+    if x_username:
+        # if username itself is a link
+        if x_username.startswith(("http://", "https://")):
+            x_display = x_username
+        else:
+            # normal username → show username + link
+            x_display = f"@{x_username}"
+
+    try:
+        # A user notice: skipped when the chat is over its message limit (bot/outbound.py)
+        # (Message.reply_text has no rate_limit_args in PTB 20)
+        await context.bot.send_message(
+            update.effective_chat.id,
+            f"𝕏 ID: {x_display}",
+            reply_to_message_id=update.message.message_id,
+            disable_web_page_preview=True,
+            rate_limit_args=ALERT
+        )
+    except RetryAfter:
+        pass
 
 
 
 # Admin /sr command when replying to an AD message
 async def sr_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global safe_users, unsafe_users, link_counts
-
     if not await is_admin(update):
         await update.message.reply_text("🚫 Unauthorized")
         return
@@ -336,39 +274,29 @@ async def sr_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     replied_user = update.message.reply_to_message.from_user
     user_id = replied_user.id
 
-    if user_id not in link_counts:
+    state = await get_state(update.effective_chat.id, fresh=True)
+    participant = state.participants.get(user_id)
+
+    if participant is None:
         await update.message.reply_text("ℹ️ User data not found.")
         return
 
-    if user_id not in safe_users:
+    if participant.status != SAFE:
         await update.message.reply_text("ℹ️ User is already unsafe.")
         return
 
-    user_data = link_counts[user_id]
-
-    # Reset ad count
-    user_data["ad_count"] = 0
+    async with state.lock:
+        await mark_users(update.effective_chat.id, [user_id], UNSAFE, reset_ad_count=True)
 
-    # Move SAFE → UNSAFE
-    unsafe_users[user_id] = {
-        "srno": user_data["srno"],
-        "name": user_data["name"],
-        "username": user_data["username"],
-        "x_username": user_data["x_username"],
-        "links": user_data["links"],
-    }
+        # Reset ad count
+        participant.ad_count = 0
 
-    safe_users.pop(user_id, None)
-
-    await execute(
-        "UPDATE users SET status='unsafe', ad_count=0 WHERE chat_id=$1 AND tg_user_id=$2",
-        update.effective_chat.id,
-        user_id
-    )
+        # Move SAFE → UNSAFE
+        participant.status = UNSAFE
 
 
     await update.message.reply_text(
-        f"⚠️ @{user_data['username']} has been marked **UNSAFE** again.\n\n"
+        f"⚠️ @{participant.username} has been marked **UNSAFE** again.\n\n"
         "Your likes aren’t visible yet.\n"
         "Kindly complete them or share a screen recording with your profile visible."
     )
@@ -378,8 +306,6 @@ async def ad_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Admin command to mark a user as SAFE if they are currently in the UNSAFE list.
     Usage: Reply to the user's message with /ad
     """
-    global safe_users, unsafe_users, link_counts
-
     if not await is_admin(update):
         await update.message.reply_text("🚫 Unauthorized")
         return
@@ -391,46 +317,38 @@ async def ad_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     replied_user = update.message.reply_to_message.from_user
     user_id = replied_user.id
 
-    if user_id not in link_counts:
+    state = await get_state(update.effective_chat.id, fresh=True)
+    participant = state.participants.get(user_id)
+
+    if participant is None:
         await update.message.reply_text("ℹ️ User data not found.")
         return
 
-    if user_id not in unsafe_users:
+    if participant.status != UNSAFE:
         await update.message.reply_text("ℹ️ User is already safe.")
         return
 
-    user_data = link_counts[user_id]
-
-    # Reset ad count
-    user_data["ad_count"] = 0
+    async with state.lock:
+        await mark_users(update.effective_chat.id, [user_id], SAFE, reset_ad_count=True)
 
-    # Move UNSAFE → SAFE
-    safe_users[user_id] = {
-        "srno": user_data["srno"],
-        "name": user_data["name"],
-        "username": user_data["username"],
-        "x_username": user_data["x_username"],
-        "links": user_data["x_username"]
-    }
+        # Reset ad count
+        participant.ad_count = 0
 
-    unsafe_users.pop(user_id, None)
-
-    await execute(
-        "UPDATE users SET status='safe', ad_count=0 WHERE chat_id=$1 AND tg_user_id=$2",
-        update.effective_chat.id,
-        user_id
-    )
+        # Move UNSAFE → SAFE
+        participant.status = SAFE
 
 
     await update.message.reply_text(
-        f"✅ @{user_data['username']} has been marked SAFE!\n\n"
+        f"✅ @{participant.username} has been marked SAFE!\n\n"
     )
 
 async def show_ad_completed(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global link_counts
+    # Make sure batched link writes are visible to the report
+    await link_buffer.flush()
+    participants = (await get_state(update.effective_chat.id, fresh=True)).participants
 
     # Calculate the total number of users who completed the ad task
-    total_completed_users = sum(1 for data in link_counts.values() if data.get("ad_count", 0) > 0)
+    total_completed_users = sum(1 for p in participants.values() if p.ad_count > 0)
 
     # Send a message to the user with the total count
     if total_completed_users > 0:
@@ -445,9 +363,9 @@ def format_x_value(x_value):
         return "NA"
 
     if x_value.startswith("http"):
-        return f'<a href="{x_value}">Link</a>'
+        return f'<a href="{html.escape(x_value)}">Link</a>'
 
-    return f"@{x_value}"
+    return f"@{html.escape(x_value)}"
 
 
 async def show_unsafe_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -456,6 +374,9 @@ async def show_unsafe_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_sticker(update.effective_chat.id, STICKER_ID)
         return
 
+    await link_buffer.flush()
+    unsafe_users = (await get_state(update.effective_chat.id, fresh=True)).with_status(UNSAFE)
+
     if not unsafe_users:
         await context.bot.send_message(
             update.effective_chat.id,
@@ -463,19 +384,17 @@ async def show_unsafe_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    lines = ["Unsafe Users:"]
+    def rows():
+        for idx, (_, participant) in enumerate(unsafe_users, start=1):
+            tg_username = participant.username or "Unknown"
+            x_display = format_x_value(participant.x_username)
 
-    for idx, data in enumerate(unsafe_users.values(), start=1):
-        tg_username = data.get("username", "Unknown")
-        x_display = format_x_value(data.get("x_username"))
+            yield f"{idx}. @{tg_username} | X:{x_display}"
 
-        lines.append(
-            f"{idx}. @{tg_username} | X:{x_display}"
-        )
-
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="\n".join(lines),
+    await send_report(
+        lambda text, **kwargs: context.bot.send_message(update.effective_chat.id, text, **kwargs),
+        rows(),
+        header="Unsafe Users:",
         parse_mode="HTML",
         disable_web_page_preview=True
     )
@@ -491,34 +410,40 @@ async def show_link_counts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_sticker(STICKER_ID)  # Send sticker
         return  # Stop execution if user is not an admin
 
-    if not link_counts:
+    await link_buffer.flush()
+    participants = (await get_state(update.effective_chat.id, fresh=True)).participants
+
+    if not participants:
         await update.message.reply_text("No links counted yet!")
         return
 
     # Count total users who shared links
-    total_users = sum(1 for data in link_counts.values() if data['link_count'] > 0)
-
-    # Find users who shared more than 2 links
-    users_with_more_than_2_links = [
-        f"🔗 @{escape_markdown_v2(data['username'])} → *{escape_markdown_v2(str(data['link_count']))}* links"
-        for data in link_counts.values()
-        if data['link_count'] > 1
-    ]
-
-    # Construct the message with escaped characters
-    counts_text = (
+    total_users = sum(1 for p in participants.values() if p.link_count > 0)
+
+    # Users who shared more than 1 link
+    def rows():
+        found = False
+        for p in participants.values():
+            if p.link_count > 1:
+                found = True
+                yield f"🔗 @{escape_markdown_v2(p.username)} → *{escape_markdown_v2(str(p.link_count))}* links"
+        if not found:
+            yield "✅ No users with more than 1 links"
+
+    # Header with escaped characters, repeated on every chunk
+    header = (
         f"📊 *Link Tracking Report*\n"
         f"━━━━━━━━━━━━━━━━━━\n"
         f"👥 *Total Users with Links:* `{escape_markdown_v2(str(total_users))}`\n"
-        f"━━━━━━━━━━━━━━━━━━\n"
+        f"━━━━━━━━━━━━━━━━━━"
     )
 
-    if users_with_more_than_2_links:
-        counts_text += "\n".join(users_with_more_than_2_links)
-    else:
-        counts_text += "✅ No users with more than 1 links"
-
-    await update.message.reply_text(counts_text, parse_mode=telegram.constants.ParseMode.MARKDOWN_V2)
+    await send_report(
+        update.message.reply_text,
+        rows(),
+        header=header,
+        parse_mode=telegram.constants.ParseMode.MARKDOWN_V2
+    )
 
 async def multiple_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Admin check
@@ -527,235 +452,137 @@ async def multiple_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_sticker(STICKER_ID)
         return
 
-    if not link_counts:
+    await link_buffer.flush()
+    state = await get_state(update.effective_chat.id, fresh=True)
+    participants = state.participants
+
+    if not participants:
         await update.message.reply_text("No one shared links yet!")
         return
 
-    response_text = "🚨 Users with multiple links or duplicate X usernames 🚨\n\n"
-    rows_added = False
-
-    for data in link_counts.values():
-        link_count = data.get("link_count", 0)
-        x_username = data.get("x_username")
-        links = data.get("links", [])
-
-        include = False
+    def rows():
+        for p in participants.values():
+            link_count = p.link_count
+            x_username = p.x_username
 
-        # multiple links
-        if link_count > 1:
-            include = True
+            include = False
 
-        # duplicate X username
-        if x_username:
-            same_x_users = [
-                u for u in link_counts.values()
-                if u.get("x_username") == x_username
-            ]
-            if len(same_x_users) > 1:
+            # multiple links
+            if link_count > 1:
                 include = True
 
-        if not include:
-            continue
+            # duplicate X username (index lookup, see bot/x_index.py)
+            if x_username and state.x_index.is_shared(x_username):
+                include = True
 
-        rows_added = True
+            if not include:
+                continue
 
-        # BEST display name: TG username else full name
-        display_name = f"@{data['username']}" if data.get("username") else data.get("name", "Unknown")
+            # User info and all their links, empty line after each user
+            block = [f"{p.srno}. {p.display_name} | X: @{x_username or 'NA'}"]
+            for idx, link in enumerate(p.links, start=1):
+                block.append(f"   {idx}. {link}")
+            block.append("")
+            yield "\n".join(block)
 
-        # Add user info and all their links
-        response_text += f"{data['srno']}. {display_name} | X: @{x_username or 'NA'}\n"
-        for idx, link in enumerate(links, start=1):
-            response_text += f"   {idx}. {link}\n"
-        response_text += "\n"  # empty line after each user
+    sent = await send_report(
+        update.message.reply_text,
+        rows(),
+        header="🚨 Users with multiple links or duplicate X usernames 🚨\n"
+    )
 
-    if not rows_added:
+    if not sent:
         await update.message.reply_text("No multiple or duplicate X users found.")
-        return
 
-    # Send the final message
-    await update.message.reply_text(response_text)
 
-
-async def user_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def shared_x_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/xwho <handle or link> → Telegram users in this session who gave that X account."""
     if not await is_admin(update):
-        await update.message.reply_text("🚫 Unauthorized access attempt!")
+        await update.message.reply_text("🚫 Admin only")
         return
 
-    if not link_counts:
-        await update.message.reply_text("🔴 No users found!")
+    if not context.args:
+        await update.message.reply_text("Usage: /xwho @handle or /xwho x.com/handle")
         return
 
-    TELEGRAM_ICON = "💬"
-    X_ICON = "𝕏"
-
-    user_list_text = "Users List:\n"
-    user_count = 0
-
-    for data in link_counts.values():
-        srno = data.get("srno")
-        tg_username = data.get("username", "Unknown")
-        x_value = data.get("x_username")
-
-        # Decide how to show X value
-        if x_value and x_value.startswith("http"):
-            x_display = f'<a href="{x_value}">Link</a>'
-        elif x_value:
-            x_display = f'@{x_value}'
-        else:
-            x_display = "NA"
-
-        user_list_text += (
-            f"{srno}. {TELEGRAM_ICON} @{tg_username} | "
-            f"{X_ICON} {x_display}\n"
-        )
-
-        user_count += 1
-
-        # Send in batches of 80
-        if user_count % 80 == 0:
-            await update.message.reply_text(
-                user_list_text,
-                parse_mode="HTML",
-                disable_web_page_preview=True
-            )
-            user_list_text = "Users List:\n"
-
-    # Send remaining users
-    if user_list_text.strip():
-        await update.message.reply_text(
-            user_list_text,
-            parse_mode="HTML",
-            disable_web_page_preview=True
-        )
-
-async def show_checklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global link_counts
-
-    if not await is_admin(update):
-        STICKER_ID = "CAACAgUAAxkBAAICLWfAVQEf_k6dGDuoUbGDUrcng0BlAAJWBQACDLDZVke9Qr6WRu8KNgQ"
-
-        await update.message.reply_sticker(STICKER_ID)  # Send sticker
-        return  # Stop execution if user is not an admin
-    # Create a list to store the checklist entries
-    checklist = []
+    state = await get_state(update.effective_chat.id, fresh=True)
+    user_ids = state.x_index.users_for(context.args[0])
 
-    # Loop through all users and their data in link_counts
-    for user_data in link_counts.values():
-        srno = user_data["srno"]
-        name = user_data["name"]
-        ad_completed = "✅" if user_data.get("ad_count", 0) > 0 else "❌"
+    if not user_ids:
+        await update.message.reply_text("No users found with that X account.")
+        return
 
-        checklist.append(f"{srno}. {name} - {ad_completed}")
+    lines = [f"𝕏 {context.args[0]} shared by:"]
+    for user_id in sorted(user_ids, key=lambda uid: state.participants[uid].srno):
+        participant = state.participants[user_id]
+        lines.append(f"{participant.srno}. {participant.display_name}")
 
-    # Join all the entries into a single string
-    checklist_text = "\n".join(checklist)
+    await update.message.reply_text("\n".join(lines), disable_web_page_preview=True)
 
-    # Send the checklist as a message
-    if checklist_text:
-        await update.message.reply_text(f"📋 Checklist:\n{checklist_text}")
-    else:
-        await update.message.reply_text("❌ No users found in the list.")
 
-async def mute_all_unsafe_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def user_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        STICKER_ID = "CAACAgUAAxkBAAICLWfAVQEf_k6dGDuoUbGDUrcng0BlAAJWBQACDLDZVke9Qr6WRu8KNgQ"
-        await update.message.reply_sticker(STICKER_ID)
-        return
-
-    if not unsafe_users:
-        await update.message.reply_text("No unsafe users to mute.")
+        await update.message.reply_text("🚫 Unauthorized access attempt!")
         return
 
-    chat = update.effective_chat
-    bot_member = await chat.get_member(context.bot.id)
+    await link_buffer.flush()
+    participants = (await get_state(update.effective_chat.id, fresh=True)).participants
 
-    if not bot_member.can_restrict_members:
-        await update.message.reply_text("Bot needs Manage Members permission.")
+    if not participants:
+        await update.message.reply_text("🔴 No users found!")
         return
 
-    # 🔒 DEFAULT MUTE DURATION → 5 DAYS
-    mute_duration = timedelta(days=5)
-    until_date = update.message.date + mute_duration
+    TELEGRAM_ICON = "💬"
+    X_ICON = "𝕏"
 
-    muted = 0
-    failed = 0
+    def rows():
+        for p in participants.values():
+            srno = p.srno
+            tg_username = p.username or "Unknown"
+            x_display = format_x_value(p.x_username)
 
-    for user_id in list(unsafe_users.keys()):
-        try:
-            await context.bot.restrict_chat_member(
-                chat_id=chat.id,
-                user_id=user_id,
-                permissions=ChatPermissions(can_send_messages=False),
-                until_date=until_date
-            )
-            muted += 1
-        except Exception:
-            failed += 1
+            yield f"{srno}. {TELEGRAM_ICON} @{tg_username} | {X_ICON} {x_display}"
 
-    await update.message.reply_text(
-        f"Muted {muted} unsafe users"
-        + (f"\nFailed: {failed}" if failed else "")
+    # Packed by length instead of fixed batches of 80
+    await send_report(
+        update.message.reply_text,
+        rows(),
+        header="Users List:",
+        parse_mode="HTML",
+        disable_web_page_preview=True
     )
 
-    await lock_chat(update, context)
-
-
-
-async def mute_user(update, context):
+async def show_checklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
-        await update.message.reply_text("🚫 Admin only")
-        return
-
-    if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Reply to a user to mute them")
-        return
-
-    user_id = update.message.reply_to_message.from_user.id
+        STICKER_ID = "CAACAgUAAxkBAAICLWfAVQEf_k6dGDuoUbGDUrcng0BlAAJWBQACDLDZVke9Qr6WRu8KNgQ"
 
-    # Mute for 5 days
-    await context.bot.restrict_chat_member(
-        chat_id=update.effective_chat.id,
-        user_id=user_id,
-        permissions=ChatPermissions(can_send_messages=False),
-        until_date=update.message.date + timedelta(days=5)
-    )
+        await update.message.reply_sticker(STICKER_ID)  # Send sticker
+        return  # Stop execution if user is not an admin
 
-    await update.message.reply_text("✅ User muted for 5 days")
+    await link_buffer.flush()
+    participants = (await get_state(update.effective_chat.id, fresh=True)).participants
 
+    def rows():
+        for p in participants.values():
+            srno = p.srno
+            name = p.name
+            ad_completed = "✅" if p.ad_count > 0 else "❌"
 
+            yield f"{srno}. {name} - {ad_completed}"
 
-async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_admin(update):
-        await update.message.reply_text("🚫 Admin only")
-        return
+    sent = await send_report(update.message.reply_text, rows(), header="📋 Checklist:")
 
-    if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Reply to a user to unmute")
-        return
-
-    user_id = update.message.reply_to_message.from_user.id
-
-    await context.bot.restrict_chat_member(
-        chat_id=update.effective_chat.id,
-        user_id=user_id,
-        permissions=ChatPermissions(
-            can_send_messages=True
-        )
-    )
-
-    await update.message.reply_text("✅ User unmuted")
+    if not sent:
+        await update.message.reply_text("❌ No users found in the list.")
 
 # Command to enable ad tracking
 async def start_ad(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global tracking_enabled
-
     # 🔐 Admin check
     if not await is_admin(update):
         STICKER_ID = "CAACAgUAAxkBAAICLWfAVQEf_k6dGDuoUbGDUrcng0BlAAJWBQACDLDZVke9Qr6WRu8KNgQ"
         await update.message.reply_sticker(STICKER_ID)
         return
 
-    tracking_enabled = True
     chat_id = update.effective_chat.id
 
     # 🕒 Time calculation (now + 1 hour)
@@ -766,18 +593,24 @@ async def start_ad(update: Update, context: ContextTypes.DEFAULT_TYPE):
     end_time = now + timedelta(hours=1)
     end_time_str = end_time.strftime("%I:%M %p")  # e.g. 05:30 PM
 
-    # 🔁 Update Group Name → CLOSED
-    try:
-        await context.bot.set_chat_title(
+    # The chat's own list if /adwords set one
+    state = await get_state(chat_id)
+    words = state.ad_words or default_ad_words
+
+    # Same shape as /open: the message only once tracking is on, the pin after it
+    await run_transition("/tracking", [
+        Step("tracking", functools.partial(set_tracking, chat_id, True), required=True),
+
+        # 🔁 Update Group Name → CLOSED
+        Step("title", functools.partial(
+            context.bot.set_chat_title,
             chat_id=chat_id,
             title="VERIFIED LIKE GC [CLOSED]"
-        )
-    except Exception as e:
-        print("Failed to update group title:", e)
+        )),
 
-    # 🔒 Change permissions (TEXT ONLY)
-    try:
-        await context.bot.set_chat_permissions(
+        # 🔒 Change permissions (TEXT ONLY)
+        Step("permissions", functools.partial(
+            context.bot.set_chat_permissions,
             chat_id=chat_id,
             permissions=ChatPermissions(
                 can_send_messages=True,
@@ -791,136 +624,79 @@ async def start_ad(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 can_send_other_messages=False,
                 can_add_web_page_previews=False
             )
-        )
-    except Exception as e:
-        print("Failed to update permissions:", e)
-
-    # 📢 Message
-    msg = await update.message.reply_text(
-        "📢 Timeline Updated 👇\n\n"
-        "🔗 x.com/glamm__girl\n\n"
-        "❤️ Like all posts of the TL account\n"
-        "📝 Drop All done in the group after completion\n\n"
-        f"⏰ Last time for activity: {end_time_str}\n\n"
-        "✅ Tracking words: done, ad, all done"
-    )
-
-    # 📌 Pin the message
-    try:
-        await context.bot.pin_chat_message(
+        )),
+
+        # 📢 Message
+        Step("reply", lambda _: update.message.reply_text(
+            "📢 Timeline Updated 👇\n\n"
+            "🔗 x.com/glamm__girl\n\n"
+            "❤️ Like all posts of the TL account\n"
+            "📝 Drop All done in the group after completion\n\n"
+            f"⏰ Last time for activity: {end_time_str}\n\n"
+            + tracking_words_text(words)
+        ), after="tracking", required=True),
+
+        # 📌 Pin the message
+        Step("pin", lambda msg: context.bot.pin_chat_message(
             chat_id=chat_id,
             message_id=msg.message_id,
             disable_notification=True
-        )
-    except Exception as e:
-        print("Failed to pin message:", e)
+        ), after="reply"),
+    ])
 
 # Command to stop ad tracking (optional)
 async def stop_ad(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global tracking_enabled
-
     # Check if the user is an admin
     if not await is_admin(update):
         await update.message.reply_text("You are not authorized to use this command.")
         return
 
-    tracking_enabled = False
-    await update.message.reply_text("Ad trackinghas been deactivated!")
-
-
-async def get_user_id(context: ContextTypes.DEFAULT_TYPE, username: str):
-    """Convert username (@username) to user ID even if they haven't sent a message."""
-    try:
-        user = await context.bot.get_chat(username)  # ✅ Resolves username to user ID
-        return user.id
-    except Exception:
-        return None
-
-
-async def kick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Kick a user from the group (Admins only)."""
-
-    chat = update.effective_chat
+    # One statement settles the whole session (bot/state.py close_session)
+    unsafe_ids, safe_count = await close_session(update.effective_chat.id)
+    await update.message.reply_text(
+        "Ad trackinghas been deactivated!\n\n"
+        f"✅ Safe: {safe_count}\n"
+        f"⚠️ Unsafe: {len(unsafe_ids)}"
+    )
 
-    # # ✅ Ensure the bot has permission to kick
-    # if not await bot_has_permissions(update, context):
-    #     await update.message.reply_text("I need 'Ban Members' permission to kick users.")
-    #     return
 
+async def set_ad_words_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/adwords done, all done, ad → set this chat's AD words. /adwords reset → default."""
     if not await is_admin(update):
-            STICKER_ID = "7688271168:AAFpBE6eZc8-vI1qRSmdK7ayOMVXEoVoLcI"
-
-            await update.message.reply_sticker(STICKER_ID)  # Send sticker
-            return  # Stop execution if user is not an admin
-
-    target_user_id = None
-    target_username = None
-
-    try:
-        # ✅ Kick by replying to a user
-        if update.message.reply_to_message:
-            target_user_id = update.message.reply_to_message.from_user.id
-            target_username = f"@{update.message.reply_to_message.from_user.username}" if update.message.reply_to_message.from_user.username else "Unknown User"
-        else:
-            # ✅ Kick by @username
-            if not context.args:
-                await update.message.reply_text("Usage: /kick @username or reply to a user.")
-                return
-
-            target_username = context.args[0].replace("@", "")
-
-            # ✅ Convert username to user ID
-            target_user_id = await get_user_id(context, f"@{target_username}")
-
-            if not target_user_id:
-                await update.message.reply_text(f"User @{target_username} not found in Telegram.")
-                return
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
 
-        # ✅ Check if user is in the group
-        try:
-            user_status = await context.bot.get_chat_member(chat.id, target_user_id)
-        except Exception:
-            await update.message.reply_text(f"User @{target_username} is not in this group.")
-            return
+    chat_id = update.effective_chat.id
+    raw = " ".join(context.args or [])
 
-        # ✅ Prevent kicking admins
-        if user_status.status in ["administrator", "creator"]:
-            await update.message.reply_text(f"Cannot kick an admin: @{target_username}")
-            return
+    if not raw:
+        state = await get_state(chat_id)
+        words = state.ad_words or default_ad_words
+        await update.message.reply_text(tracking_words_text(words))
+        return
 
+    if raw.strip().lower() == "reset":
+        await set_ad_words(chat_id, None)
+        await update.message.reply_text("✅ Tracking words reset to default.")
+        return
 
+    words = normalize_ad_words(raw.split(","))
+    await set_ad_words(chat_id, words)
+    await update.message.reply_text(tracking_words_text(words))
 
-        # ✅ Kick the user
-        await context.bot.ban_chat_member(chat.id, target_user_id)
 
-        # ✅ Notify the chat
-        await update.message.reply_text(
-            f"User Kicked: @{target_username}\n"
-            f"Action: Removed from group"
-        )
+def lazy_handler(module_name, func_name):
+    """Callback that imports `module_name` on first use instead of at cold start."""
+    handler = None
 
-    except Exception as e:
-        await update.message.reply_text(f"Failed to kick user: {e}")
+    async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        nonlocal handler
+        if handler is None:
+            handler = getattr(importlib.import_module(module_name), func_name)
+        return await handler(update, context)
 
-
-async def lock_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_admin(update):
-        await update.message.reply_text("🚫 Admin only command")
-        return
-
-    try:
-        await context.bot.set_chat_permissions(
-            chat_id=update.effective_chat.id,
-            permissions=ChatPermissions(
-                can_send_messages=False
-            )
-        )
-
-        await update.message.reply_text("🔒 Chat locked successfully")
-
-    except Exception as e:
-        print("Failed to lock chat:", e)
-        await update.message.reply_text("❌ Failed to lock chat")
+    callback.__name__ = func_name
+    return callback
 
 
 def build_bot():
@@ -929,7 +705,21 @@ def build_bot():
     if not BOT_TOKEN:
         raise RuntimeError("❌ BOT_TOKEN environment variable not set")
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Self-hosted Bot API server (or the fake one of bench/load_test.py)
+    api_url = os.getenv("TELEGRAM_API_URL")
+    bot_kwargs = {"base_url": api_url.rstrip("/") + "/bot"} if api_url else {}
+
+    # No getMe round trip on initialize() when BOT_USERNAME is set (bot/identity.py)
+    # Bot API calls are timed per update (bot/tracing.py) and scheduled
+    # within Telegram's limits (bot/outbound.py)
+    bot = CachedIdentityBot(
+        BOT_TOKEN,
+        identity=cached_identity(BOT_TOKEN),
+        request=TracedRequest(**telegram_request_kwargs()),
+        rate_limiter=OutboundScheduler(),
+        **bot_kwargs
+    )
+    application = Application.builder().bot(bot).build()
 
     # =========================
     # Command handlers
@@ -937,20 +727,25 @@ def build_bot():
     application.add_handler(CommandHandler("open", start))
     application.add_handler(CommandHandler("count", show_link_counts))
     application.add_handler(CommandHandler("unsafe", show_unsafe_users))
-    application.add_handler(CommandHandler("mute", mute_user))
-    application.add_handler(CommandHandler("unmute", unmute_user))
+    application.add_handler(CommandHandler("mute", lazy_handler("bot.moderation_commands", "mute_user")))
+    application.add_handler(CommandHandler("unmute", lazy_handler("bot.moderation_commands", "unmute_user")))
     application.add_handler(CommandHandler("tracking", start_ad))
     application.add_handler(CommandHandler("stop_ad", stop_ad))
+    application.add_handler(CommandHandler("adwords", set_ad_words_command))
     application.add_handler(CommandHandler("mult", multiple_links))
+    application.add_handler(CommandHandler("xwho", shared_x_users))
     application.add_handler(CommandHandler("list", user_list))
     application.add_handler(CommandHandler("count_ad", show_ad_completed))
     application.add_handler(CommandHandler("testlist", show_checklist))
-    application.add_handler(CommandHandler("muteall", mute_all_unsafe_users))
-    application.add_handler(CommandHandler("kick", kick_user))
-    application.add_handler(CommandHandler("l", lock_chat))
+    application.add_handler(CommandHandler("muteall", lazy_handler("bot.moderation_commands", "mute_all_unsafe_users")))
+    application.add_handler(CommandHandler("kick", lazy_handler("bot.moderation_commands", "kick_user")))
+    application.add_handler(CommandHandler("l", lazy_handler("bot.moderation_commands", "lock_chat")))
     application.add_handler(CommandHandler("sr", sr_command))
     application.add_handler(CommandHandler("ad", ad_command))
 
+    # Promotions / demotions invalidate the cached admin list
+    application.add_handler(ChatMemberHandler(track_admin_changes, ChatMemberHandler.ANY_CHAT_MEMBER))
+
     # =========================
     # Message handlers
     # =========================
@@ -968,4 +763,13 @@ def build_bot():
         )
     )
 
+    # Admin commands go ahead of alert digests in their chat
+    prioritize_commands(application, alert_digest)
+
+    # Traces are named after the handler that ran
+    instrument_handlers(application)
+
+    # A handler that raised fails its update (bot/dispatcher.py)
+    application.add_error_handler(handler_failed)
+
     return application
\ No newline at end of file
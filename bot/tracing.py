@@ -0,0 +1,280 @@
+# bot/tracing.py
+"""
+Per-update tracing and Prometheus metrics.
+
+The dispatcher worker opens an UpdateTrace around every processed update
+(trace_update). While it is the current trace, time spent holding a DB
+connection (and waiting for one), Bot API requests (TracedRequest) and the
+handler that ran (instrument_handlers) are added to it; whatever is left
+of the wall time is Python. Finished traces go into the in-process
+`metrics` registry, rendered in the Prometheus text format by GET /metrics.
+
+TRACE_SAMPLE_RATE (0..1) traces only a share of the updates; TRACE_LOG=1
+also prints every trace as one JSON line. Metrics are per process: on
+serverless each instance reports only what it handled itself.
+"""
+import contextvars
+import functools
+import json
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from telegram.request import HTTPXRequest
+
+from db import database
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"
+
+# Histogram buckets, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar("update_trace", default=None)
+
+
+class UpdateTrace:
+    __slots__ = (
+        "update_id", "handler", "queue_lag", "started", "duration", "failed", "done",
+        "db_time", "db_wait", "db_calls", "api_time", "api_calls",
+    )
+
+    def __init__(self, update_id, queue_lag=0.0):
+        self.update_id = update_id
+        self.handler = "unhandled"
+        self.queue_lag = queue_lag
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.failed = False
+        self.done = False
+        self.db_time = 0.0
+        self.db_wait = 0.0
+        self.db_calls = 0
+        self.api_time = 0.0
+        self.api_calls = 0
+
+    @property
+    def python_time(self):
+        # Concurrent awaits inside one handler can make this slightly low
+        return max(0.0, self.duration - self.db_time - self.db_wait - self.api_time)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        self.done = True
+
+    def as_dict(self):
+        return {
+            "update_id": self.update_id,
+            "handler": self.handler,
+            "ok": not self.failed,
+            "total_ms": round(self.duration * 1000, 3),
+            "queue_lag_ms": round(self.queue_lag * 1000, 3),
+            "db_ms": round(self.db_time * 1000, 3),
+            "db_wait_ms": round(self.db_wait * 1000, 3),
+            "db_calls": self.db_calls,
+            "telegram_ms": round(self.api_time * 1000, 3),
+            "telegram_calls": self.api_calls,
+            "python_ms": round(self.python_time * 1000, 3),
+        }
+
+
+def current_trace():
+    trace = _current.get()
+    # Tasks spawned by a handler inherit the context after it finished
+    return trace if trace is not None and not trace.done else None
+
+
+@contextmanager
+def trace_update(update_id, queue_lag=0.0):
+    """Trace the update processed inside the block (None when not sampled)."""
+    if TRACE_SAMPLE_RATE < 1.0 and random.random() >= TRACE_SAMPLE_RATE:
+        yield None
+        return
+
+    trace = UpdateTrace(update_id, queue_lag)
+    token = _current.set(trace)
+    try:
+        yield trace
+    except BaseException:
+        trace.failed = True
+        raise
+    finally:
+        _current.reset(token)
+        trace.finish()
+        metrics.observe(trace)
+        if TRACE_LOG:
+            print(json.dumps(trace.as_dict()))
+
+
+def record_db(wait, held):
+    trace = current_trace()
+    if trace is not None:
+        trace.db_wait += wait
+        trace.db_time += held
+        trace.db_calls += 1
+
+
+database.acquire_observers.append(record_db)
+
+
+def record_api(method, seconds):
+    metrics.observe_api(method, seconds)
+    trace = current_trace()
+    if trace is not None:
+        trace.api_time += seconds
+        trace.api_calls += 1
+
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call (bot constructor `request=`)."""
+
+    __slots__ = ()
+
+    async def do_request(self, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            record_api(url.rsplit("/", 1)[-1], time.perf_counter() - start)
+
+
+def instrument_handlers(application):
+    """Name the current trace after the handler callback that runs."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = _named(handler.callback)
+
+
+def _named(callback):
+    name = getattr(callback, "__name__", "handler")
+
+    @functools.wraps(callback)
+    async def traced(update, context):
+        trace = current_trace()
+        if trace is not None:
+            trace.handler = name
+        return await callback(update, context)
+
+    traced.__name__ = name
+    return traced
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics:
+    def __init__(self):
+        self.updates = Counter()                 # (handler, outcome)
+        self.duration = defaultdict(Histogram)   # handler
+        self.queue_lag = Histogram()
+        self.parts = defaultdict(Counter)        # handler -> db / db_wait / telegram / python seconds
+        self.api_calls = Counter()               # method
+        self.api_seconds = defaultdict(Histogram)  # method
+        self.steps = Counter()                   # (transition, step, outcome)
+        self.step_seconds = defaultdict(Histogram)  # (transition, step)
+
+    def observe(self, trace):
+        handler = trace.handler
+        self.updates[(handler, "error" if trace.failed else "ok")] += 1
+        self.duration[handler].observe(trace.duration)
+        self.queue_lag.observe(trace.queue_lag)
+        parts = self.parts[handler]
+        parts["db"] += trace.db_time
+        parts["db_wait"] += trace.db_wait
+        parts["telegram"] += trace.api_time
+        parts["python"] += trace.python_time
+
+    def observe_api(self, method, seconds):
+        self.api_calls[method] += 1
+        self.api_seconds[method].observe(seconds)
+
+    def observe_step(self, transition, result):
+        """A StepResult of bot/transitions.py."""
+        if result.ok:
+            outcome = "ok"
+        else:
+            outcome = "error" if isinstance(result.error, Exception) else "skipped"
+        self.steps[(transition, result.name, outcome)] += 1
+        if outcome != "skipped":
+            self.step_seconds[(transition, result.name)].observe(result.seconds)
+
+    def render(self, gauges=()):
+        """Prometheus text format. `gauges`: (name, help, value) read at scrape time."""
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, hist, **labels):
+            for bound, count in zip(BUCKETS, hist.counts):
+                lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {count}")
+            lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {hist.count}")
+            lines.append(f"{name}_sum{_labels(**labels)} {hist.sum}")
+            lines.append(f"{name}_count{_labels(**labels)} {hist.count}")
+
+        header("bot_updates_total", "counter", "Traced updates by handler and outcome.")
+        for (handler, outcome), count in sorted(self.updates.items()):
+            lines.append(f"bot_updates_total{_labels(handler=handler, outcome=outcome)} {count}")
+
+        header("bot_update_duration_seconds", "histogram", "Processing time of an update (after the queue).")
+        for handler, hist in sorted(self.duration.items()):
+            histogram("bot_update_duration_seconds", hist, handler=handler)
+
+        header("bot_update_time_seconds_total", "counter", "Where update processing time went: db, db_wait, telegram, python.")
+        for handler, parts in sorted(self.parts.items()):
+            for part in ("db", "db_wait", "telegram", "python"):
+                lines.append(f"bot_update_time_seconds_total{_labels(handler=handler, part=part)} {parts[part]}")
+
+        header("bot_queue_lag_seconds", "histogram", "Time an update waited in its dispatcher shard.")
+        histogram("bot_queue_lag_seconds", self.queue_lag)
+
+        header("bot_telegram_requests_total", "counter", "Bot API requests by method.")
+        for method, count in sorted(self.api_calls.items()):
+            lines.append(f"bot_telegram_requests_total{_labels(method=method)} {count}")
+
+        header("bot_telegram_request_duration_seconds", "histogram", "Bot API request latency by method.")
+        for method, hist in sorted(self.api_seconds.items()):
+            histogram("bot_telegram_request_duration_seconds", hist, method=method)
+
+        header("bot_transition_steps_total", "counter", "Session transition steps by outcome.")
+        for (transition, step, outcome), count in sorted(self.steps.items()):
+            lines.append(f"bot_transition_steps_total{_labels(transition=transition, step=step, outcome=outcome)} {count}")
+
+        header("bot_transition_step_duration_seconds", "histogram", "Duration of a session transition step.")
+        for (transition, step), hist in sorted(self.step_seconds.items()):
+            histogram("bot_transition_step_duration_seconds", hist, transition=transition, step=step)
+
+        for name, help_text, value in gauges:
+            header(name, "gauge", help_text)
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
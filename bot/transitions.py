@@ -0,0 +1,71 @@
+# bot/transitions.py
+"""
+Session transitions (/open, /tracking) as a set of steps run concurrently.
+
+Each Step is an async callable. A step with `after` waits for that step
+and gets its result (e.g. the pin gets the message the reply sent); all
+other steps start at once, so the switch takes about one round trip
+instead of one per call. A failed step is logged and skips the steps
+after it; a failed `required` step is raised once the others are done.
+
+Step timings go into the metrics registry (bot/tracing.py) as
+bot_transition_step_duration_seconds.
+"""
+import asyncio
+import time
+
+from bot.tracing import metrics
+
+
+class Step:
+    __slots__ = ("name", "run", "after", "required")
+
+    def __init__(self, name, run, after=None, required=False):
+        self.name = name
+        self.run = run
+        self.after = after
+        self.required = required
+
+
+class StepResult:
+    __slots__ = ("name", "ok", "value", "error", "seconds")
+
+    def __init__(self, name, ok, value=None, error=None, seconds=0.0):
+        self.name = name
+        self.ok = ok
+        self.value = value
+        self.error = error
+        self.seconds = seconds
+
+
+async def run_transition(transition, steps) -> dict:
+    """Run `steps`; returns {step name: StepResult} in step order."""
+    tasks = {}
+
+    async def run_step(step):
+        args = ()
+        if step.after is not None:
+            before = await tasks[step.after]
+            if not before.ok:
+                return StepResult(step.name, False, error=f"skipped, {step.after} failed")
+            args = (before.value,)
+
+        start = time.perf_counter()
+        try:
+            value = await step.run(*args)
+        except Exception as e:
+            print(f"⚠️ {transition}: {step.name} failed:", e)
+            return StepResult(step.name, False, error=e, seconds=time.perf_counter() - start)
+        return StepResult(step.name, True, value, seconds=time.perf_counter() - start)
+
+    for step in steps:
+        tasks[step.name] = asyncio.ensure_future(run_step(step))
+    results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+
+    for result in results.values():
+        metrics.observe_step(transition, result)
+    for step in steps:
+        error = results[step.name].error
+        if step.required and isinstance(error, Exception):
+            raise error
+    return results
@@ -0,0 +1,125 @@
+# bot/urls.py
+"""
+URL normalization for shared links.
+
+parse_url() turns any variant of a link into one canonical form, so the
+same post shared as twitter.com / mobile.twitter.com / vxtwitter.com /
+x.com?s=20 is stored and deduplicated once. Only http(s) links are
+rewritten; other schemes (tg://...) are kept as sent. For X links it also extracts
+the profile handle and the status id. Results are memoized on the raw URL
+(people share the same timeline posts over and over).
+"""
+import os
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+URL_CACHE_SIZE = int(os.getenv("URL_CACHE_SIZE", "4096"))
+
+X_CANONICAL_HOST = "x.com"
+# Hosts (after dropping "www.") that serve X profiles / posts
+X_HOSTS = {
+    "x.com",
+    "twitter.com",
+    "mobile.x.com",
+    "mobile.twitter.com",
+    # embed-fixing mirrors, same paths as x.com
+    "vxtwitter.com",
+    "fxtwitter.com",
+    "fixupx.com",
+    "fixvx.com",
+}
+
+# First path segments that are X pages, not profiles
+NOT_HANDLES = {
+    "", "i", "status", "home", "intent", "share", "search", "hashtag",
+    "explore", "notifications", "messages", "settings", "login", "signup",
+}
+HANDLE_RE = re.compile(r"[a-z0-9_]{1,15}")
+STATUS_ID_RE = re.compile(r"\d{1,25}")
+
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = {"fbclid", "gclid", "igshid", "si", "ref_src", "ref_url"}
+TRACKING_PREFIXES = ("utm_",)
+
+
+class ParsedUrl(NamedTuple):
+    canonical: str                 # https://host/path?query, no tracking params
+    host: str                      # canonical host, e.g. "x.com"
+    handle: Optional[str] = None   # X profile handle, lowercase
+    status_id: Optional[str] = None
+
+    @property
+    def is_x(self):
+        return self.host == X_CANONICAL_HOST
+
+
+def _is_tracking(key):
+    key = key.lower()
+    return key in TRACKING_PARAMS or key.startswith(TRACKING_PREFIXES)
+
+
+def _canonical_host(host):
+    host = host.lower().rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    return X_CANONICAL_HOST if host in X_HOSTS else host
+
+
+def _parse_x_path(segments):
+    """(handle, status_id, canonical path) for an x.com path."""
+    first = segments[0].lower() if segments else ""
+
+    # x.com/i/status/<id>, x.com/i/web/status/<id>
+    if first == "i":
+        rest = [s.lower() for s in segments[1:]]
+        if rest[:1] == ["web"]:
+            rest = rest[1:]
+        if len(rest) >= 2 and rest[0] == "status" and STATUS_ID_RE.fullmatch(rest[1]):
+            return None, rest[1], f"/i/status/{rest[1]}"
+        return None, None, "/" + "/".join(segments)
+
+    if first in NOT_HANDLES or not HANDLE_RE.fullmatch(first):
+        return None, None, "/" + "/".join(segments)
+
+    # x.com/<handle>/status(es)/<id>[/photo/1 ...] → the post itself
+    if len(segments) >= 3 and segments[1].lower() in ("status", "statuses") and STATUS_ID_RE.fullmatch(segments[2]):
+        return first, segments[2], f"/{first}/status/{segments[2]}"
+
+    # Profile (tabs like /likes or /media count as the profile)
+    return first, None, f"/{first}"
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def parse_url(raw) -> ParsedUrl:
+    """Canonical form of `raw` (a URL as typed, scheme optional)."""
+    text = raw.strip()
+    try:
+        parts = urlsplit(text if "://" in text else "https://" + text)
+        host = parts.hostname or ""
+        port = parts.port
+    except ValueError:
+        # Not parseable as a URL: keep it as is
+        return ParsedUrl(text, "")
+
+    if parts.scheme.lower() not in ("http", "https"):
+        # tg://, ftp://...: nothing to canonicalize, and no https equivalent
+        return ParsedUrl(text, "")
+
+    host = _canonical_host(host)
+    segments = [s for s in parts.path.split("/") if s]
+
+    if host == X_CANONICAL_HOST:
+        # Every query parameter on an X link is share tracking
+        handle, status_id, path = _parse_x_path(segments)
+        return ParsedUrl(f"https://{host}{path}", host, handle, status_id)
+
+    netloc = host if port in (None, 80, 443) else f"{host}:{port}"
+    path = "/" + "/".join(segments) if segments else ""
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _is_tracking(k)])
+    return ParsedUrl(urlunsplit((parts.scheme.lower(), netloc, path, query, "")), host)
+
+
+def canonical_url(raw):
+    return parse_url(raw).canonical
@@ -0,0 +1,41 @@
+# bot/x_index.py
+from bot.urls import parse_url
+
+
+def normalize_x_username(value):
+    """Key for comparing X usernames: case-insensitive, no "@", and any X
+    profile / post URL (see bot/urls.py) reduced to the handle. Other URLs
+    reduce to their canonical form without the scheme."""
+    if not value:
+        return None
+
+    value = value.strip().lower()
+
+    if "/" not in value:
+        return value.lstrip("@") or None
+
+    parsed = parse_url(value)
+    if parsed.handle:
+        return parsed.handle
+    return parsed.canonical.split("://", 1)[-1]
+
+
+class XUsernameIndex:
+    """normalized X username → Telegram user ids that gave it."""
+
+    def __init__(self):
+        self._ids = {}
+
+    def clear(self):
+        self._ids.clear()
+
+    def add(self, user_id, x_username):
+        key = normalize_x_username(x_username)
+        if key:
+            self._ids.setdefault(key, set()).add(user_id)
+
+    def users_for(self, x_username):
+        return self._ids.get(normalize_x_username(x_username), set())
+
+    def is_shared(self, x_username):
+        return len(self.users_for(x_username)) > 1
@@ -1,39 +1,132 @@
 # db/database.py
+import asyncio
 import asyncpg
 import os
+import time
+from contextlib import asynccontextmanager
+
+from db.migrations import DB_MIGRATE, prepare_schema
 
 pool = None
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# asyncpg ssl mode; "disable" for a local Postgres without TLS
+DB_SSL = os.getenv("DB_SSL", "require")
+
+# Pool sizing / tuning
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Prepared statements kept per connection. asyncpg prepares every query text
+# once per connection and reuses it, so the bot's fixed queries are only
+# parsed/planned on first use. Set to 0 behind pgbouncer in transaction mode.
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_STATEMENT_LIFETIME = float(os.getenv("DB_STATEMENT_LIFETIME", "0"))  # 0 = never expire
+DB_IDLE_LIFETIME = float(os.getenv("DB_IDLE_LIFETIME", "300"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+
+_init_lock = asyncio.Lock()
+
+# Acquire statistics (see pool_stats)
+_waiters = 0
+_acquires = 0
+_acquire_time_total = 0.0
+_acquire_time_max = 0.0
+
+# Called with (wait_seconds, held_seconds) after every acquire (bot/tracing.py)
+acquire_observers = []
+
 
 async def init_db():
     global pool
-    if pool is None:
-        pool = await asyncpg.create_pool(
-            dsn=DATABASE_URL,
-            ssl="require",
-            min_size=1,
-            max_size=1,
-            timeout=10,
-        )
-
-async def ensure_db():
-    if pool is None:
-        await init_db()
+    if pool is not None:
+        return pool
+
+    async with _init_lock:
+        if pool is None:
+            new_pool = await asyncpg.create_pool(
+                dsn=DATABASE_URL,
+                ssl=DB_SSL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                max_cached_statement_lifetime=DB_STATEMENT_LIFETIME,
+                max_inactive_connection_lifetime=DB_IDLE_LIFETIME,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                timeout=DB_CONNECT_TIMEOUT,
+            )
+            if DB_MIGRATE:
+                # Schema behind the code: fail every request (Telegram
+                # retries) instead of running queries it can't answer
+                try:
+                    async with new_pool.acquire() as con:
+                        await prepare_schema(con)
+                except Exception as e:
+                    print("❌ Database schema not ready:", e)
+                    await new_pool.close()
+                    raise
+            pool = new_pool
+    return pool
+
+async def close_db():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+@asynccontextmanager
+async def acquire():
+    global _waiters, _acquires, _acquire_time_total, _acquire_time_max
+
+    db = pool or await init_db()
+
+    _waiters += 1
+    start = time.perf_counter()
+    try:
+        con = await db.acquire()
+    finally:
+        _waiters -= 1
+
+    waited = time.perf_counter() - start
+    _acquires += 1
+    _acquire_time_total += waited
+    _acquire_time_max = max(_acquire_time_max, waited)
+
+    held_from = time.perf_counter()
+    try:
+        yield con
+    finally:
+        await db.release(con)
+        held = time.perf_counter() - held_from
+        for observer in acquire_observers:
+            observer(waited, held)
+
+
+def pool_stats():
+    """Snapshot of pool usage: connections in use / idle, waiters and acquire latency."""
+    size = pool.get_size() if pool is not None else 0
+    idle = pool.get_idle_size() if pool is not None else 0
+    return {
+        "size": size,
+        "max_size": max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+        "in_use": size - idle,
+        "idle": idle,
+        "waiters": _waiters,
+        "acquires": _acquires,
+        "acquire_avg_ms": round(_acquire_time_total / _acquires * 1000, 3) if _acquires else 0.0,
+        "acquire_max_ms": round(_acquire_time_max * 1000, 3),
+    }
+
 
 async def fetchrow(query: str, *args):
-    await ensure_db()
-    async with pool.acquire() as con:
+    async with acquire() as con:
         return await con.fetchrow(query, *args)
 
 async def execute(query, *args):
-    await ensure_db()
-    async with pool.acquire() as con:
+    async with acquire() as con:
         return await con.execute(query, *args)
 
 async def fetch(query, *args):
-    await ensure_db()
-    async with pool.acquire() as con:
+    async with acquire() as con:
         return await con.fetch(query, *args)
-    
-
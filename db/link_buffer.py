@@ -0,0 +1,142 @@
+# db/link_buffer.py
+import asyncio
+import os
+
+from db.database import fetch
+
+# Flush as soon as this many links are pending...
+LINK_FLUSH_SIZE = int(os.getenv("LINK_FLUSH_SIZE", "200"))
+# ...or this many seconds after the first pending link (0 = flush inline).
+# Only raise it on a long-running server (see WEBHOOK_ASYNC): a serverless
+# instance may be frozen or recycled right after the response, and buffered
+# links are invisible to other instances until flushed.
+LINK_FLUSH_INTERVAL = float(os.getenv("LINK_FLUSH_INTERVAL", "0"))
+
+
+# One round trip per batch: bump each touched chat's state version (which
+# also yields its current session_id), aggregate the batch per user, upsert
+# the users of that session (in first-seen order, so users.id follows
+# arrival order) and insert every link against the returned ids.
+FLUSH_LINKS_SQL = """
+WITH batch AS (
+    SELECT *
+    FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::text[], $6::text[])
+        WITH ORDINALITY AS b(chat_id, tg_user_id, username, full_name, x_username, url, ord)
+),
+sessions AS (
+    INSERT INTO sessionsdata (chat_id, tracking_enabled, version)
+    SELECT DISTINCT chat_id, false, 1 FROM batch
+    ON CONFLICT (chat_id)
+    DO UPDATE SET version = sessionsdata.version + 1
+    RETURNING chat_id, session_id, version
+),
+per_user AS (
+    SELECT
+        chat_id,
+        tg_user_id,
+        (array_agg(username ORDER BY ord))[1] AS username,
+        (array_agg(full_name ORDER BY ord))[1] AS full_name,
+        (array_agg(x_username ORDER BY ord) FILTER (WHERE x_username IS NOT NULL))[1] AS x_username,
+        count(*) AS link_count,
+        min(ord) AS first_ord
+    FROM batch
+    GROUP BY chat_id, tg_user_id
+),
+upserted AS (
+    INSERT INTO users (chat_id, session_id, tg_user_id, username, full_name, x_username, link_count)
+    SELECT p.chat_id, s.session_id, p.tg_user_id, p.username, p.full_name, p.x_username, p.link_count
+    FROM per_user p
+    JOIN sessions s USING (chat_id)
+    ORDER BY p.first_ord
+    ON CONFLICT (session_id, tg_user_id)
+    DO UPDATE SET
+        link_count = users.link_count + EXCLUDED.link_count,
+        x_username = COALESCE(users.x_username, EXCLUDED.x_username)
+    RETURNING id, chat_id, session_id, tg_user_id
+),
+inserted AS (
+    INSERT INTO links (session_id, user_id, url)
+    SELECT upserted.session_id, upserted.id, batch.url
+    FROM batch
+    JOIN upserted USING (chat_id, tg_user_id)
+    ORDER BY batch.ord
+)
+SELECT chat_id, version FROM sessions
+"""
+
+
+class LinkWriteBuffer:
+    """Write-behind queue for the users upsert + links insert of count_links."""
+
+    def __init__(self, flush_size=LINK_FLUSH_SIZE, flush_interval=LINK_FLUSH_INTERVAL):
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._flush_lock = asyncio.Lock()
+        self._timer = None
+        self._tasks = set()
+        # Called with (chat_id, version) for every chat a flush touched
+        self.version_listeners = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def add(self, chat_id, tg_user_id, username, full_name, x_username, url):
+        self._pending.append((chat_id, tg_user_id, username, full_name, x_username, url))
+
+        if self.flush_interval <= 0 or len(self._pending) >= self.flush_size:
+            # Full batch (or buffering disabled) → flush now, which also
+            # applies backpressure to the handler producing the links
+            await self.flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._flush_in_background)
+
+    def _flush_in_background(self):
+        self._timer = None
+        task = asyncio.ensure_future(self._background_flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _background_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            # Already logged; try again on the next interval
+            if self._pending and self._timer is None:
+                loop = asyncio.get_running_loop()
+                self._timer = loop.call_later(self.flush_interval, self._flush_in_background)
+
+    async def flush(self):
+        """Write everything pending. Safe to call concurrently."""
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            if not self._pending:
+                return
+
+            batch, self._pending = self._pending, []
+            columns = list(zip(*batch))
+
+            try:
+                rows = await fetch(FLUSH_LINKS_SQL, *columns)
+            except Exception as e:
+                print("❌ Link flush failed, will retry:", e)
+                # Keep arrival order: failed batch goes back in front
+                self._pending[:0] = batch
+                raise
+
+            for row in rows:
+                for listener in self.version_listeners:
+                    listener(row["chat_id"], row["version"])
+
+    async def close(self):
+        """Flush on shutdown and wait for any background flush."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+
+link_buffer = LinkWriteBuffer()
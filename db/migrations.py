@@ -0,0 +1,380 @@
+# db/migrations.py
+"""
+Versioned schema for the bot's tables.
+
+MIGRATIONS is an append-only list of (version, name, sql); schema_migrations
+records what a database already has. migrate() applies the missing ones in
+order, each in its own transaction, under an advisory lock so concurrent
+cold starts don't race. Statements use IF NOT EXISTS, so databases that
+were set up by hand are adopted as they are.
+
+Migrations in OFFLINE_MIGRATIONS rewrite or index whole tables. Once
+those tables hold rows they only run by hand, on a connection without the
+pool's command timeout:
+
+    python -m db.migrations            # apply pending migrations
+    python -m db.migrations --check    # only report missing indexes
+
+At startup (DB_MIGRATE=1) init_db() calls prepare_schema(): pending
+migrations are applied up to the first offline one whose tables are not
+empty, then the bot refuses to serve (SchemaBehind) if the database is
+still behind the code. A new deployment on an empty database therefore
+needs no manual step; an existing one logs the command to run.
+"""
+import os
+
+# Run migrations / the index check when the pool is created
+DB_MIGRATE = os.getenv("DB_MIGRATE", "1") == "1"
+
+# Whole-table index builds and data migrations: too slow for a cold start
+# (and its command timeout), python -m db.migrations only, unless the
+# listed tables are still empty
+OFFLINE_MIGRATIONS = {
+    3: ("users",),
+    4: ("users", "links"),
+}
+
+# Arbitrary constant for pg_advisory_xact_lock
+MIGRATION_LOCK_ID = 7_301_417
+
+MIGRATIONS = [
+    (1, "base tables", """
+        CREATE TABLE IF NOT EXISTS users (
+            id          bigserial PRIMARY KEY,
+            chat_id     bigint NOT NULL,
+            tg_user_id  bigint NOT NULL,
+            username    text,
+            full_name   text,
+            x_username  text,
+            link_count  integer NOT NULL DEFAULT 0,
+            ad_count    integer NOT NULL DEFAULT 0,
+            status      text NOT NULL DEFAULT 'unsafe'
+        );
+
+        CREATE TABLE IF NOT EXISTS links (
+            id       bigserial PRIMARY KEY,
+            user_id  bigint NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            url      text NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS sessionsdata (
+            chat_id           bigint PRIMARY KEY,
+            tracking_enabled  boolean NOT NULL DEFAULT false,
+            start_time        timestamptz DEFAULT NOW(),
+            end_time          timestamptz
+        );
+
+        -- Columns added after the first deployments
+        ALTER TABLE sessionsdata
+            ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS ad_words text[];
+    """),
+    (2, "moderation jobs and processed updates", """
+        CREATE TABLE IF NOT EXISTS moderation_jobs (
+            id          bigserial PRIMARY KEY,
+            chat_id     bigint NOT NULL,
+            action      text NOT NULL,
+            until_date  timestamptz,
+            user_ids    bigint[] NOT NULL,
+            done        bigint[] NOT NULL DEFAULT '{}',
+            failed      bigint[] NOT NULL DEFAULT '{}',
+            created_at  timestamptz NOT NULL DEFAULT NOW(),
+            finished_at timestamptz
+        );
+
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id bigint PRIMARY KEY,
+            seen_at   timestamptz NOT NULL DEFAULT NOW()
+        );
+    """),
+    (3, "indexes for the handlers' queries", """
+        -- ON CONFLICT (chat_id, tg_user_id) of the link flush; also every
+        -- WHERE chat_id = $1 [AND tg_user_id = ...] lookup
+        CREATE UNIQUE INDEX IF NOT EXISTS users_chat_user_key
+            ON users (chat_id, tg_user_id);
+
+        -- (links_user_id_idx used to be built here; migration 4 rebuilds
+        -- links with links_session_user_idx, so it was wasted work)
+
+        -- Unsafe-by-chat (close_session, /unsafe, /muteall), in srno order
+        CREATE INDEX IF NOT EXISTS users_unsafe_by_chat_idx
+            ON users (chat_id, id) INCLUDE (tg_user_id)
+            WHERE status IS DISTINCT FROM 'safe';
+
+        -- Safe count per chat
+        CREATE INDEX IF NOT EXISTS users_safe_by_chat_idx
+            ON users (chat_id) INCLUDE (tg_user_id)
+            WHERE status = 'safe';
+
+        -- Duplicate X usernames within a chat
+        CREATE INDEX IF NOT EXISTS users_x_username_by_chat_idx
+            ON users (chat_id, lower(x_username)) INCLUDE (tg_user_id)
+            WHERE x_username IS NOT NULL;
+
+        -- Open job lookup when a bulk action resumes
+        CREATE INDEX IF NOT EXISTS moderation_jobs_open_idx
+            ON moderation_jobs (chat_id, action, id DESC)
+            WHERE finished_at IS NULL;
+
+        -- Hourly prune of processed_updates
+        CREATE INDEX IF NOT EXISTS processed_updates_seen_at_idx
+            ON processed_updates (seen_at);
+    """),
+    (4, "session-scoped users, partitioned links, session archive", """
+        -- Every /open starts a new session id; users and links belong to one
+        CREATE SEQUENCE IF NOT EXISTS chat_session_id_seq;
+
+        ALTER TABLE sessionsdata
+            ADD COLUMN IF NOT EXISTS session_id bigint NOT NULL DEFAULT nextval('chat_session_id_seq');
+        CREATE UNIQUE INDEX IF NOT EXISTS sessionsdata_session_id_key ON sessionsdata (session_id);
+
+        -- Closed sessions; db/retention.py fills in the rollup columns
+        CREATE TABLE IF NOT EXISTS session_archive (
+            session_id    bigint PRIMARY KEY,
+            chat_id       bigint NOT NULL,
+            started_at    timestamptz,
+            ended_at      timestamptz NOT NULL DEFAULT NOW(),
+            rolled_up_at  timestamptz,
+            user_count    integer,
+            safe_count    integer,
+            unsafe_count  integer,
+            link_count    integer,
+            unique_links  integer
+        );
+        CREATE INDEX IF NOT EXISTS session_archive_pending_idx
+            ON session_archive (session_id) WHERE rolled_up_at IS NULL;
+
+        -- users: one row per (session, Telegram user)
+        INSERT INTO sessionsdata (chat_id)
+        SELECT DISTINCT chat_id FROM users
+        ON CONFLICT (chat_id) DO NOTHING;
+
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS session_id bigint;
+        UPDATE users u
+        SET session_id = s.session_id
+        FROM sessionsdata s
+        WHERE s.chat_id = u.chat_id AND u.session_id IS NULL;
+        ALTER TABLE users ALTER COLUMN session_id SET NOT NULL;
+
+        -- Per-chat uniqueness (ours or hand made) would block a user's
+        -- second session
+        DO $$
+        DECLARE r record;
+        BEGIN
+            FOR r IN
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = 'users'::regclass AND contype = 'u'
+                  AND pg_get_constraintdef(oid) = 'UNIQUE (chat_id, tg_user_id)'
+            LOOP
+                EXECUTE format('ALTER TABLE users DROP CONSTRAINT %I', r.conname);
+            END LOOP;
+            FOR r IN
+                SELECT indexname FROM pg_indexes
+                WHERE schemaname = current_schema() AND tablename = 'users'
+                  AND indexdef LIKE 'CREATE UNIQUE INDEX % USING btree (chat_id, tg_user_id)'
+            LOOP
+                EXECUTE format('DROP INDEX %I', r.indexname);
+            END LOOP;
+        END $$;
+
+        DROP INDEX IF EXISTS users_unsafe_by_chat_idx;
+        DROP INDEX IF EXISTS users_safe_by_chat_idx;
+        DROP INDEX IF EXISTS users_x_username_by_chat_idx;
+
+        CREATE UNIQUE INDEX IF NOT EXISTS users_session_user_key
+            ON users (session_id, tg_user_id);
+        CREATE INDEX IF NOT EXISTS users_unsafe_by_session_idx
+            ON users (session_id, id) INCLUDE (tg_user_id)
+            WHERE status IS DISTINCT FROM 'safe';
+        CREATE INDEX IF NOT EXISTS users_safe_by_session_idx
+            ON users (session_id) INCLUDE (tg_user_id)
+            WHERE status = 'safe';
+        CREATE INDEX IF NOT EXISTS users_x_username_by_session_idx
+            ON users (session_id, lower(x_username)) INCLUDE (tg_user_id)
+            WHERE x_username IS NOT NULL;
+
+        -- links: range partitioned by month, rows outside every month
+        -- partition land in links_default
+        ALTER TABLE links RENAME TO links_legacy;
+
+        CREATE TABLE links (
+            id          bigserial,
+            session_id  bigint NOT NULL,
+            user_id     bigint NOT NULL,
+            url         text NOT NULL,
+            created_at  timestamptz NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        CREATE TABLE links_default PARTITION OF links DEFAULT;
+
+        -- Session load: one session's links per user in id order, url from the index
+        CREATE INDEX links_session_user_idx ON links (session_id, user_id, id) INCLUDE (url);
+
+        -- links_YYYY_MM for the month of `month`; rows of that month that
+        -- already landed in links_default are moved into it
+        CREATE OR REPLACE FUNCTION ensure_links_partition(month date) RETURNS text
+        LANGUAGE plpgsql AS $fn$
+        DECLARE
+            lower_bound date := date_trunc('month', month)::date;
+            upper_bound date := (date_trunc('month', month) + interval '1 month')::date;
+            name text := format('links_%s', to_char(lower_bound, 'YYYY_MM'));
+        BEGIN
+            IF to_regclass(name) IS NOT NULL THEN
+                RETURN name;
+            END IF;
+            EXECUTE format('CREATE TABLE %I (LIKE links INCLUDING DEFAULTS)', name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM links_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved', lower_bound, upper_bound, name);
+            EXECUTE format(
+                'ALTER TABLE links ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                name, lower_bound, upper_bound);
+            RETURN name;
+        END
+        $fn$;
+
+        SELECT ensure_links_partition(CURRENT_DATE);
+        SELECT ensure_links_partition((CURRENT_DATE + interval '1 month')::date);
+
+        INSERT INTO links (id, session_id, user_id, url)
+        SELECT l.id, u.session_id, l.user_id, l.url
+        FROM links_legacy l
+        JOIN users u ON u.id = l.user_id;
+        SELECT setval(pg_get_serial_sequence('links', 'id'), COALESCE(max(id), 0) + 1, false) FROM links;
+
+        DROP TABLE links_legacy;
+    """),
+    (5, "in-progress update claims", """
+        -- Rows from before this migration were all processed
+        ALTER TABLE processed_updates
+            ADD COLUMN IF NOT EXISTS done boolean NOT NULL DEFAULT true,
+            ADD COLUMN IF NOT EXISTS claimed_until timestamptz;
+    """),
+    (6, "moderation jobs per session", """
+        -- Jobs from before this migration have no session and are never resumed
+        ALTER TABLE moderation_jobs ADD COLUMN IF NOT EXISTS session_id bigint;
+    """),
+]
+
+# (table, index) pairs the query paths depend on; see check_indexes()
+REQUIRED_INDEXES = [
+    ("sessionsdata", "sessionsdata_session_id_key"),
+    ("users", "users_session_user_key"),
+    ("users", "users_unsafe_by_session_idx"),
+    ("users", "users_safe_by_session_idx"),
+    ("users", "users_x_username_by_session_idx"),
+    ("links", "links_session_user_idx"),
+    ("session_archive", "session_archive_pending_idx"),
+    ("moderation_jobs", "moderation_jobs_open_idx"),
+    ("processed_updates", "processed_updates_seen_at_idx"),
+]
+
+CREATE_MIGRATIONS_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version    integer PRIMARY KEY,
+    name       text NOT NULL,
+    applied_at timestamptz NOT NULL DEFAULT NOW()
+)
+"""
+
+EXISTING_INDEXES_SQL = """
+SELECT tablename, indexname
+FROM pg_indexes
+WHERE schemaname = current_schema()
+"""
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+async def applied_version(con):
+    await con.execute(CREATE_MIGRATIONS_SQL)
+    return await con.fetchval("SELECT COALESCE(max(version), 0) FROM schema_migrations")
+
+
+class SchemaBehind(RuntimeError):
+    pass
+
+
+async def migrate(con, online_only=False) -> list:
+    """Apply pending migrations on `con`; returns the versions applied.
+
+    online_only: stop before the first pending OFFLINE_MIGRATIONS entry
+    whose tables hold rows."""
+    current = await applied_version(con)
+    if current >= latest_version():
+        return []
+
+    applied = []
+    for version, name, sql in MIGRATIONS:
+        async with con.transaction():
+            await con.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+            # Re-check under the lock: another instance may have been first
+            done = await con.fetchval("SELECT 1 FROM schema_migrations WHERE version = $1", version)
+            if done:
+                continue
+            if online_only and version in OFFLINE_MIGRATIONS:
+                if not await _tables_empty(con, OFFLINE_MIGRATIONS[version]):
+                    break
+            await con.execute(sql)
+            await con.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name
+            )
+            applied.append(version)
+            print(f"✅ Applied migration {version}: {name}")
+    return applied
+
+
+async def _tables_empty(con, tables):
+    # Nothing to copy or index: fast enough for a cold start
+    for table in tables:
+        if await con.fetchval(f"SELECT EXISTS (SELECT 1 FROM {table})"):
+            return False
+    return True
+
+
+async def prepare_schema(con):
+    """Startup: online migrations, then refuse to run against an older schema."""
+    await migrate(con, online_only=True)
+    version = await applied_version(con)
+    if version < latest_version():
+        raise SchemaBehind(
+            f"database schema is at version {version}, the bot needs {latest_version()}"
+            " (run: python -m db.migrations)"
+        )
+    await check_indexes(con)
+
+
+async def check_indexes(con) -> list:
+    """(table, index) pairs from REQUIRED_INDEXES that the database lacks."""
+    existing = {(row["tablename"], row["indexname"]) for row in await con.fetch(EXISTING_INDEXES_SQL)}
+    missing = [pair for pair in REQUIRED_INDEXES if pair not in existing]
+    for table, index in missing:
+        print(f"⚠️ Missing index {index} on {table} (run: python -m db.migrations)")
+    return missing
+
+
+async def _main(check_only):
+    import asyncpg
+
+    from db.database import DATABASE_URL, DB_SSL
+
+    # Own connection: data migrations outlast the pool's command_timeout
+    con = await asyncpg.connect(dsn=DATABASE_URL, ssl=DB_SSL, command_timeout=None)
+    try:
+        if not check_only:
+            applied = await migrate(con)
+            if not applied:
+                print("Schema is up to date.")
+        missing = await check_indexes(con)
+    finally:
+        await con.close()
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+
+    sys.exit(asyncio.run(_main("--check" in sys.argv)))
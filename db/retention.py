@@ -0,0 +1,175 @@
+# db/retention.py
+"""
+Retention for session data (schema: db/migrations.py, migration 4).
+
+/open archives the chat's session into session_archive and starts a new
+session id; the old users / links rows stay until this job:
+
+1. rolls archived sessions up into their session_archive row (user, safe,
+   unsafe, link and unique link counts) and deletes their users rows,
+2. keeps a links partition for this month and the next,
+3. drops whole links_YYYY_MM partitions that ended more than
+   LINK_RETENTION_DAYS ago (DROP TABLE, no row-by-row DELETE), unless a
+   session that is still open has links in one.
+
+It runs in the background at most every RETENTION_INTERVAL seconds (kicked
+off by /open), or by hand:
+
+    python -m db.retention
+"""
+import asyncio
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from db.database import acquire
+
+LINK_RETENTION_DAYS = int(os.getenv("LINK_RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "21600"))
+# Archived sessions rolled up per statement
+ROLLUP_BATCH = int(os.getenv("ROLLUP_BATCH", "100"))
+
+ROLLUP_SQL = """
+WITH pending AS (
+    SELECT session_id
+    FROM session_archive
+    WHERE rolled_up_at IS NULL
+    ORDER BY session_id
+    LIMIT $1
+),
+user_stats AS (
+    SELECT
+        u.session_id,
+        count(*) AS user_count,
+        count(*) FILTER (WHERE u.status = 'safe') AS safe_count,
+        COALESCE(sum(u.link_count), 0) AS link_count
+    FROM users u
+    JOIN pending USING (session_id)
+    GROUP BY u.session_id
+),
+link_stats AS (
+    SELECT l.session_id, count(DISTINCT l.url) AS unique_links
+    FROM links l
+    JOIN pending USING (session_id)
+    GROUP BY l.session_id
+),
+rolled AS (
+    UPDATE session_archive a
+    SET rolled_up_at = NOW(),
+        user_count = COALESCE(us.user_count, 0),
+        safe_count = COALESCE(us.safe_count, 0),
+        unsafe_count = COALESCE(us.user_count - us.safe_count, 0),
+        link_count = COALESCE(us.link_count, 0),
+        unique_links = COALESCE(ls.unique_links, 0)
+    FROM pending p
+    LEFT JOIN user_stats us USING (session_id)
+    LEFT JOIN link_stats ls USING (session_id)
+    WHERE a.session_id = p.session_id
+    RETURNING a.session_id
+),
+dropped AS (
+    DELETE FROM users WHERE session_id IN (SELECT session_id FROM rolled)
+)
+SELECT count(*) FROM rolled
+"""
+
+PARTITIONS_SQL = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'links'::regclass
+"""
+
+# A partition still holding links of a session that is open right now
+OPEN_SESSION_LINKS_SQL = """
+SELECT 1 FROM {partition} l
+JOIN sessionsdata s USING (session_id)
+LIMIT 1
+"""
+
+_last_run = 0.0
+_task = None
+
+
+def _partition_month(name):
+    """date of the first day of links_YYYY_MM's month, None for other tables."""
+    try:
+        year, month = name.removeprefix("links_").split("_")
+        return date(int(year), int(month), 1)
+    except ValueError:
+        return None
+
+
+def _next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+async def rollup_sessions(con) -> int:
+    total = 0
+    while True:
+        rolled = await con.fetchval(ROLLUP_SQL, ROLLUP_BATCH)
+        total += rolled
+        if rolled < ROLLUP_BATCH:
+            return total
+
+
+async def ensure_partitions(con):
+    today = datetime.now(timezone.utc).date()
+    for month in (today, _next_month(today)):
+        await con.execute("SELECT ensure_links_partition($1)", month)
+
+
+async def drop_expired_partitions(con) -> list:
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=LINK_RETENTION_DAYS)
+    dropped = []
+    for row in await con.fetch(PARTITIONS_SQL):
+        name = row["relname"]
+        month = _partition_month(name)
+        if month is None or _next_month(month) > cutoff:
+            continue
+        if await con.fetchval(OPEN_SESSION_LINKS_SQL.format(partition=name)):
+            print(f"⚠️ Keeping {name}: an open session still has links in it")
+            continue
+        await con.execute(f"DROP TABLE {name}")
+        dropped.append(name)
+    return dropped
+
+
+async def run_retention() -> dict:
+    async with acquire() as con:
+        rolled = await rollup_sessions(con)
+        await ensure_partitions(con)
+        dropped = await drop_expired_partitions(con)
+    return {"rolled_up_sessions": rolled, "dropped_partitions": dropped}
+
+
+def maybe_run_retention():
+    """Start run_retention() in the background if it is due."""
+    global _last_run, _task
+    now = time.monotonic()
+    if _last_run and now - _last_run < RETENTION_INTERVAL:
+        return
+    if _task and not _task.done():
+        return
+    _last_run = now
+    _task = asyncio.ensure_future(_run_in_background())
+
+
+async def _run_in_background():
+    try:
+        await run_retention()
+    except Exception as e:
+        print("⚠️ Retention run failed:", e)
+
+
+async def _main():
+    from db.database import close_db
+
+    try:
+        print(await run_retention())
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,7 @@
+# tests/conftest.py
+import os
+
+# Offline bot: cached identity (no getMe), no DB pre-warm
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("BOT_USERNAME", "test_bot")
+os.environ.setdefault("DB_PREWARM", "0")
@@ -0,0 +1,36 @@
+# tests/test_dedup.py
+import asyncio
+
+from bot.dedup import UpdateDeduplicator
+
+
+def test_redelivery_is_dropped_while_in_progress_and_once_done():
+    async def run():
+        dedup = UpdateDeduplicator(use_db=False)
+        first = await dedup.claim(1)
+        during = await dedup.claim(1)
+        await dedup.finish(1)
+        after = await dedup.claim(1)
+        return first, during, after
+
+    assert asyncio.run(run()) == (True, False, False)
+
+
+def test_redelivery_goes_through_after_a_failure():
+    async def run():
+        dedup = UpdateDeduplicator(use_db=False)
+        await dedup.claim(1)
+        await dedup.forget(1)
+        return await dedup.claim(1)
+
+    assert asyncio.run(run()) is True
+
+
+def test_expired_claim_is_taken_over():
+    async def run():
+        # The first attempt never finished (timed out, instance recycled)
+        dedup = UpdateDeduplicator(use_db=False, claim_ttl=0)
+        await dedup.claim(1)
+        return await dedup.claim(1)
+
+    assert asyncio.run(run()) is True
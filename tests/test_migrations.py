@@ -0,0 +1,53 @@
+# tests/test_migrations.py
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from db import migrations
+
+
+class FakeConnection:
+    """schema_migrations in a set; `rows` says which tables hold data."""
+
+    def __init__(self, applied=(), rows=()):
+        self.applied = set(applied)
+        self.rows = set(rows)
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, query, *args):
+        if query.startswith("INSERT INTO schema_migrations"):
+            self.applied.add(args[0])
+
+    async def fetchval(self, query, *args):
+        if "max(version)" in query:
+            return max(self.applied, default=0)
+        if "FROM schema_migrations WHERE version" in query:
+            return 1 if args[0] in self.applied else None
+        if query.startswith("SELECT EXISTS"):
+            return any(f"FROM {table})" in query for table in self.rows)
+        raise AssertionError(query)
+
+    async def fetch(self, query, *args):
+        return [{"tablename": table, "indexname": index} for table, index in migrations.REQUIRED_INDEXES]
+
+
+def test_new_database_is_migrated_at_startup():
+    con = FakeConnection()
+    asyncio.run(migrations.prepare_schema(con))
+    assert max(con.applied) == migrations.latest_version()
+
+
+def test_data_migrations_wait_for_the_cli_once_there_is_data():
+    con = FakeConnection(applied={1, 2}, rows={"users", "links"})
+    with pytest.raises(migrations.SchemaBehind):
+        asyncio.run(migrations.prepare_schema(con))
+    assert con.applied == {1, 2}
+
+    # python -m db.migrations
+    asyncio.run(migrations.migrate(con))
+    asyncio.run(migrations.prepare_schema(con))
+    assert max(con.applied) == migrations.latest_version()
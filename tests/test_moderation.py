@@ -0,0 +1,26 @@
+# tests/test_moderation.py
+from datetime import datetime, timedelta, timezone
+
+from bot.moderation import _resumable
+
+
+def job(session_id=5, recent=True, until_in=timedelta(days=5)):
+    until_date = None if until_in is None else datetime.now(timezone.utc) + until_in
+    return {"session_id": session_id, "recent": recent, "until_date": until_date}
+
+
+def test_recent_job_of_the_same_session_is_resumed():
+    assert _resumable(job(), 5)
+    assert _resumable(job(until_in=None), 5)
+
+
+def test_job_of_another_session_or_too_old_is_not_resumed():
+    assert not _resumable(job(session_id=4), 5)
+    assert not _resumable(job(session_id=None), None)
+    assert not _resumable(job(recent=False), 5)
+
+
+def test_job_whose_mutes_would_be_permanent_is_not_resumed():
+    # Telegram restricts forever when until_date is past or < 30s away
+    assert not _resumable(job(until_in=timedelta(seconds=-60)), 5)
+    assert not _resumable(job(until_in=timedelta(seconds=10)), 5)
@@ -0,0 +1,114 @@
+# tests/test_outbound.py
+import asyncio
+import json
+
+import pytest
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+from bot.alerts import AlertDigest
+from bot.outbound import ALERT, OutboundScheduler
+from bot.ratelimit import SlidingWindow
+
+
+class RecordingRequest(BaseRequest):
+    """Records every Bot API call and answers it with a plausible result."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls.append((endpoint, request_data.parameters if request_data else {}))
+        if endpoint == "getChatMember":
+            result = {"status": "member", "user": {"id": 7, "is_bot": False, "first_name": "a"}}
+        else:
+            result = {"message_id": len(self.calls), "date": 0, "chat": {"id": -1, "type": "group"}}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_bot(scheduler):
+    request = RecordingRequest()
+    return ExtBot("1:test", request=request, rate_limiter=scheduler), request
+
+
+def test_scheduler_is_used_by_the_bot():
+    scheduler = OutboundScheduler()
+    assert scheduler
+    assert make_bot(scheduler)[0].rate_limiter is scheduler
+
+
+def test_alert_digest_is_sent_through_the_scheduler():
+    async def run():
+        bot, request = make_bot(OutboundScheduler())
+        digest = AlertDigest(window=0)
+        await digest.add(bot, -1, 7, "@someone", 2)
+        return digest, request
+
+    digest, request = asyncio.run(run())
+    assert digest.sent == 1
+    assert [endpoint for endpoint, _ in request.calls] == ["sendMessage"]
+    assert "@someone shared more than one link" in request.calls[0][1]["text"]
+
+
+def test_group_messages_are_held_to_the_chat_budget():
+    async def run():
+        scheduler = OutboundScheduler(global_rate=1000, chat_limit=2, chat_period=60)
+        bot, request = make_bot(scheduler)
+        sends = [asyncio.ensure_future(bot.send_message(-1, str(i))) for i in range(3)]
+        # Reads don't spend the chat's message budget
+        await bot.get_chat_member(-1, 7)
+        await asyncio.sleep(0.05)
+        sent = len([c for c in request.calls if c[0] == "sendMessage"])
+        queued = scheduler.queued
+        await scheduler.shutdown()
+        await asyncio.gather(*sends, return_exceptions=True)
+        return sent, queued
+
+    sent, queued = asyncio.run(run())
+    assert (sent, queued) == (2, 1)
+
+
+def test_alerts_over_the_chat_budget_are_refused_not_queued():
+    async def run():
+        scheduler = OutboundScheduler(global_rate=1000, chat_limit=1, chat_period=60)
+        bot, request = make_bot(scheduler)
+        await bot.send_message(-1, "command reply")
+        with pytest.raises(RetryAfter):
+            await bot.send_message(-1, "alert", rate_limit_args=ALERT)
+        return scheduler, request
+
+    scheduler, request = asyncio.run(run())
+    assert scheduler.refused == 1
+    assert scheduler.queued == 0
+    assert len(request.calls) == 1
+
+
+def test_no_request_waits_longer_than_max_wait():
+    async def run():
+        scheduler = OutboundScheduler(global_rate=1000, chat_limit=1, chat_period=60, max_wait=0.05)
+        bot, request = make_bot(scheduler)
+        await bot.send_message(-1, "first")
+        with pytest.raises(RetryAfter):
+            await bot.send_message(-1, "second")
+        await asyncio.sleep(0)
+        return scheduler, request
+
+    scheduler, request = asyncio.run(run())
+    assert (scheduler.refused, scheduler.queued, len(request.calls)) == (1, 0, 1)
+
+
+def test_window_counts_a_request_from_when_it_is_done():
+    window = SlidingWindow(1, period=0.05)
+    window.take()
+    # Still in flight: the slot stays used however long the call takes
+    assert window.delay() > 0
+    window.done()
+    assert 0 < window.delay() <= 0.05
@@ -0,0 +1,124 @@
+# tests/test_prefilter.py
+import asyncio
+import time
+
+import pytest
+from telegram import Update
+
+from bot import state
+from bot.prefilter import build_prefilter
+from bot.telegram_bot import build_bot
+
+CHAT = {"id": -100123, "type": "supergroup", "title": "test"}
+CHANNEL = {"id": -100456, "type": "channel", "title": "news"}
+USER = {"id": 42, "is_bot": False, "first_name": "Test"}
+PHOTO = [{"file_id": "AgAD", "file_unique_id": "AQAD", "width": 90, "height": 90}]
+STICKER = {
+    "file_id": "CAAC", "file_unique_id": "AgAD", "width": 512, "height": 512,
+    "is_animated": False, "is_video": False, "type": "regular",
+}
+POLL = {
+    "id": "1", "question": "?", "options": [{"text": "yes", "voter_count": 0}],
+    "total_voter_count": 0, "is_closed": False, "is_anonymous": True,
+    "type": "regular", "allows_multiple_answers": False,
+}
+MEMBER = {"status": "member", "user": USER}
+ADMIN = {"status": "administrator", "user": USER, "can_be_edited": False, "is_anonymous": False,
+         "can_manage_chat": True, "can_delete_messages": True, "can_manage_video_chats": True,
+         "can_restrict_members": True, "can_promote_members": False, "can_change_info": True,
+         "can_invite_users": True}
+
+
+def message(chat=CHAT, **fields):
+    return {"message_id": 1, "date": 0, "chat": chat, "from": USER, **fields}
+
+
+def command(text):
+    length = len(text.split()[0])
+    return message(text=text, entities=[{"type": "bot_command", "offset": 0, "length": length}])
+
+
+def link(text="https://x.com/a/status/1"):
+    return message(text=text, entities=[{"type": "url", "offset": 0, "length": len(text)}])
+
+
+UPDATES = {
+    "text": {"message": message(text="done")},
+    "command": {"message": command("/open")},
+    "command @bot": {"message": command("/count@test_bot")},
+    "command uppercase": {"message": command("/OPEN")},
+    "command uppercase @Bot": {"message": command("/Unsafe@Test_Bot now")},
+    "unknown command": {"message": command("/nope")},
+    "command @other_bot": {"message": command("/open@other_bot")},
+    "command not at the start": {"message": message(
+        text="hi /open", entities=[{"type": "bot_command", "offset": 3, "length": 5}])},
+    "link": {"message": link()},
+    "photo with caption": {"message": message(photo=PHOTO, caption="all done")},
+    "photo": {"message": message(photo=PHOTO)},
+    "edited text": {"edited_message": {**message(text="done"), "edit_date": 1}},
+    "edited link": {"edited_message": {**link(), "edit_date": 1}},
+    "edited command": {"edited_message": {**command("/count"), "edit_date": 1}},
+    "channel post": {"channel_post": message(chat=CHANNEL, text="done")},
+    "channel post link": {"channel_post": link() | {"chat": CHANNEL}},
+    "chat_member": {"chat_member": {"chat": CHAT, "from": USER, "date": 0,
+                                    "old_chat_member": MEMBER, "new_chat_member": ADMIN}},
+    "my_chat_member": {"my_chat_member": {"chat": CHAT, "from": USER, "date": 0,
+                                          "old_chat_member": MEMBER, "new_chat_member": ADMIN}},
+    "sticker": {"message": message(sticker=STICKER)},
+    "poll": {"poll": POLL},
+    "poll message": {"message": message(poll=POLL)},
+}
+
+
+@pytest.fixture(scope="module")
+def application():
+    application = build_bot()
+    # Command @username checks need the bot's identity (cached, no getMe)
+    asyncio.run(application.bot.get_me())
+    return application
+
+
+def handled(application, data):
+    """Whether a registered handler would act on `data`, as PTB decides it."""
+    update = Update.de_json(data, application.bot)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is None or check is False:
+                continue
+            needs = getattr(handler.callback, "prefilter_requires", None) or {}
+            # The callback returns right away for anything but a new message
+            if needs.get("message") and update.message is None:
+                continue
+            return True
+    return False
+
+
+@pytest.mark.parametrize("name", UPDATES)
+def test_prefilter_agrees_with_the_handlers(application, name):
+    data = {"update_id": 1, **UPDATES[name]}
+    keep = build_prefilter(application)
+    assert keep(data) == handled(application, data)
+
+
+def test_prefilter_drops_what_nothing_handles(application):
+    keep = build_prefilter(application)
+    for name in ("sticker", "poll", "poll message", "edited text", "edited link"):
+        assert not keep({"update_id": 1, **UPDATES[name]}), name
+
+
+def test_text_is_dropped_while_tracking_is_known_to_be_off(application):
+    session = state.sessions.get_or_create(CHAT["id"])
+    session.version = 1
+    session.checked_at = time.monotonic()
+    session.tracking_enabled = False
+    try:
+        keep = build_prefilter(application)
+        assert not keep({"update_id": 1, **UPDATES["text"]})
+        # Links and commands don't depend on tracking
+        assert keep({"update_id": 1, **UPDATES["link"]})
+        assert keep({"update_id": 1, **UPDATES["command"]})
+        # Not settled (something of the chat still queued): kept
+        assert build_prefilter(application, settled=lambda chat_id: False)({"update_id": 1, **UPDATES["text"]})
+    finally:
+        session.version = None
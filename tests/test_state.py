@@ -0,0 +1,26 @@
+# tests/test_state.py
+import asyncio
+
+import pytest
+
+from bot import state
+
+
+def test_failed_status_write_forces_a_reload(monkeypatch):
+    async def failing_fetchrow(query, *args):
+        raise ConnectionError("database went away")
+
+    async def nothing_to_flush():
+        pass
+
+    monkeypatch.setattr(state, "fetchrow", failing_fetchrow)
+    monkeypatch.setattr(state.link_buffer, "flush", nothing_to_flush)
+    session = state.sessions.get_or_create(-777)
+    session.version = 3
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(state.mark_users(-777, [42], state.SAFE))
+
+    # The next get_state() reads the chat again instead of trusting memory
+    assert session.version is None
+    assert state.cached_tracking(-777) is None
@@ -0,0 +1,40 @@
+# tests/test_urls.py
+import pytest
+
+from bot.urls import ParsedUrl, parse_url
+
+POST = ParsedUrl("https://x.com/someone/status/1790000000000000000", "x.com", "someone", "1790000000000000000")
+
+
+@pytest.mark.parametrize("raw", [
+    "https://x.com/someone/status/1790000000000000000",
+    "https://twitter.com/SomeOne/status/1790000000000000000?s=20&t=abc",
+    "http://mobile.twitter.com/someone/statuses/1790000000000000000",
+    "https://www.vxtwitter.com/someone/status/1790000000000000000/photo/1",
+    "x.com/someone/status/1790000000000000000",
+    "  https://fixupx.com/someone/status/1790000000000000000  ",
+])
+def test_x_post_variants_share_one_canonical_form(raw):
+    assert parse_url(raw) == POST
+
+
+def test_x_profile_and_pages():
+    assert parse_url("https://x.com/SomeOne/likes") == ParsedUrl("https://x.com/someone", "x.com", "someone")
+    assert parse_url("https://x.com/i/web/status/123") == ParsedUrl("https://x.com/i/status/123", "x.com", None, "123")
+    assert parse_url("https://x.com/home").handle is None
+    assert parse_url("https://x.com/this_name_is_too_long").handle is None
+
+
+def test_other_links_lose_only_tracking_parameters():
+    assert parse_url("https://WWW.Example.com/a/b/?id=7&utm_source=tg&fbclid=x").canonical == "https://example.com/a/b?id=7"
+    assert parse_url("http://example.com:8080/").canonical == "http://example.com:8080"
+    assert parse_url("example.com/page").canonical == "https://example.com/page"
+
+
+def test_non_http_links_are_kept_as_sent():
+    assert parse_url("tg://resolve?domain=foo") == ParsedUrl("tg://resolve?domain=foo", "")
+    assert parse_url("ftp://files.example.com/a.zip").canonical == "ftp://files.example.com/a.zip"
+
+
+def test_unparseable_url_is_kept():
+    assert parse_url("http://[broken").canonical == "http://[broken"
@@ -0,0 +1,82 @@
+# tests/test_webhook.py
+import asyncio
+import json
+
+from telegram.ext import MessageHandler, filters
+
+import api.webhook as webhook
+
+STICKER_UPDATE = {
+    "update_id": 501,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": -100123, "type": "supergroup", "title": "test"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        "sticker": {
+            "file_id": "CAACAgUAAxkBAAICLWfAVQEf", "file_unique_id": "AgADVgUAAgyw2VY",
+            "width": 512, "height": 512, "is_animated": False, "is_video": False, "type": "regular",
+        },
+    },
+}
+
+
+def test_update_whose_handler_raised_is_redelivered(monkeypatch):
+    calls = []
+
+    async def flaky(update, context):
+        calls.append(update.update_id)
+        if len(calls) == 1:
+            raise RuntimeError("handler failed")
+
+    handler = MessageHandler(filters.Sticker.ALL, flaky)
+    monkeypatch.setattr(webhook.dedup, "use_db", False)
+    monkeypatch.setattr(webhook, "keep_update", lambda data: True)
+    webhook.bot_app.add_handler(handler)
+
+    async def run():
+        body = json.dumps(STICKER_UPDATE).encode()
+        try:
+            statuses = [(await webhook.handle_webhook(body)).status_code for _ in range(3)]
+        finally:
+            await webhook.dispatcher.drain()
+        return statuses
+
+    try:
+        statuses = asyncio.run(run())
+    finally:
+        webhook.bot_app.remove_handler(handler)
+
+    # Failed → 500 and Telegram's redelivery runs; once it succeeded the next copy is dropped
+    assert statuses == [500, 200, 200]
+    assert calls == [501, 501]
+
+
+def test_handler_error_is_counted_as_failed(monkeypatch):
+    async def broken(update, context):
+        raise RuntimeError("handler failed")
+
+    handler = MessageHandler(filters.Sticker.ALL, broken)
+    monkeypatch.setattr(webhook.dedup, "use_db", False)
+    monkeypatch.setattr(webhook, "keep_update", lambda data: True)
+    webhook.bot_app.add_handler(handler)
+    def errors():
+        return sum(n for (_, outcome), n in webhook.metrics.updates.items() if outcome == "error")
+
+    before = errors()
+
+    async def run():
+        body = json.dumps({**STICKER_UPDATE, "update_id": 502}).encode()
+        try:
+            return (await webhook.handle_webhook(body)).status_code
+        finally:
+            await webhook.dispatcher.drain()
+
+    try:
+        status = asyncio.run(run())
+    finally:
+        webhook.bot_app.remove_handler(handler)
+
+    assert status == 500
+    assert errors() == before + 1
+    assert sum(shard.failed for shard in webhook.dispatcher.shards) >= 1